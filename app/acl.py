@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from app import app, db
+from .models import User, Location, Bulb, Group, Shared_control
+
+######################################################################################
+##
+## ACCESS CONTROL INDEX
+##
+## For each user, the ids of every location, group and bulb they may use and at
+## which level: OWN for what they own, CONTROL for what is shared with them
+## (locations granted through Shared_control, everything in those locations,
+## and bulbs lent to them through Bulb.friend_id). A user's index is built in a
+## few queries on first use and answers permission checks with dict lookups.
+##
+## Committed ORM changes to ownership, locations, grants or emails drop only the
+## affected users' indexes. Set-based state updates never change access and
+## leave the index alone.
+##
+######################################################################################
+
+CONTROL = 1
+OWN = 2
+
+#(id, level) FOR THE ROWS OF model OWNED BY THE USER, IN A SHARED LOCATION OR MATCHING extra
+def _levels(model, user_id, shared, *extra):
+    clauses = [model.owner_id == user_id] + list(extra)
+    if shared:
+        clauses.append((model.id if model is Location else model.location_id).in_(shared))
+    return dict((id, OWN if owner_id == user_id else CONTROL)
+        for (id, owner_id) in db.session.query(model.id, model.owner_id).filter(or_(*clauses)))
+
+def build_index(user_id):
+    email = db.session.query(User.email).filter(User.id == user_id).scalar()
+    if email is None:
+        return None
+    shared = set(id for (id,) in db.session.query(Shared_control.location_id).filter(Shared_control.email == email))
+    return {
+        'email': email,
+        'location': _levels(Location, user_id, shared),
+        'group': _levels(Group, user_id, shared),
+        'bulb': _levels(Bulb, user_id, shared, Bulb.friend_id == user_id)
+    }
+
+
+class AccessIndex(object):
+
+    def __init__(self, build, size=10000, ttl=300, clock=time.time):
+        self.build = build
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        #reverse maps, to find whose index a location or email change touches
+        self.by_location = {}
+        self.by_email = {}
+        #bumped by every invalidation; an index built across one is not stored
+        self.generation = 0
+        self.counters = dict.fromkeys(['hits', 'misses', 'builds', 'invalidated'], 0)
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[0] > self.clock():
+                self.entries[user_id] = self.entries.pop(user_id)
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+            generation = self.generation
+        index = self.build(user_id)
+        with self.lock:
+            self.counters['builds'] += 1
+            if index is not None and generation == self.generation:
+                self._drop(user_id)
+                self.entries[user_id] = (self.clock() + self.ttl, index)
+                for location_id in index['location']:
+                    self.by_location.setdefault(location_id, set()).add(user_id)
+                self.by_email.setdefault(index['email'], set()).add(user_id)
+                while len(self.entries) > self.size:
+                    self._drop(next(iter(self.entries)))
+        return index
+
+    def _drop(self, user_id):
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return False
+        for location_id in entry[1]['location']:
+            users = self.by_location.get(location_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.by_location[location_id]
+        users = self.by_email.get(entry[1]['email'])
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self.by_email[entry[1]['email']]
+        return True
+
+    #DROP THE INDEXES OF THESE USERS, OF EVERYONE WITH ACCESS TO THESE LOCATIONS,
+    #AND OF THE USERS WITH THESE EMAILS
+    def invalidate(self, user_ids=(), location_ids=(), emails=()):
+        with self.lock:
+            self.generation += 1
+            users = set(user_ids)
+            for location_id in location_ids:
+                users.update(self.by_location.get(location_id, ()))
+            for email in emails:
+                users.update(self.by_email.get(email, ()))
+            for user_id in users:
+                if self._drop(user_id):
+                    self.counters['invalidated'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.by_location.clear()
+            self.by_email.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=len(self.entries))
+
+_index = None
+_index_lock = threading.Lock()
+
+def access_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = AccessIndex(build_index, size=app.config.get('ACL_INDEX_SIZE', 10000),
+                    ttl=app.config.get('ACL_INDEX_TTL', 300))
+    return _index
+
+#TRUE IF THE USER MAY USE (OR, WITH own=True, MANAGE) THIS LOCATION, GROUP OR BULB
+def allowed(user_id, kind, id, own=False):
+    index = access_index().get(user_id)
+    if index is None:
+        return False
+    return index[kind].get(id, 0) >= (OWN if own else CONTROL)
+
+#TRUE IF THE USER MAY USE EVERY ONE OF THESE IDS
+def allowed_all(user_id, kind, ids, own=False):
+    index = access_index().get(user_id)
+    if index is None:
+        return False
+    level = OWN if own else CONTROL
+    return all(index[kind].get(id, 0) >= level for id in ids)
+
+def _values(obj, key):
+    #old and new values alike: (added, unchanged, deleted)
+    return set(v for part in get_history(obj, key) for v in (part or ()) if v is not None)
+
+#COLUMNS THAT DECIDE WHO HAS ACCESS TO WHAT
+ACCESS_COLUMNS = {Location: ['owner_id'], Group: ['owner_id', 'location_id'],
+    Bulb: ['owner_id', 'location_id', 'friend_id'], Shared_control: ['email', 'location_id'], User: ['email']}
+
+@event.listens_for(Session, 'after_flush')
+def _track_access_changes(session, context):
+    users, locations, emails = set(), set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        columns = ACCESS_COLUMNS.get(type(obj))
+        if columns is None:
+            continue
+        if obj in session.dirty and not any(get_history(obj, key).has_changes() for key in columns):
+            continue
+        if isinstance(obj, User):
+            users.add(obj.id)
+        elif isinstance(obj, Shared_control):
+            emails.update(_values(obj, 'email'))
+        else:
+            users.update(_values(obj, 'owner_id'))
+            locations.update([obj.id] if isinstance(obj, Location) else _values(obj, 'location_id'))
+            if isinstance(obj, Bulb):
+                users.update(_values(obj, 'friend_id'))
+    if users or locations or emails:
+        pending = session.info.setdefault('access_changes', (set(), set(), set()))
+        pending[0].update(users)
+        pending[1].update(locations)
+        pending[2].update(emails)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    pending = session.info.pop('access_changes', None)
+    if pending and _index is not None:
+        _index.invalidate(*pending)
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_after_rollback(session):
+    session.info.pop('access_changes', None)
@@ -0,0 +1,144 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+######################################################################################
+##
+## TTL CACHE
+##
+## A bounded, thread-safe LRU map whose entries also expire after ttl seconds.
+## Writers invalidate entries explicitly; the ttl only bounds how stale an entry
+## can get when the write happened in another process.
+##
+## DiskCache is the same for text values kept as files in a local directory,
+## for caches larger than memory should hold.
+##
+######################################################################################
+
+class TTLCache(object):
+
+    def __init__(self, size=1000, ttl=60, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = dict.fromkeys(['hits', 'misses', 'expired', 'evicted', 'invalidated'], 0)
+
+    #CACHED VALUE, OR load(key) STORED UNLESS IT IS None
+    def get(self, key, load):
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    #most recently used last
+                    self.entries[key] = self.entries.pop(key)
+                    self.counters['hits'] += 1
+                    return entry[1]
+                del self.entries[key]
+                self.counters['expired'] += 1
+            self.counters['misses'] += 1
+        value = load(key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counters['evicted'] += 1
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.counters['invalidated'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(self.counters, size=len(self.entries),
+                hit_rate=round(self.counters['hits'] / float(lookups), 4) if lookups else None)
+
+
+class DiskCache(TTLCache):
+
+    #entries maps key -> expiry; the value is in the key's file
+    def __init__(self, path, size=10000, ttl=60, clock=time.time):
+        TTLCache.__init__(self, size, ttl, clock)
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        #files left by an earlier process can't be matched to keys again
+        for name in os.listdir(path):
+            if len(name) == 40 or name.endswith('.tmp'):
+                os.remove(os.path.join(path, name))
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key, load):
+        now = self.clock()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None:
+                if expires > now:
+                    try:
+                        with io.open(self._file(key), encoding='utf-8') as f:
+                            value = f.read()
+                        self.entries[key] = self.entries.pop(key)
+                        self.counters['hits'] += 1
+                        return value
+                    except IOError:
+                        pass
+                else:
+                    self.counters['expired'] += 1
+                self._drop(key)
+            self.counters['misses'] += 1
+        value = load(key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(value)
+        with self.lock:
+            os.rename(temp, self._file(key))
+            self.entries.pop(key, None)
+            self.entries[key] = self.clock() + self.ttl
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+                self.counters['evicted'] += 1
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self._drop(key)
+                    self.counters['invalidated'] += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._drop(key)
@@ -0,0 +1,98 @@
+from datetime import datetime
+from sqlalchemy import event, literal, select
+from sqlalchemy.orm import Session
+from app import db
+from .models import User, Location, Bulb, Group, Shared_control, Change
+from .serializers import serialize_bulbs, serialize_groups
+
+######################################################################################
+##
+## INCREMENTAL CHANGE FEED
+##
+## Every insert, update and delete of a bulb, group, location or shared control
+## is recorded in the change table, in the same transaction, under the user
+## who should see it. The sequence number is the client's cursor; a resync reads
+## only the changes after it.
+##
+######################################################################################
+
+ENTITIES = {Bulb: 'bulb', Group: 'group', Location: 'location', Shared_control: 'shared_control'}
+MODELS = dict((name, model) for model, name in ENTITIES.items())
+
+#USERS WHO SEE A CHANGE TO THIS OBJECT
+def _audience(connection, obj):
+    if not isinstance(obj, Shared_control):
+        return [obj.owner_id]
+    users = []
+    owner = connection.execute(select([Location.owner_id]).where(Location.id == obj.location_id)).scalar()
+    grantee = connection.execute(select([User.id]).where(User.email == obj.email)).scalar()
+    return [u for u in (owner, grantee) if u is not None]
+
+@event.listens_for(Session, 'after_flush')
+def _record_orm_changes(session, context):
+    now = datetime.now()
+    rows = []
+    connection = session.connection()
+    for objects, op in ((session.new, 'upsert'), (session.dirty, 'upsert'), (session.deleted, 'delete')):
+        for obj in objects:
+            entity = ENTITIES.get(type(obj))
+            if entity is None or (op == 'upsert' and obj in session.dirty and not session.is_modified(obj)):
+                continue
+            for user_id in _audience(connection, obj):
+                rows.append({'user_id': user_id, 'entity': entity, 'entity_id': obj.id, 'op': op, 'changed_on': now})
+    if rows:
+        connection.execute(Change.__table__.insert(), rows)
+
+#SET-BASED UPDATES ARE RECORDED WITH ONE INSERT ... SELECT PER UPDATE
+@event.listens_for(Session, 'before_commit')
+def _record_bulk_changes(session):
+    changes = session.info.pop('bulk_changes', None)
+    if not changes:
+        return
+    now = datetime.now()
+    columns = ['user_id', 'entity', 'entity_id', 'op', 'changed_on']
+    connection = session.connection()
+    for model, criterion in changes:
+        source = select([model.owner_id, literal(ENTITIES[model]), model.id, literal('upsert'), literal(now)]) \
+            .where(criterion)
+        connection.execute(Change.__table__.insert().from_select(columns, source))
+
+def _serialize(entity, objects):
+    if entity == 'bulb':
+        return serialize_bulbs(objects)
+    if entity == 'group':
+        return serialize_groups(objects)
+    if entity == 'location':
+        return [{'id': l.id, 'name': l.name, 'owner_id': l.owner_id} for l in objects]
+    return [s.serialize() for s in objects]
+
+#ONE PAGE OF A USER'S CHANGES AFTER THE CURSOR, LATEST OP PER ENTITY, CURRENT STATE FOR UPSERTS
+def changes_since(user_id, since, limit):
+    page = Change.query.filter(Change.user_id == user_id, Change.seq > since) \
+        .order_by(Change.seq).limit(limit + 1).all()
+    more = len(page) > limit
+    page = page[:limit]
+    latest = {}
+    for change in page:
+        latest[(change.entity, change.entity_id)] = change
+    upserts = {}
+    for (entity, id), change in latest.items():
+        if change.op == 'upsert':
+            upserts.setdefault(entity, []).append(id)
+    data = {}
+    for entity, ids in upserts.items():
+        model = MODELS[entity]
+        objects = model.query.filter(model.id.in_(ids)).all()
+        for obj, rendered in zip(objects, _serialize(entity, objects)):
+            data[(entity, obj.id)] = rendered
+    response = []
+    for change in sorted(latest.values(), key=lambda c: c.seq):
+        key = (change.entity, change.entity_id)
+        deleted = change.op == 'delete' or key not in data
+        response.append({'seq': change.seq, 'entity': change.entity, 'id': change.entity_id,
+            'op': 'delete' if deleted else 'upsert', 'data': None if deleted else data[key]})
+    return {
+        'cursor': page[-1].seq if page else since,
+        'more': more,
+        'changes': response
+    }
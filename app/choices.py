@@ -0,0 +1,74 @@
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from app import app, db
+from .models import Location, Bulb
+from .cache import TTLCache
+
+######################################################################################
+##
+## DROPDOWN CHOICES
+##
+## The (id, name) lists behind the location and bulb selectors, read as two
+## column projections instead of loading whole rows, and cached per user.
+## Committed creates, deletes, renames and moves of a user's locations or
+## bulbs drop that user's lists.
+##
+######################################################################################
+
+MODELS = {'location': Location, 'bulb': Bulb}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def choice_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TTLCache(size=app.config.get('CHOICE_CACHE_SIZE', 10000),
+                    ttl=app.config.get('CHOICE_CACHE_TTL', 300))
+    return _cache
+
+def _load_choices(key):
+    kind, user_id = key
+    model = MODELS[kind]
+    return [(id, name) for id, name in
+        db.session.query(model.id, model.name).filter(model.owner_id == user_id).order_by(model.id)]
+
+def location_choices(user_id):
+    return choice_cache().get(('location', user_id), _load_choices)
+
+def bulb_choices(user_id):
+    return choice_cache().get(('bulb', user_id), _load_choices)
+
+def forget_choices(user_id):
+    if _cache is not None:
+        for kind in MODELS:
+            _cache.invalidate((kind, user_id))
+
+def _owners(obj):
+    #old and new values alike: (added, unchanged, deleted)
+    return set(v for part in get_history(obj, 'owner_id') for v in (part or ()) if v is not None)
+
+@event.listens_for(Session, 'after_flush')
+def _track_choice_changes(session, context):
+    owners = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, (Location, Bulb)):
+            continue
+        if obj in session.dirty and not any(get_history(obj, key).has_changes() for key in ('name', 'owner_id')):
+            continue
+        owners.update(_owners(obj))
+    if owners:
+        session.info.setdefault('forget_choices', set()).update(owners)
+
+@event.listens_for(Session, 'after_commit')
+def _forget_after_commit(session):
+    for user_id in session.info.pop('forget_choices', ()):
+        forget_choices(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_after_rollback(session):
+    session.info.pop('forget_choices', None)
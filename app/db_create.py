@@ -1,12 +1,21 @@
-from app import db
-from models import MyPosts
+from app import app, db
+from .models import User
+from .migrate import upgrade
+from .loader import BulkLoader, synthetic_fleet
 
-#CREATE DB
-db.create_all()
-
-#INSERT IN DB
-db.session.add(MyPosts("Hello", "WELCOME"))
-db.session.add(MyPosts("Well", "LETS DO SOME PYTHON"))
-
-#COMMIT THE CHANGES
-db.session.commit()
\ No newline at end of file
+#CREATE (OR UPGRADE) THE DB AND, IF IT HAS NO USERS YET, SEED A SMALL DEMO FLEET:
+#user1@example.com .. user3@example.com, PASSWORD "secret". RUN AS A MODULE FROM THE
+#REPOSITORY ROOT (IT USES PACKAGE IMPORTS):
+#
+#  python -m app.db_create
+#
+#FOR LARGE DATASETS USE python -m app.loader
+if __name__ == '__main__':
+    with app.app_context():
+        upgrade()
+        if db.session.query(User.id).first() is not None:
+            print('Database already has users; not seeding the demo fleet.')
+        else:
+            with BulkLoader(db.engine, workers=0) as loader:
+                loader.load(synthetic_fleet(3, locations=2, groups=2, bulbs=5))
+            print(loader.stats())
@@ -0,0 +1,85 @@
+import itertools
+import threading
+from app import app
+
+######################################################################################
+##
+## DEBOUNCED BRIGHTNESS WRITES
+##
+## Sliders send many brightness changes per second. Changes are held for a short
+## window, keyed by ('bulb', id) or ('group', id); only the latest value per key
+## is kept and everything left at the end of the window is written in one
+## transaction. A write that fails is kept pending and retried a window later.
+##
+######################################################################################
+
+class BrightnessDebouncer(object):
+
+    def __init__(self, window, writer, context=None):
+        #writer(items) persists [(kind, id, value), ...] in submission order, in one transaction
+        self.window = window
+        self.writer = writer
+        self.context = context
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        self.sequence = itertools.count()
+        self.submitted = 0
+        self.absorbed = 0
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+
+    def submit(self, kind, id, value):
+        with self.lock:
+            self.submitted += 1
+            if (kind, id) in self.pending:
+                self.absorbed += 1
+            self.pending[(kind, id)] = (next(self.sequence), value)
+            self._schedule()
+
+    #CALLED WITH THE LOCK HELD
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.window, self._flush_later)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except Exception:
+            app.logger.exception('Debounced brightness write failed, retrying.')
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.timer = None
+        if not pending:
+            return 0
+        #a group change made after a change to one of its bulbs must be applied after it
+        items = [(kind, id, value) for (kind, id), (seq, value) in sorted(pending.items(), key=lambda p: p[1][0])]
+        try:
+            if self.context is not None:
+                with self.context():
+                    self.writer(items)
+            else:
+                self.writer(items)
+        except Exception:
+            #keep the values pending (newer submissions win) and retry a window later
+            with self.lock:
+                for key, entry in pending.items():
+                    self.pending.setdefault(key, entry)
+                self.failed += 1
+                self._schedule()
+            raise
+        with self.lock:
+            self.flushes += 1
+            self.written += len(items)
+        return len(items)
+
+    def stats(self):
+        with self.lock:
+            return {'submitted': self.submitted, 'absorbed': self.absorbed, 'flushes': self.flushes,
+                'written': self.written, 'failed': self.failed, 'pending': len(self.pending)}
@@ -0,0 +1,73 @@
+import sys
+from sqlalchemy import and_, exists, or_, select
+from app import app, db
+from .models import User, Location, Bulb, Group, Shared_control, Change, Entry_Scene, Schedule, State_history, \
+    State_rollup
+from .state import bulb_selection
+
+######################################################################################
+##
+## INDEX USAGE REPORT
+##
+## Runs EXPLAIN QUERY PLAN over the app's known hot queries and flags every
+## full table scan. Exits non-zero when one is found:
+##
+##   python -m app.diagnostics
+##
+######################################################################################
+
+#(name, statement) WITH PLACEHOLDER IDS; ONLY THE PLAN MATTERS
+def known_queries():
+    groups = select([Bulb.group_id]).where(bulb_selection(1, location_id=1))
+    return [
+        ('dashboard locations', select([Location.id, Location.name]).where(Location.owner_id == 1)),
+        ('dashboard bulbs', select([Bulb.id]).where(and_(Bulb.owner_id == 1, Bulb.location_id == 1))),
+        ('dashboard groups', select([Group.id]).where(and_(Group.owner_id == 1, Group.location_id == 1))),
+        ('bulbs of a location', select([Bulb.id]).where(bulb_selection(1, location_id=1))),
+        ('bulbs of a group', select([Bulb.id]).where(bulb_selection(1, group_id=1))),
+        ('group power sync', select([Group.id]).where(and_(Group.id.in_(groups), Group.power == True,
+            ~exists().where(and_(Bulb.group_id == Group.id, Bulb.power != True))))),
+        ('grants of a user', select([Shared_control.location_id]).where(Shared_control.email == 'user@example.com')),
+        ('grantees of a location', select([Shared_control.email]).where(Shared_control.location_id == 1)),
+        ('access index bulbs', select([Bulb.id, Bulb.owner_id]).where(or_(Bulb.owner_id == 1, Bulb.friend_id == 1,
+            Bulb.location_id.in_([1, 2])))),
+        ('access index groups', select([Group.id, Group.owner_id]).where(or_(Group.owner_id == 1,
+            Group.location_id.in_([1, 2])))),
+        ('user by email', select([User.id]).where(User.email == 'user@example.com')),
+        ('change feed page', select([Change.seq]).where(and_(Change.user_id == 1, Change.seq > 0))
+            .order_by(Change.seq).limit(500)),
+        ('scene entries', select([Entry_Scene.bulb_id]).where(Entry_Scene.scene_id == 1)),
+        ('due schedules', select([Schedule.id]).where(Schedule.fire_at <= 0)),
+        ('history to roll up', select([State_history.entity_id]).where(and_(State_history.at >= 0,
+            State_history.at < 60))),
+        ('history range', select([State_rollup.bucket]).where(and_(State_rollup.resolution == 60,
+            State_rollup.kind == 'bulb', State_rollup.entity_id == 1, State_rollup.bucket >= 0))),
+    ]
+
+#PLAN ROWS AS (detail, full scan?)
+def explain(connection, statement):
+    sql = str(statement.compile(connection, compile_kwargs={'literal_binds': True}))
+    plan = []
+    for row in connection.execute('EXPLAIN QUERY PLAN ' + sql):
+        detail = row[-1]
+        #"SCAN t USING INDEX" reads a whole index, "SCAN t" the whole table
+        plan.append((detail, detail.startswith('SCAN') and 'USING' not in detail))
+    return plan
+
+def report(out=sys.stdout):
+    scans = 0
+    connection = db.engine.connect()
+    try:
+        for name, statement in known_queries():
+            out.write('%s\n' % name)
+            for detail, full_scan in explain(connection, statement):
+                scans += full_scan
+                out.write('  %s %s\n' % ('FULL SCAN' if full_scan else '         ', detail))
+    finally:
+        connection.close()
+    out.write('%d full scan(s)\n' % scans)
+    return scans
+
+if __name__ == '__main__':
+    with app.app_context():
+        sys.exit(1 if report() else 0)
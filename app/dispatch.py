@@ -0,0 +1,161 @@
+import json
+import socket
+import threading
+import time
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+from app import app
+from .state import on_change
+
+######################################################################################
+##
+## DEVICE COMMAND DISPATCH
+##
+## Committed bulb state changes are sent to the physical bulbs off the request
+## thread. Commands wait in a bounded queue keyed by bulb id: while a bulb's
+## command is still queued a newer one replaces it (latest wins), so a burst of
+## changes costs one send per bulb. A pool of sender threads drains the queue and
+## retries failed sends with exponential backoff, giving up on a retry as soon as
+## a newer command for the same bulb is waiting.
+##
+######################################################################################
+
+class CommandDispatcher(object):
+
+    def __init__(self, transport, workers=8, queue_size=10000, retries=3, backoff=0.05):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.counters = dict.fromkeys(['submitted', 'coalesced', 'dropped', 'sent', 'retried', 'superseded', 'failed'], 0)
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='dispatch-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    #QUEUE A COMMAND (A DICT WITH id, power, brightness, version); False WHEN THE QUEUE IS FULL
+    def submit(self, command):
+        with self.lock:
+            self.counters['submitted'] += 1
+            queued = command['id'] in self.pending
+            self.pending[command['id']] = command
+            if queued:
+                self.counters['coalesced'] += 1
+                return True
+        try:
+            self.queue.put_nowait(command['id'])
+        except Full:
+            with self.lock:
+                self.pending.pop(command['id'], None)
+                self.counters['dropped'] += 1
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            bulb_id = self.queue.get()
+            with self.lock:
+                command = self.pending.pop(bulb_id, None)
+            if command is not None:
+                self._send(command)
+            self.queue.task_done()
+
+    def _send(self, command):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.transport.send(command)
+                self._count('sent')
+                return True
+            except Exception:
+                if attempt == self.retries:
+                    self._count('failed')
+                    return False
+            time.sleep(delay)
+            delay *= 2
+            with self.lock:
+                if command['id'] in self.pending:
+                    self.counters['superseded'] += 1
+                    return False
+            self._count('retried')
+
+    #BLOCK UNTIL EVERY QUEUED COMMAND HAS BEEN HANDLED
+    def join(self):
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, queued=len(self.pending))
+
+
+class UdpTransport(object):
+
+    #address_for(bulb_id) -> (host, port); a command is sent when the device acks its version
+    def __init__(self, address_for, timeout=0.5):
+        self.address_for = address_for
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _socket(self):
+        sock = getattr(self.local, 'socket', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(self.timeout)
+            self.local.socket = sock
+        return sock
+
+    def send(self, command):
+        sock = self._socket()
+        sock.sendto(json.dumps(command).encode('utf-8'), self.address_for(command['id']))
+        deadline = time.time() + self.timeout
+        while True:
+            sock.settimeout(max(deadline - time.time(), 0.001))
+            ack = json.loads(sock.recvfrom(4096)[0].decode('utf-8'))
+            #late acks for earlier attempts are skipped
+            if ack.get('id') == command['id'] and ack.get('version') == command.get('version'):
+                return ack
+
+
+def command_for(row):
+    return {'id': row['id'], 'power': bool(row['power']), 'brightness': row['brightness'],
+        'version': row['version'], 'sent_at': time.time()}
+
+#ALL BULBS ARE REACHED THROUGH DEVICE_GATEWAY (host, port), OR DEVICE_GATEWAY_PORTS PORTS FROM IT
+def gateway_address(bulb_id):
+    host, port = app.config.get('DEVICE_GATEWAY', ('127.0.0.1', 9999))
+    return host, port + bulb_id % app.config.get('DEVICE_GATEWAY_PORTS', 1)
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def dispatcher():
+    global _dispatcher
+    if not app.config.get('DISPATCH_ENABLED', False):
+        return None
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = CommandDispatcher(
+                    UdpTransport(gateway_address, timeout=app.config.get('DISPATCH_TIMEOUT', 0.5)),
+                    workers=app.config.get('DISPATCH_WORKERS', 8),
+                    queue_size=app.config.get('DISPATCH_QUEUE_SIZE', 10000),
+                    retries=app.config.get('DISPATCH_RETRIES', 3),
+                    backoff=app.config.get('DISPATCH_BACKOFF', 0.05))
+    return _dispatcher
+
+@on_change
+def dispatch_state(rows):
+    sender = dispatcher()
+    if sender is None:
+        return
+    for row in rows:
+        if row['kind'] == 'bulb':
+            sender.submit(command_for(row))
@@ -0,0 +1,89 @@
+import hashlib
+from flask import request
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from app import app, db
+from .models import User, Location, Bulb, Group
+
+######################################################################################
+##
+## CONDITIONAL GETS
+##
+## API resources carry weak ETags built from version stamps: a few integers
+## read with one or two aggregate queries, no rows loaded or serialized.
+## Bulbs and groups have their compare-and-swap version; users and locations
+## get a version bumped on every flushed update. Embedded and listed members
+## count as (count, max id, sum of versions), which changes with any insert,
+## delete or update among them. A request whose If-None-Match matches is
+## answered 304 before the resource is loaded.
+##
+######################################################################################
+
+def _first(statement):
+    row = db.session.execute(statement).first()
+    return tuple(row) if row is not None else None
+
+#(count, max id, sum of versions) OF THE ROWS MATCHING criterion
+def members(model, criterion):
+    return _first(select([func.count(model.id), func.coalesce(func.max(model.id), 0),
+        func.coalesce(func.sum(model.version), 0)]).where(criterion))
+
+#PER-RESOURCE STAMPS; None WHEN THE RESOURCE DOES NOT EXIST
+def bulb_stamp(id):
+    return _first(select([Bulb.version, Location.version, User.version])
+        .select_from(Bulb.__table__.outerjoin(Location.__table__, Bulb.location_id == Location.id)
+            .outerjoin(User.__table__, Bulb.owner_id == User.id))
+        .where(Bulb.id == id))
+
+def group_stamp(id):
+    stamp = _first(select([Group.version, Location.version, User.version])
+        .select_from(Group.__table__.outerjoin(Location.__table__, Group.location_id == Location.id)
+            .outerjoin(User.__table__, Group.owner_id == User.id))
+        .where(Group.id == id))
+    return stamp and stamp + members(Bulb, Bulb.group_id == id)
+
+def location_stamp(id):
+    stamp = _first(select([Location.version, User.version])
+        .select_from(Location.__table__.outerjoin(User.__table__, Location.owner_id == User.id))
+        .where(Location.id == id))
+    return stamp and stamp + members(Bulb, Bulb.location_id == id)
+
+def user_stamp(id):
+    stamp = _first(select([User.version]).where(User.id == id))
+    return stamp and stamp + members(Location, Location.owner_id == id) + members(Bulb, Bulb.owner_id == id)
+
+def _versions(model, ids):
+    return _first(select([func.coalesce(func.sum(model.version), 0)]).where(model.id.in_(ids)))
+
+#A LISTED COLLECTION: ITS ROWS, THEIR OWNERS AND LOCATIONS, AND THE BULBS EMBEDDED IN THEM
+def collection_stamp(model, criterion):
+    stamp = members(model, criterion) + _versions(User, select([model.owner_id]).where(criterion))
+    if model is not Location:
+        stamp += _versions(Location, select([model.location_id]).where(criterion))
+    if model is not Bulb:
+        column = Bulb.location_id if model is Location else Bulb.group_id
+        stamp += members(Bulb, column.in_(select([model.id]).where(criterion)))
+    return stamp
+
+#THE SAME RESOURCE AND QUERY STRING WITH THE SAME STAMP GETS THE SAME ETAG
+def etag_for(stamp):
+    return hashlib.sha1(repr((stamp, request.full_path)).encode('utf-8')).hexdigest()
+
+def is_fresh(etag):
+    return request.if_none_match.contains_weak(etag)
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    #cached copies must be revalidated before use
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def not_modified(etag):
+    return with_etag(app.response_class(status=304), etag)
+
+#USER AND LOCATION VERSIONS MOVE WITH EVERY UPDATE THAT REACHES THE DATABASE
+@event.listens_for(Session, 'before_flush')
+def _bump_versions(session, context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, (User, Location)) and session.is_modified(obj, include_collections=False):
+            obj.version = type(obj).version + 1
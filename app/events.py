@@ -0,0 +1,100 @@
+import json
+import threading
+from flask import Response
+from app import app
+from .state import on_change
+
+######################################################################################
+##
+## SERVER-SENT EVENTS
+##
+## Every committed bulb/group state change is appended once to a shared,
+## bounded log with a sequence number. Subscribers are plain generators that
+## sleep on one condition and read the log from their last sequence, so an idle
+## subscriber costs a generator and nothing else: no queue and no thread of its
+## own (run under an evented worker, e.g. gunicorn -k gevent, to hold thousands
+## of open streams).
+##
+######################################################################################
+
+class EventBroker(object):
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.condition = threading.Condition()
+        self.events = []
+        self.first = 1
+        self.sequence = 0
+
+    def publish(self, events):
+        with self.condition:
+            for event in events:
+                self.sequence += 1
+                self.events.append(event)
+            if len(self.events) > 2 * self.size:
+                drop = len(self.events) - self.size
+                del self.events[:drop]
+                self.first += drop
+            self.condition.notify_all()
+
+    #EVENTS AFTER SEQUENCE after AS (last sequence, events); events is None IF THEY WERE DROPPED
+    def wait(self, after, timeout):
+        with self.condition:
+            if self.sequence <= after:
+                self.condition.wait(timeout)
+            if after + 1 < self.first:
+                return self.sequence, None
+            return self.sequence, self.events[after + 1 - self.first:]
+
+broker = EventBroker()
+
+#serialize_state shape, plus what subscribers filter on
+def state_event(row):
+    return {
+        'type': row['kind'],
+        'id': row['id'],
+        'name': row['name'],
+        'owner_id': row['owner_id'],
+        'location_id': row['location_id'],
+        'state': {
+            'state_bool': row['power'],
+            'state_string': 'Off' if row['power'] == False else 'On'
+        },
+        'brightness': row['brightness'],
+        'version': row['version']
+    }
+
+@on_change
+def publish_state(rows):
+    broker.publish([state_event(row) for row in rows])
+
+def _message(sequence, event, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (sequence, event, json.dumps(data))
+
+#STREAM A USER'S (OR ONE OF THEIR LOCATIONS') STATE CHANGES
+def event_stream(owner_id, location_id=None, last_id=None):
+    keepalive = app.config.get('SSE_KEEPALIVE', 15)
+    def matches(event):
+        if location_id is not None:
+            return event['location_id'] == location_id
+        return event['owner_id'] == owner_id
+    def generate():
+        after = broker.sequence if last_id is None else last_id
+        yield 'retry: 3000\n\n'
+        while True:
+            sequence, events = broker.wait(after, keepalive)
+            if events is None:
+                #fell behind the log: the client has to reload full state
+                yield _message(sequence, 'resync', {})
+            elif not events:
+                yield ': keepalive\n\n'
+            else:
+                first = after + 1
+                for offset, event in enumerate(events):
+                    if matches(event):
+                        yield _message(first + offset, 'state', event)
+            after = sequence
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,81 @@
+import argparse
+import json
+import sys
+from datetime import date, datetime
+from flask import Response
+from sqlalchemy import or_, select
+from app import app, db
+from .models import User, Location, Group, Bulb, Shared_control
+from .storage import read_engine
+
+######################################################################################
+##
+## STREAMING EXPORT
+##
+## A user's whole fleet as NDJSON: one line for the user, then one per location,
+## group, bulb and shared control, each a flat row tagged with its "type". Rows
+## are read from a cursor a batch at a time and written out as they come, so
+## memory stays flat however large the account is.
+##
+##   python -m app.export owner@example.com > fleet.ndjson
+##
+######################################################################################
+
+USER_COLUMNS = [User.id, User.nickname, User.email, User.registered_on, User.confirmed, User.last_location]
+
+#(type, statement) IN THE ORDER THEY ARE WRITTEN
+def export_statements(user_id):
+    owned = select([Location.id]).where(Location.owner_id == user_id)
+    email = select([User.email]).where(User.id == user_id).as_scalar()
+    return [
+        ('user', select(USER_COLUMNS).where(User.id == user_id)),
+        ('location', select([Location.id, Location.name, Location.owner_id])
+            .where(Location.owner_id == user_id).order_by(Location.id)),
+        ('group', select([Group.id, Group.name, Group.owner_id, Group.location_id, Group.power, Group.brightness,
+            Group.version]).where(Group.owner_id == user_id).order_by(Group.id)),
+        ('bulb', select([Bulb.id, Bulb.name, Bulb.bulb_type, Bulb.owner_id, Bulb.friend_id, Bulb.location_id,
+            Bulb.group_id, Bulb.power, Bulb.brightness, Bulb.version]).where(Bulb.owner_id == user_id).order_by(Bulb.id)),
+        #grants on the user's locations and grants to the user
+        ('shared_control', select([Shared_control.id, Shared_control.email, Shared_control.location_id])
+            .where(or_(Shared_control.location_id.in_(owned), Shared_control.email == email))
+            .order_by(Shared_control.id)),
+    ]
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+#NDJSON CHUNKS (ONE PER BATCH OF ROWS) FOR THE USER'S FLEET; CLOSES ITS OWN CONNECTION
+def export_lines(engine, user_id, batch=1000):
+    connection = engine.connect()
+    try:
+        for kind, statement in export_statements(user_id):
+            result = connection.execution_options(stream_results=True).execute(statement)
+            while True:
+                rows = result.fetchmany(batch)
+                if not rows:
+                    break
+                yield ''.join(json.dumps(dict(row, type=kind), default=_json_default) + '\n' for row in rows)
+            result.close()
+    finally:
+        connection.close()
+
+def export_response(user_id):
+    engine = read_engine() or db.engine
+    response = Response(export_lines(engine, user_id, app.config.get('EXPORT_BATCH', 1000)),
+        mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename=fleet-%d.ndjson' % user_id
+    return response
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a user's fleet as NDJSON.")
+    parser.add_argument('user', help='email or id')
+    parser.add_argument('--batch', type=int, default=1000)
+    args = parser.parse_args()
+    with app.app_context():
+        user = User.query.get(int(args.user)) if args.user.isdigit() else User.query.filter_by(email=args.user).first()
+        if user is None:
+            sys.exit('No such user: %s' % args.user)
+        for chunk in export_lines(read_engine() or db.engine, user.id, args.batch):
+            sys.stdout.write(chunk)
@@ -0,0 +1,150 @@
+import hashlib
+import threading
+from flask import render_template
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from app import app
+from .models import Location, Bulb, Group
+from .cache import TTLCache, DiskCache
+from .forms import AddBulbForm, AddLocationForm, AddGroupForm, LocationSelector
+from .state import on_change
+from .choices import bulb_choices
+
+######################################################################################
+##
+## DASHBOARD FRAGMENT CACHE (ENABLED WITH FRAGMENT_CACHE = 'memory' OR 'disk')
+##
+## The dashboard's bulb list, group list and forms are rendered once per user
+## and location and kept in an LRU cache, in memory or as files under
+## FRAGMENT_CACHE_DIR. List keys carry the location's version, which every
+## committed write to the location's bulbs and groups (ORM, set-based, hot
+## store once flushed) bumps, so a stale fragment is never looked up again and
+## ages out.
+## Form keys carry a digest of the user's dropdown choices.
+##
+## Forms are cached without their CSRF token; the current one is put back on
+## every render.
+##
+######################################################################################
+
+CSRF_MARKER = '__csrf_token__'
+
+class FragmentCache(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    def version(self, location_id):
+        return self.versions.get(location_id, 0)
+
+    def bump(self, location_ids):
+        with self.lock:
+            for location_id in location_ids:
+                if location_id is not None:
+                    self.versions[location_id] = self.versions.get(location_id, 0) + 1
+
+    def get(self, key, render):
+        return self.backend.get(key, lambda key: render())
+
+    def stats(self):
+        return dict(self.backend.stats(), locations=len(self.versions))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+#None WHEN FRAGMENT_CACHE IS OFF
+def fragment_cache():
+    global _cache
+    kind = app.config.get('FRAGMENT_CACHE')
+    if _cache is None and kind:
+        with _cache_lock:
+            if _cache is None:
+                size = app.config.get('FRAGMENT_CACHE_SIZE', 10000)
+                ttl = app.config.get('FRAGMENT_CACHE_TTL', 300)
+                if kind == 'disk':
+                    backend = DiskCache(app.config.get('FRAGMENT_CACHE_DIR', 'fragments'), size, ttl)
+                else:
+                    backend = TTLCache(size, ttl)
+                cache = FragmentCache(backend)
+                #hot store writes only once they're in the database, or a render in between
+                #would be cached under the new version with the old state
+                on_change(lambda rows: cache.bump(set(row.get('location_id') for row in rows)), stored=True)
+                _cache = cache
+    return _cache
+
+def _digest(*values):
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+def _csrf_token():
+    return generate_csrf() if app.config.get('WTF_CSRF_ENABLED', True) else None
+
+def _render_forms(location_choices, bulbs):
+    location_form = AddLocationForm()
+    bulb_form = AddBulbForm()
+    group_form = AddGroupForm()
+    location_selector = LocationSelector()
+    bulb_form.location.choices = location_choices
+    group_form.location.choices = location_choices
+    location_selector.selector.choices = location_choices
+    group_form.bulbs.choices = bulbs
+    html = render_template('fragments/forms.html', location_form=location_form, bulb_form=bulb_form,
+        group_form=group_form, location_selector=location_selector)
+    token = _csrf_token()
+    return html.replace(token, CSRF_MARKER) if token else html
+
+#{'bulbs', 'groups', 'forms'} HTML FOR THE USER'S CURRENT LOCATION
+def dashboard_fragments(user, location_choices):
+    location_id = user.last_location
+    bulbs = bulb_choices(user.id)
+    render = {
+        'bulbs': lambda: render_template('fragments/bulbs.html',
+            bulbs=user.bulbs.filter_by(location_id=location_id).order_by(Bulb.id)),
+        'groups': lambda: render_template('fragments/groups.html',
+            groups=user.groups.filter_by(location_id=location_id).order_by(Group.id)),
+        'forms': lambda: _render_forms(location_choices, bulbs),
+    }
+    cache = fragment_cache()
+    if cache is None:
+        fragments = dict((name, fn()) for name, fn in render.items())
+    else:
+        version = cache.version(location_id)
+        fragments = {
+            'bulbs': cache.get(('bulbs', user.id, location_id, version), render['bulbs']),
+            'groups': cache.get(('groups', user.id, location_id, version), render['groups']),
+            'forms': cache.get(('forms', user.id, location_id, _digest(location_choices, bulbs)), render['forms']),
+        }
+    token = _csrf_token()
+    fragments['forms'] = fragments['forms'].replace(CSRF_MARKER, token) if token else fragments['forms']
+    return fragments
+
+def _locations(obj):
+    if isinstance(obj, Location):
+        return set([obj.id])
+    #old and new values alike: (added, unchanged, deleted)
+    return set(v for part in get_history(obj, 'location_id') for v in (part or ()) if v is not None)
+
+#ORM CREATES, DELETES AND MOVES; SET-BASED WRITES ARRIVE THROUGH on_change
+@event.listens_for(Session, 'after_flush')
+def _track_fragment_changes(session, context):
+    if _cache is None:
+        return
+    locations = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Location, Bulb, Group)) and (obj not in session.dirty or session.is_modified(obj)):
+            locations.update(_locations(obj))
+    if locations:
+        session.info.setdefault('fragment_locations', set()).update(locations)
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    locations = session.info.pop('fragment_locations', None)
+    if locations and _cache is not None:
+        _cache.bump(locations)
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_after_rollback(session):
+    session.info.pop('fragment_locations', None)
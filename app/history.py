@@ -0,0 +1,345 @@
+import argparse
+import json
+import threading
+import time
+from itertools import groupby
+from sqlalchemy import and_, func, select
+from app import app, db
+from .models import State_history, State_rollup, Rollup_mark
+from .state import on_change
+
+######################################################################################
+##
+## STATE HISTORY (ENABLED WITH HISTORY_ENABLED)
+##
+## Every committed power or brightness change of a bulb or group (ORM, set-based,
+## debounced, hot store, scheduled) reaches on_change; it is buffered and
+## appended to state_history in batches, never one insert per change. Rows
+## whose state didn't change since the last one seen are skipped.
+##
+## A maintenance pass, in a background thread or from cron, rolls the raw rows
+## up into minute, hour and day buckets (changes, seconds powered on, brightness
+## range, state at the end), deletes raw rows and rollups past their retention,
+## and runs ANALYZE, plus VACUUM on SQLite once enough pages are free:
+##
+##   python -m app.history maintain
+##   python -m app.history range bulb 12 --resolution hour
+##
+## Range queries read the rollups only, so they lag the present by up to one
+## bucket plus HISTORY_ROLLUP_LAG.
+##
+######################################################################################
+
+RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+class HistoryLog(object):
+
+    def __init__(self, writer, batch_size=500, interval=1.0, context=None, clock=time.time):
+        #writer(rows) appends [{at, kind, entity_id, power, brightness}, ...] in one transaction
+        self.writer = writer
+        self.batch_size = batch_size
+        self.interval = interval
+        self.context = context
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.buffer = []
+        #latest state per (kind, id): buffered, being written, and written
+        self.pending = {}
+        self.writing = {}
+        self.last = {}
+        self.timer = None
+        self.received = 0
+        self.skipped = 0
+        self.flushes = 0
+        self.written = 0
+        self.failed = 0
+
+    #on_change listener: state rows with kind, id, power and brightness
+    def record(self, rows):
+        now = int(self.clock())
+        with self.lock:
+            for row in rows:
+                self.received += 1
+                key = (row['kind'], row['id'])
+                state = (row.get('power'), row.get('brightness'))
+                if self._latest(key) == state:
+                    self.skipped += 1
+                    continue
+                self.pending[key] = state
+                self.buffer.append({'at': now, 'kind': row['kind'], 'entity_id': row['id'],
+                    'power': state[0], 'brightness': state[1]})
+            full = len(self.buffer) >= self.batch_size
+            if not full and self.buffer:
+                self._schedule()
+        if full:
+            self.flush()
+
+    #CALLED WITH THE LOCK HELD
+    def _latest(self, key):
+        for states in (self.pending, self.writing, self.last):
+            if key in states:
+                return states[key]
+        return None
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self._flush_later)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except Exception:
+            app.logger.exception('State history write failed, retrying.')
+
+    def flush(self):
+        with self.lock:
+            rows = self.buffer
+            self.buffer = []
+            self.writing = self.pending
+            self.pending = {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not rows:
+            return 0
+        try:
+            if self.context is not None:
+                with self.context():
+                    self.writer(rows)
+            else:
+                self.writer(rows)
+        except Exception:
+            #put the rows back ahead of anything recorded since, and retry an interval later
+            with self.lock:
+                self.buffer = rows + self.buffer
+                for key, state in self.writing.items():
+                    self.pending.setdefault(key, state)
+                self.writing = {}
+                self.failed += 1
+                self._schedule()
+            raise
+        with self.lock:
+            self.last.update(self.writing)
+            self.writing = {}
+            self.flushes += 1
+            self.written += len(rows)
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            return {'received': self.received, 'skipped': self.skipped, 'flushes': self.flushes,
+                'written': self.written, 'failed': self.failed, 'pending': len(self.buffer)}
+
+def write_history(rows):
+    with db.engine.begin() as connection:
+        connection.execute(State_history.__table__.insert(), rows)
+
+###
+### ROLLUPS
+###
+
+#ONE BUCKET OF AN ENTITY FROM ITS STATE BEFORE THE BUCKET (None IF UNKNOWN) AND ITS CHANGES IN IT
+def _bucket(resolution, bucket, state, points):
+    power, brightness = state or (None, None)
+    on_seconds, t = 0, bucket
+    levels = []
+    for point in points:
+        if power:
+            on_seconds += point['at'] - t
+        t = point['at']
+        power, brightness = point['power'], point['brightness']
+        if brightness is not None:
+            levels.append(brightness)
+    if power:
+        on_seconds += bucket + resolution - t
+    return {'resolution': resolution, 'bucket': bucket, 'changes': len(points), 'on_seconds': on_seconds,
+        'power': power, 'brightness': brightness,
+        'brightness_min': min(levels) if levels else None, 'brightness_max': max(levels) if levels else None}
+
+#END STATES OF EACH ENTITY'S LATEST BUCKET BEFORE start
+def _carried(connection, resolution, start):
+    rollup = State_rollup.__table__
+    latest = select([rollup.c.kind, rollup.c.entity_id, func.max(rollup.c.bucket).label('bucket')]) \
+        .where(and_(rollup.c.resolution == resolution, rollup.c.bucket < start)) \
+        .group_by(rollup.c.kind, rollup.c.entity_id).alias('latest')
+    statement = select([rollup.c.kind, rollup.c.entity_id, rollup.c.power, rollup.c.brightness]) \
+        .select_from(rollup.join(latest, and_(rollup.c.kind == latest.c.kind,
+            rollup.c.entity_id == latest.c.entity_id, rollup.c.bucket == latest.c.bucket))) \
+        .where(rollup.c.resolution == resolution)
+    return dict(((kind, id), (power, brightness)) for kind, id, power, brightness in connection.execute(statement))
+
+#ROLL RAW HISTORY IN [start, end) (BOTH MULTIPLES OF resolution) INTO BUCKETS; RETURNS THE NUMBER WRITTEN
+def roll_up(connection, resolution, start, end):
+    history = State_history.__table__
+    carried = _carried(connection, resolution, start)
+    rows = connection.execute(select([history.c.kind, history.c.entity_id, history.c.at, history.c.power,
+        history.c.brightness]).where(and_(history.c.at >= start, history.c.at < end))
+        .order_by(history.c.kind, history.c.entity_id, history.c.at, history.c.seq))
+    buckets = []
+    for (kind, entity_id), points in groupby((dict(row) for row in rows), lambda p: (p['kind'], p['entity_id'])):
+        state = carried.get((kind, entity_id))
+        for bucket, changes in groupby(points, lambda p: p['at'] - p['at'] % resolution):
+            item = _bucket(resolution, bucket, state, list(changes))
+            state = (item['power'], item['brightness'])
+            buckets.append(dict(item, kind=kind, entity_id=entity_id))
+    if buckets:
+        connection.execute(State_rollup.__table__.insert(), buckets)
+    return len(buckets)
+
+def _mark(connection, resolution, end):
+    until = connection.execute(select([Rollup_mark.until]).where(Rollup_mark.resolution == resolution)).scalar()
+    if until is None:
+        first = connection.execute(select([func.min(State_history.at)])).scalar()
+        until = end if first is None else min(end, first - first % resolution)
+        connection.execute(Rollup_mark.__table__.insert(), {'resolution': resolution, 'until': until})
+    return until
+
+###
+### MAINTENANCE
+###
+
+_compacted = [0]
+
+#ANALYZE, AND VACUUM ONCE free_ratio OF THE DATABASE'S PAGES ARE UNUSED; RETURNS WHETHER IT VACUUMED
+def compact(engine, free_ratio=0.2):
+    connection = engine.connect()
+    try:
+        connection.execute('ANALYZE')
+        if engine.dialect.name != 'sqlite':
+            return False
+        free = connection.execute('PRAGMA freelist_count').scalar()
+        pages = connection.execute('PRAGMA page_count').scalar()
+        if pages and free >= free_ratio * pages:
+            connection.execute('VACUUM')
+            return True
+        return False
+    finally:
+        connection.close()
+
+def maintain(now=None):
+    now = int(now if now is not None else time.time())
+    config = app.config
+    ready = now - config.get('HISTORY_ROLLUP_LAG', 10)
+    result = {'rolled_up': 0, 'history_deleted': 0, 'rollups_deleted': 0, 'vacuumed': False}
+    with db.engine.begin() as connection:
+        marks = []
+        for name, resolution in sorted(RESOLUTIONS.items(), key=lambda r: r[1]):
+            end = ready - ready % resolution
+            until = _mark(connection, resolution, end)
+            if end > until:
+                result['rolled_up'] += roll_up(connection, resolution, until, end)
+                connection.execute(Rollup_mark.__table__.update().where(Rollup_mark.resolution == resolution)
+                    .values(until=end))
+                until = end
+            marks.append(until)
+        #raw rows go once every resolution has rolled them up
+        cutoff = min([now - config.get('HISTORY_RETENTION', 2 * 86400)] + marks)
+        result['history_deleted'] = connection.execute(State_history.__table__.delete()
+            .where(State_history.at < cutoff)).rowcount
+        for name, resolution in RESOLUTIONS.items():
+            keep = config.get('HISTORY_ROLLUP_RETENTION', {}).get(name)
+            if keep:
+                result['rollups_deleted'] += connection.execute(State_rollup.__table__.delete()
+                    .where(and_(State_rollup.resolution == resolution, State_rollup.bucket < now - keep))).rowcount
+    if now - _compacted[0] >= config.get('HISTORY_COMPACT_INTERVAL', 86400):
+        _compacted[0] = now
+        result['vacuumed'] = compact(db.engine, config.get('HISTORY_VACUUM_FREE_RATIO', 0.2))
+    return result
+
+def _maintain_forever(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                maintain()
+        except Exception:
+            app.logger.exception('State history maintenance failed.')
+
+###
+### RANGE QUERIES
+###
+
+#FINEST RESOLUTION WITH AT MOST max_buckets BUCKETS IN [start, end)
+def pick_resolution(start, end, max_buckets=1000):
+    for resolution in sorted(RESOLUTIONS.values()):
+        if (end - start) / resolution <= max_buckets:
+            return resolution
+    return RESOLUTIONS['day']
+
+#BUCKETS OF ONE BULB OR GROUP IN [start, end), AND ITS TOTAL SECONDS ON, QUIET BUCKETS INCLUDED
+def history_range(kind, entity_id, start, end, resolution):
+    start -= start % resolution
+    query = State_rollup.query.filter(State_rollup.resolution == resolution, State_rollup.kind == kind,
+        State_rollup.entity_id == entity_id)
+    buckets = query.filter(State_rollup.bucket >= start, State_rollup.bucket < end) \
+        .order_by(State_rollup.bucket).all()
+    before = query.filter(State_rollup.bucket < start).order_by(State_rollup.bucket.desc()).first()
+    until = db.session.query(Rollup_mark.until).filter(Rollup_mark.resolution == resolution).scalar() or start
+    power = before.power if before is not None else None
+    on_seconds, t = 0, start
+    for bucket in buckets:
+        if power:
+            on_seconds += bucket.bucket - t
+        on_seconds += bucket.on_seconds
+        t = bucket.bucket + resolution
+        power = bucket.power
+    if power:
+        on_seconds += max(0, min(end, until) - t)
+    return {
+        'kind': kind,
+        'id': entity_id,
+        'resolution': resolution,
+        'start': start,
+        'end': end,
+        'rolled_up_until': until,
+        'on_seconds': on_seconds,
+        'buckets': [b.serialize() for b in buckets]
+    }
+
+###
+### SETUP
+###
+
+_log = None
+_log_lock = threading.Lock()
+
+#None WHEN HISTORY_ENABLED IS OFF
+def history_log():
+    global _log
+    if not app.config.get('HISTORY_ENABLED', False):
+        return None
+    if _log is None:
+        with _log_lock:
+            if _log is None:
+                log = HistoryLog(write_history, batch_size=app.config.get('HISTORY_BATCH', 500),
+                    interval=app.config.get('HISTORY_FLUSH_INTERVAL', 1.0), context=app.app_context)
+                on_change(log.record)
+                interval = app.config.get('HISTORY_MAINTENANCE_INTERVAL', 60)
+                if interval:
+                    thread = threading.Thread(target=_maintain_forever, args=(interval,))
+                    thread.daemon = True
+                    thread.start()
+                _log = log
+    return _log
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain and query the state history.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('maintain')
+    query = commands.add_parser('range')
+    query.add_argument('kind', choices=['bulb', 'group'])
+    query.add_argument('id', type=int)
+    query.add_argument('--start', type=int, help='unix time (default: a day before --end)')
+    query.add_argument('--end', type=int, help='unix time (default: now)')
+    query.add_argument('--resolution', choices=sorted(RESOLUTIONS))
+    args = parser.parse_args()
+    with app.app_context():
+        if args.command == 'maintain':
+            print(json.dumps(maintain()))
+        else:
+            end = args.end or int(time.time())
+            start = args.start or end - 86400
+            resolution = RESOLUTIONS[args.resolution] if args.resolution else pick_resolution(start, end)
+            print(json.dumps(history_range(args.kind, args.id, start, end, resolution), indent=2))
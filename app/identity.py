@@ -0,0 +1,70 @@
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.session import make_transient_to_detached
+from app import app, db
+from .models import User
+from .cache import TTLCache
+
+######################################################################################
+##
+## CACHED USER IDENTITY
+##
+## flask_jwt's identity() and flask_login's user_loader run on every request.
+## Both go through cached_user(), which keeps each user's column values in a
+## TTL cache and rebuilds a session-bound User from them without a query.
+## Committed changes to a user (edit, update_user, delete_user, logout, ...)
+## drop that user from the cache.
+##
+######################################################################################
+
+USER_COLUMNS = [c.key for c in User.__mapper__.column_attrs]
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def user_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TTLCache(size=app.config.get('USER_CACHE_SIZE', 10000),
+                    ttl=app.config.get('USER_CACHE_TTL', 60))
+    return _cache
+
+def _load_user_columns(user_id):
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    return dict((key, getattr(user, key)) for key in USER_COLUMNS)
+
+#THE USER WITH THIS ID IN THE CURRENT SESSION, OR None
+def cached_user(user_id):
+    columns = user_cache().get(int(user_id), _load_user_columns)
+    if columns is None:
+        return None
+    user = User.__mapper__.class_manager.new_instance()
+    for key, value in columns.items():
+        setattr(user, key, value)
+    #persistent as if just loaded: later changes are flushed as usual
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def forget_user(user_id):
+    if _cache is not None:
+        _cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_flush')
+def _track_user_changes(session, context):
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            session.info.setdefault('forget_users', set()).add(obj.id)
+
+@event.listens_for(Session, 'after_commit')
+def _forget_after_commit(session):
+    for user_id in session.info.pop('forget_users', ()):
+        forget_user(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _keep_after_rollback(session):
+    session.info.pop('forget_users', None)
@@ -0,0 +1,72 @@
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+######################################################################################
+##
+## PER-REQUEST SQL INSTRUMENTATION
+##
+## Counts the statements a request runs, their total time and the slowest one,
+## on every engine (read and write). In debug and testing they are returned as
+## X-SQL-* response headers, so tests can hold routes to a query budget;
+## otherwise, with SQL_LOG_REQUESTS, each request logs one line.
+##
+######################################################################################
+
+class RequestQueries(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if seconds >= self.slowest:
+            self.slowest = seconds
+            self.slowest_statement = statement
+
+def _current():
+    if has_app_context():
+        return getattr(g, 'sql_queries', None)
+    return None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    queries = _current()
+    if queries is not None and started is not None:
+        queries.record(statement, time.time() - started)
+
+def _one_line(statement, limit=200):
+    return ' '.join((statement or '').split())[:limit]
+
+def init_instrumentation():
+
+    @app.before_request
+    def _start_request_queries():
+        g.sql_queries = RequestQueries()
+
+    @app.after_request
+    def _report_request_queries(response):
+        queries = _current()
+        if queries is None:
+            return response
+        if app.debug or app.testing:
+            response.headers['X-SQL-Count'] = str(queries.count)
+            response.headers['X-SQL-Time'] = '%.2f' % (1000 * queries.seconds)
+            response.headers['X-SQL-Slowest-Time'] = '%.2f' % (1000 * queries.slowest)
+            response.headers['X-SQL-Slowest'] = _one_line(queries.slowest_statement)
+        elif app.config.get('SQL_LOG_REQUESTS', False):
+            app.logger.info('%s %s %d sql=%d sql_ms=%.1f slowest_ms=%.1f slowest=%s', request.method, request.path,
+                response.status_code, queries.count, 1000 * queries.seconds, 1000 * queries.slowest,
+                _one_line(queries.slowest_statement))
+        return response
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import sys
+import time
+from datetime import datetime
+from app import app, db
+from .models import User, Location, Group, Bulb
+from .passwords import hash_inline
+
+######################################################################################
+##
+## BULK LOADER
+##
+## Streams users, locations, groups and bulbs from JSONL or CSV files (one
+## record per line, with a "type" field or column) into the database: rows are
+## batched into executemany INSERTs, committed in large transactions, and user
+## passwords are hashed by a process pool. Synthetic fleets of any shape can be
+## generated to a file or loaded directly.
+##
+##   python -m app.loader load fleet.jsonl more.csv
+##   python -m app.loader generate --users 10000 --locations 2 --groups 5 --bulbs 50 [--out fleet.jsonl]
+##
+## Records carry their own ids and reference each other by id.
+##
+######################################################################################
+
+#IN FOREIGN KEY ORDER, WITH THE COLUMNS A RECORD MAY SET AND THEIR DEFAULTS
+TYPES = [
+    ('user', User, {'id': None, 'nickname': None, 'email': None, 'password': None, 'confirmed': True,
+        'authenticated': False, 'last_location': None, 'version': 1}),
+    ('location', Location, {'id': None, 'name': None, 'owner_id': None, 'version': 1}),
+    ('group', Group, {'id': None, 'name': None, 'owner_id': None, 'location_id': None, 'power': False,
+        'brightness': 10, 'version': 1}),
+    ('bulb', Bulb, {'id': None, 'name': None, 'bulb_type': 'life', 'owner_id': None, 'friend_id': None,
+        'location_id': None, 'group_id': None, 'power': False, 'brightness': 10, 'version': 1}),
+]
+ORDER = [name for name, model, columns in TYPES]
+INTEGER_COLUMNS = set(['id', 'owner_id', 'friend_id', 'location_id', 'group_id', 'last_location', 'brightness', 'version'])
+BOOLEAN_COLUMNS = set(['confirmed', 'authenticated', 'power'])
+
+#RECORDS FROM A .jsonl/.ndjson OR .csv FILE
+def read_records(path):
+    with open(path) as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield _from_csv(row)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def _from_csv(row):
+    record = {}
+    for key, value in row.items():
+        if value is None or value == '':
+            continue
+        if key in INTEGER_COLUMNS:
+            value = int(value)
+        elif key in BOOLEAN_COLUMNS:
+            value = value.lower() in ('1', 'true', 'yes')
+        record[key] = value
+    return record
+
+
+class BulkLoader(object):
+
+    #progress(stats) is called every progress_every rows
+    def __init__(self, engine, batch_size=5000, transaction_rows=200000, workers=None, rounds=None,
+            progress=None, progress_every=100000):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.transaction_rows = transaction_rows
+        self.rounds = rounds or app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.pool = multiprocessing.Pool(workers) if workers != 0 else None
+        self.progress = progress
+        self.progress_every = progress_every
+        self.reported = 0
+        self.tables = dict((name, model.__table__) for name, model, columns in TYPES)
+        self.columns = dict((name, columns) for name, model, columns in TYPES)
+        self.buffers = dict((name, []) for name in ORDER)
+        self.counts = dict((name, 0) for name in ORDER)
+        self.connection = None
+        self.transaction = None
+        self.uncommitted = 0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        try:
+            if kind is None:
+                self.flush()
+                self.transaction.commit()
+            else:
+                self.transaction.rollback()
+        finally:
+            self.connection.close()
+            if self.pool is not None:
+                self.pool.close()
+
+    def add(self, record):
+        kind = record.get('type')
+        if kind not in self.buffers:
+            raise ValueError('Unknown record type %r' % kind)
+        columns = self.columns[kind]
+        self.buffers[kind].append(dict((key, record.get(key, default)) for key, default in columns.items()))
+        if len(self.buffers[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def load(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+    #WRITE kind'S BUFFER, AND FIRST THE BUFFERS OF THE TYPES IT REFERENCES
+    def flush(self, kind=ORDER[-1]):
+        for name in ORDER[:ORDER.index(kind) + 1]:
+            rows = self.buffers[name]
+            if not rows:
+                continue
+            self.buffers[name] = []
+            if name == 'user':
+                self._hash_passwords(rows)
+            self.connection.execute(self.tables[name].insert(), rows)
+            self.counts[name] += len(rows)
+            self.uncommitted += len(rows)
+        total = sum(self.counts.values())
+        if self.progress is not None and total - self.reported >= self.progress_every:
+            self.reported = total
+            self.progress(self.stats())
+        if self.uncommitted >= self.transaction_rows:
+            self.transaction.commit()
+            self.transaction = self.connection.begin()
+            self.uncommitted = 0
+
+    def _hash_passwords(self, rows):
+        now = datetime.now()
+        args = [(row['password'], self.rounds) for row in rows]
+        if self.pool is not None:
+            hashes = self.pool.map(_hash_args, args, chunksize=16)
+        else:
+            hashes = [_hash_args(a) for a in args]
+        for row, pw_hash in zip(rows, hashes):
+            row['password'] = pw_hash
+            row['registered_on'] = now
+            row['confirmed_on'] = now if row['confirmed'] else None
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        total = sum(self.counts.values())
+        return dict(self.counts, total=total, seconds=round(elapsed, 3),
+            rows_per_second=round(total / max(elapsed, 1e-9)))
+
+def _hash_args(args):
+    return hash_inline(*args)
+
+#A FLEET OF users, EACH WITH locations LOCATIONS OF groups GROUPS OF bulbs BULBS
+def synthetic_fleet(users, locations=1, groups=1, bulbs=10, password='secret', first_id=1):
+    location_id = group_id = bulb_id = first_id
+    for user_id in range(first_id, first_id + users):
+        yield {'type': 'user', 'id': user_id, 'nickname': 'user%d' % user_id,
+            'email': 'user%d@example.com' % user_id, 'password': password, 'last_location': location_id}
+        for l in range(locations):
+            yield {'type': 'location', 'id': location_id, 'name': 'Location %d' % l, 'owner_id': user_id}
+            for g in range(groups):
+                yield {'type': 'group', 'id': group_id, 'name': 'Group %d' % g, 'owner_id': user_id,
+                    'location_id': location_id}
+                for b in range(bulbs):
+                    yield {'type': 'bulb', 'id': bulb_id, 'name': 'Bulb %d' % b, 'owner_id': user_id,
+                        'location_id': location_id, 'group_id': group_id}
+                    bulb_id += 1
+                group_id += 1
+            location_id += 1
+
+def print_progress(stats):
+    print('%(total)d rows, %(rows_per_second)d rows/s' % stats)
+
+def run(records, args):
+    db.create_all()
+    with BulkLoader(db.engine, batch_size=args.batch, transaction_rows=args.transaction,
+            workers=args.workers, rounds=args.rounds, progress=print_progress) as loader:
+        loader.load(records)
+    if db.engine.dialect.name == 'sqlite':
+        db.engine.execute('ANALYZE')
+    stats = loader.stats()
+    for name in ORDER:
+        print('%-10s %10d' % (name + 's', stats[name]))
+    print('%(total)d rows in %(seconds).1fs, %(rows_per_second)d rows/s' % stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk load users, locations, groups and bulbs.')
+    parser.add_argument('--batch', type=int, default=5000, help='rows per executemany')
+    parser.add_argument('--transaction', type=int, default=200000, help='rows per commit')
+    parser.add_argument('--workers', type=int, default=None, help='password hashing processes (0: inline)')
+    parser.add_argument('--rounds', type=int, default=None, help='bcrypt cost (default BCRYPT_LOG_ROUNDS)')
+    commands = parser.add_subparsers(dest='command')
+    load = commands.add_parser('load')
+    load.add_argument('files', nargs='+')
+    generate = commands.add_parser('generate')
+    generate.add_argument('--users', type=int, default=100)
+    generate.add_argument('--locations', type=int, default=1)
+    generate.add_argument('--groups', type=int, default=2)
+    generate.add_argument('--bulbs', type=int, default=10)
+    generate.add_argument('--first-id', type=int, default=1)
+    generate.add_argument('--out', help='write JSONL here instead of loading')
+    args = parser.parse_args()
+    if args.command == 'load':
+        records = (record for path in args.files for record in read_records(path))
+    else:
+        records = synthetic_fleet(args.users, args.locations, args.groups, args.bulbs, first_id=args.first_id)
+        if args.out:
+            with open(args.out, 'w') as out:
+                for record in records:
+                    out.write(json.dumps(record) + '\n')
+            sys.exit(0)
+    with app.app_context():
+        run(records, args)
@@ -0,0 +1,60 @@
+from sqlalchemy import inspect
+from app import db
+
+######################################################################################
+##
+## SCHEMA UPGRADES FOR EXISTING DATABASES
+##
+## db.create_all() only creates missing tables. Columns added to existing tables
+## are listed here and added in place, and indexes declared on the models but
+## missing from the database are created. Safe to run repeatedly:
+##
+##   python -m app.migrate
+##
+######################################################################################
+
+#(table, column, column DDL)
+COLUMNS = [
+    ('bulb', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('group', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('location', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('user', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('scene', 'owner_id', 'INTEGER REFERENCES user (id)'),
+    ('scene', 'location_id', 'INTEGER REFERENCES location (id)'),
+    ('entry_scene', 'scene_id', 'INTEGER REFERENCES scene (id)'),
+    ('entry_scene', 'bulb_id', 'INTEGER REFERENCES bulb (id)'),
+    ('entry_scene', 'power', 'BOOLEAN DEFAULT 0'),
+]
+
+def add_missing_columns(engine):
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    for table, column, ddl in COLUMNS:
+        if table not in tables:
+            continue
+        if column not in [c['name'] for c in inspector.get_columns(table)]:
+            engine.execute('ALTER TABLE "%s" ADD COLUMN %s %s' % (table, column, ddl))
+
+def add_missing_indexes(engine):
+    inspector = inspect(engine)
+    created = False
+    tables = inspector.get_table_names()
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created = True
+    if created and engine.dialect.name == 'sqlite':
+        #planner statistics for the new indexes
+        engine.execute('ANALYZE')
+
+def upgrade():
+    db.create_all()
+    add_missing_columns(db.engine)
+    add_missing_indexes(db.engine)
+
+if __name__ == '__main__':
+    upgrade()
@@ -1,7 +1,8 @@
 import json
-from app import db, bcrypt
+from app import db
 from datetime import datetime
 from flask import jsonify
+from .passwords import hash_password
 
 class User(db.Model):
 
@@ -19,11 +20,13 @@ class User(db.Model):
     confirmed = db.Column(db.Boolean, default=False, nullable=False)
     confirmed_on = db.Column(db.DateTime, nullable=True)
     last_location = db.Column(db.Integer)
+    #bumped on every update (app/etags.py); not a compare-and-swap like Bulb.version
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __init__(self, email, nickname, password, confirmed, confirmed_on=None):
         self.email = email
         self.nickname = nickname
-        self.password = bcrypt.generate_password_hash(password)
+        self.password = hash_password(password)
         self.registered_on = datetime.now()
         self.confirmed = confirmed
         self.confirmed_on = confirmed_on
@@ -50,14 +53,8 @@ class User(db.Model):
         return '<User %r>' % (self.email)
 
     def serialize(self):
-        bulbs = self.bulbs
-        return {
-            'id': self.id,
-            'nickname': self.nickname,
-            'email': self.email,
-            'bulbs': [b.serialize() for b in self.bulbs if self.bulbs is not None],
-            'locations': [l.serialize() for l in self.locations if self.locations is not None]
-        }
+        from .serializers import serialize_user
+        return serialize_user(self)
 
 class Bulb(db.Model):
     __tablename__ = 'bulb'
@@ -72,6 +69,19 @@ class Bulb(db.Model):
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'))
     power = db.Column(db.Boolean, default=False)
     brightness = db.Column(db.Integer, default=10)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    #optimistic concurrency: ORM flushes only update the row version they loaded
+    __mapper_args__ = {'version_id_col': version}
+
+    #a user's bulbs per location (dashboard, bulb_selection); a location's bulbs per group
+    #(scenes, shared access); group power sync; bulbs lent to a friend
+    __table_args__ = (
+        db.Index('ix_bulb_owner_location', 'owner_id', 'location_id'),
+        db.Index('ix_bulb_location_group', 'location_id', 'group_id'),
+        db.Index('ix_bulb_group_power', 'group_id', 'power'),
+        db.Index('ix_bulb_friend', 'friend_id'),
+    )
 
     def __repr__(self):
         return '<Bulb %r>' % (self.name)
@@ -83,26 +93,8 @@ class Bulb(db.Model):
         self.item = value
 
     def serialize(self):
-        power_state = 'Off' if self.power == False else 'True'
-        location = Location.query.filter_by(id=self.location_id).first()
-        if location is None:
-            return {"error":"Bulb is created without a location. This shouldn't have happened."}
-        response =  {
-            'id': self.id,
-            'name': self.name,
-            'bulb_type': self.bulb_type,
-            'owner': {
-                'owner_id': self.owner_id,
-                'owner_nickname': User.query.get(self.owner_id).nickname
-                },
-            'location': {
-                'location_id': location.id,
-                'location_name': location.name
-                },
-            'power': power_state,
-            'brightness': self.brightness
-        }
-        return response
+        from .serializers import serialize_bulb
+        return serialize_bulb(self)
 
     def serialize_state(self): 
         power_state = 'Off' if self.power == False else 'On'
@@ -111,7 +103,8 @@ class Bulb(db.Model):
             'state': {
                 'state_bool': self.power,
                 'state_string': power_state
-            }
+            },
+            'version': self.version
         }
 
 
@@ -121,22 +114,20 @@ class Location(db.Model):
     id = db.Column(db.Integer, primary_key = True)
     name = db.Column(db.String(120), index=True)
     owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    bulbs = db.relationship('Bulb', backref='location', lazy='joined')
+    #bumped on every update (app/etags.py)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    #loaded on first access; queries that need them up front add joinedload(Location.bulbs)
+    bulbs = db.relationship('Bulb', backref='location', lazy='select')
     groups = db.relationship('Group', backref='location', lazy='dynamic')
 
+    __table_args__ = (db.Index('ix_location_owner', 'owner_id'),)
+
     def __repr__(self):
         return '<Location %r>' % (self.name)
 
     def serialize(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'owner': {
-                'owner_id': self.owner_id,
-                'owner_nickname': User.query.get(self.owner_id).nickname
-            },
-            'bulbs': [b.serialize() for b in self.bulbs if b is not None]
-        }
+        from .serializers import serialize_location
+        return serialize_location(self)
 
 class Group(db.Model):
     __tablename__ = 'group'
@@ -148,24 +139,21 @@ class Group(db.Model):
     bulbs = db.relationship('Bulb', backref='group', lazy='dynamic' )
     power = db.Column(db.Boolean, default=False)
     brightness = db.Column(db.Integer, default=10)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version}
+
+    __table_args__ = (
+        db.Index('ix_group_owner_location', 'owner_id', 'location_id'),
+        db.Index('ix_group_location', 'location_id'),
+    )
 
     def __repr__(self):
             return '<Group %r>' % (self.name)
 
     def serialize(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'owner': {
-                'owner_id': self.owner_id,
-                'owner_nickname': User.query.get(self.owner_id).nickname
-            },
-            'location': {
-                'location_id': self.location_id,
-                'location_name': Location.query.get(self.location_id).name
-            },
-            'bulbs' : [b.serialize() for b in self.bulbs if b is not None]
-        }
+        from .serializers import serialize_group
+        return serialize_group(self)
 
 
 class Scene(db.Model):
@@ -173,14 +161,20 @@ class Scene(db.Model):
 
     id = db.Column(db.Integer, primary_key = True)
     scene_name = db.Column(db.String(120), index= True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
+    entries = db.relationship('Entry_Scene', backref='scene', lazy='dynamic')
     
     def __repr__(self):
-        return '<Scene %r>' % (self.name)
+        return '<Scene %r>' % (self.scene_name)
 
     def serialize(self): 
         return {
                'id':self.id,
-               'scene_name':self.scene_name
+               'scene_name':self.scene_name,
+               'owner_id':self.owner_id,
+               'location_id':self.location_id,
+               'entries':[e.serialize() for e in self.entries]
         }   
 
 
@@ -188,19 +182,24 @@ class Entry_Scene(db.Model):
         __tablename__ = 'entry_scene'
 
         id = db.Column(db.Integer,primary_key = True)
+        scene_id = db.Column(db.Integer, db.ForeignKey('scene.id'), index=True)
+        bulb_id = db.Column(db.Integer, db.ForeignKey('bulb.id'))
+        power = db.Column(db.Boolean, default = False)
         brightness = db.Column(db.Integer, default = 10)
         color = db.Column(db.String(30),index=True)
         location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
 
         def __repr__(self):
-            return'<Entry_Scene %r>' %(self.name)
+            return'<Entry_Scene %r>' %(self.id)
 
         def serialize(self):
                 return {
                     'id' : self.id,
+                    'bulb_id' : self.bulb_id,
+                    'power' : self.power,
                     'brightness' : self.brightness,
                     'color' : self.color,
-                    'location' : self.location
+                    'location' : self.location_id
                 }
 
 
@@ -212,6 +211,12 @@ class Shared_control(db.Model):
     email = db.Column(db.String, db.ForeignKey('user.email'))
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
 
+    #grants of a user (access index) and of a location (change feed audience)
+    __table_args__ = (
+        db.Index('ix_owner_table_email_location', 'email', 'location_id'),
+        db.Index('ix_owner_table_location', 'location_id'),
+    )
+
     def __repr__(self):
         return '<Owner %r>' % (self.email)
 
@@ -221,3 +226,116 @@ class Shared_control(db.Model):
                 'email': self.email,
                 'location': self.location_id
                 }
+
+
+class Change(db.Model):
+
+    __tablename__ = 'change'
+
+    #the sequence is the feed cursor: it only ever grows
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    changed_on = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index('ix_change_user_seq', 'user_id', 'seq'), {'sqlite_autoincrement': True})
+
+    def __repr__(self):
+        return '<Change %r %r %r>' % (self.entity, self.entity_id, self.op)
+
+
+class Schedule(db.Model):
+
+    __tablename__ = 'schedule'
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    #'bulb', 'group' or 'scene'
+    action = db.Column(db.String(10), nullable=False)
+    target_id = db.Column(db.Integer, nullable=False)
+    power = db.Column(db.Boolean)
+    brightness = db.Column(db.Integer)
+    #unix time in whole seconds; actions due in the same second fire together
+    fire_at = db.Column(db.Integer, nullable=False, index=True)
+    repeat_seconds = db.Column(db.Integer)
+    enabled = db.Column(db.Boolean, default=True, nullable=False)
+
+    def __repr__(self):
+        return '<Schedule %r %r at %r>' % (self.action, self.target_id, self.fire_at)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'target_id': self.target_id,
+            'power': self.power,
+            'brightness': self.brightness,
+            'fire_at': self.fire_at,
+            'repeat_seconds': self.repeat_seconds,
+            'enabled': self.enabled
+        }
+
+
+class State_history(db.Model):
+
+    __tablename__ = 'state_history'
+
+    #append-only; rows are only ever deleted by retention (app/history.py)
+    seq = db.Column(db.Integer, primary_key=True)
+    #unix time in whole seconds
+    at = db.Column(db.Integer, nullable=False)
+    #'bulb' or 'group'
+    kind = db.Column(db.String(5), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    power = db.Column(db.Boolean)
+    brightness = db.Column(db.SmallInteger)
+
+    __table_args__ = (db.Index('ix_state_history_at', 'at'),
+        db.Index('ix_state_history_entity', 'kind', 'entity_id', 'at'))
+
+    def __repr__(self):
+        return '<State_history %r %r at %r>' % (self.kind, self.entity_id, self.at)
+
+
+class State_rollup(db.Model):
+
+    __tablename__ = 'state_rollup'
+
+    #seconds per bucket: 60, 3600 or 86400
+    resolution = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(5), primary_key=True)
+    entity_id = db.Column(db.Integer, primary_key=True)
+    #unix time the bucket starts at, a multiple of resolution
+    bucket = db.Column(db.Integer, primary_key=True)
+    changes = db.Column(db.Integer, nullable=False)
+    on_seconds = db.Column(db.Integer, nullable=False)
+    #state at the end of the bucket
+    power = db.Column(db.Boolean)
+    brightness = db.Column(db.SmallInteger)
+    brightness_min = db.Column(db.SmallInteger)
+    brightness_max = db.Column(db.SmallInteger)
+
+    def __repr__(self):
+        return '<State_rollup %r %r %r at %r>' % (self.resolution, self.kind, self.entity_id, self.bucket)
+
+    def serialize(self):
+        return {
+            'bucket': self.bucket,
+            'changes': self.changes,
+            'on_seconds': self.on_seconds,
+            'power': self.power,
+            'brightness': self.brightness,
+            'brightness_min': self.brightness_min,
+            'brightness_max': self.brightness_max
+        }
+
+
+class Rollup_mark(db.Model):
+
+    __tablename__ = 'rollup_mark'
+
+    resolution = db.Column(db.Integer, primary_key=True)
+    #history before this unix time is rolled up at this resolution
+    until = db.Column(db.Integer, nullable=False)
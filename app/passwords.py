@@ -0,0 +1,124 @@
+import multiprocessing
+import threading
+import bcrypt
+from app import app
+
+######################################################################################
+##
+## PASSWORD HASHING
+##
+## bcrypt is slow on purpose, so hashing and checking run in a process pool of
+## PASSWORD_WORKERS processes instead of on the request worker (0 runs them
+## inline). At most PASSWORD_MAX_CONCURRENT requests may wait on the pool at
+## once; beyond that PasswordBusy is raised straight away and the request gets a
+## 503, as it does when the pool takes longer than PASSWORD_TIMEOUT. A request
+## that gives up keeps its slot until the pool has finished its task, so slow
+## pools never queue more than PASSWORD_MAX_CONCURRENT tasks. Hashes made with
+## a cost other than BCRYPT_LOG_ROUNDS are replaced after the next successful
+## check.
+##
+######################################################################################
+
+class PasswordBusy(Exception):
+    pass
+
+def _text(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+def _bytes(value):
+    return value.encode('utf-8') if not isinstance(value, bytes) else value
+
+#HASH ON THE CALLING THREAD, FOR CALLERS WITH THEIR OWN PROCESSES (RUNS IN THE POOL'S TOO)
+def hash_inline(password, rounds):
+    return _text(bcrypt.hashpw(_bytes(password), bcrypt.gensalt(rounds)))
+
+#RUN IN THE POOL PROCESSES
+#(ok, result or exception), so the completion callback runs either way
+def _guarded(fn, args):
+    try:
+        return True, fn(*args)
+    except Exception as e:
+        return False, e
+
+def _check(pw_hash, password):
+    try:
+        return bcrypt.checkpw(_bytes(password), _bytes(pw_hash))
+    except ValueError:
+        #not a bcrypt hash
+        return False
+
+_pool = None
+_slots = None
+_lock = threading.Lock()
+counters = dict.fromkeys(['hashed', 'checked', 'rehashed', 'rejected', 'timed_out'], 0)
+
+def _count(counter):
+    with _lock:
+        counters[counter] += 1
+
+def _setup():
+    global _pool, _slots
+    with _lock:
+        if _slots is None:
+            workers = app.config.get('PASSWORD_WORKERS', multiprocessing.cpu_count())
+            if workers:
+                _pool = multiprocessing.Pool(processes=workers)
+            _slots = threading.BoundedSemaphore(app.config.get('PASSWORD_MAX_CONCURRENT', 4 * max(workers, 1)))
+
+def _run(fn, *args):
+    if _slots is None:
+        _setup()
+    slots = _slots
+    if not slots.acquire(False):
+        _count('rejected')
+        raise PasswordBusy()
+    if _pool is None:
+        try:
+            return fn(*args)
+        finally:
+            slots.release()
+    try:
+        #the slot is given back when the task is done, not when this request stops waiting
+        result = _pool.apply_async(_guarded, (fn, args), callback=lambda outcome: slots.release())
+    except Exception:
+        slots.release()
+        raise
+    try:
+        ok, value = result.get(app.config.get('PASSWORD_TIMEOUT', 10))
+    except multiprocessing.TimeoutError:
+        _count('timed_out')
+        raise PasswordBusy()
+    if not ok:
+        raise value
+    return value
+
+def rounds():
+    return app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
+def hash_password(password):
+    _count('hashed')
+    return _run(hash_inline, password, rounds())
+
+def check_password(pw_hash, password):
+    _count('checked')
+    return _run(_check, _text(pw_hash), password)
+
+#COST OF A $2b$12$... HASH
+def hash_rounds(pw_hash):
+    try:
+        return int(_text(pw_hash).split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+#CHECK user's PASSWORD, REPLACING ITS HASH IF THE COST CHANGED; THE CALLER COMMITS
+def verify_user(user, password):
+    if not check_password(user.password, password):
+        return False
+    if hash_rounds(user.password) != rounds():
+        user.password = hash_password(password)
+        _count('rehashed')
+    return True
+
+def stats():
+    with _lock:
+        return dict(counters, workers=_pool._processes if _pool is not None else 0)
@@ -0,0 +1,55 @@
+import time
+from sqlalchemy import and_, bindparam, literal, or_, select
+from app import db
+from .models import Bulb, Scene, Entry_Scene
+from .state import apply_bulb_rows, release_hot_state
+
+######################################################################################
+##
+## SCENES
+##
+## A scene is a stored power/brightness preset for the bulbs of one location.
+## Capturing copies the current states with one INSERT ... SELECT; applying
+## diffs the presets against the bulbs in SQL and writes only the bulbs that
+## differ, with one batched UPDATE.
+##
+######################################################################################
+
+#CAPTURE A LOCATION'S CURRENT BULB STATES; presets [{bulb_id, power, brightness}] OVERRIDE THEM
+def capture_scene(owner_id, location_id, name, presets=None):
+    release_hot_state(Bulb.location_id == location_id)
+    scene = Scene(scene_name=name, owner_id=owner_id, location_id=location_id)
+    db.session.add(scene)
+    db.session.flush()
+    entries = Entry_Scene.__table__
+    source = select([literal(scene.id), Bulb.id, Bulb.location_id, Bulb.power, Bulb.brightness]) \
+        .where(and_(Bulb.location_id == location_id, Bulb.owner_id == owner_id))
+    db.session.execute(entries.insert().from_select(['scene_id', 'bulb_id', 'location_id', 'power', 'brightness'], source))
+    for key in ('power', 'brightness'):
+        rows = [{'e_bulb': p['bulb_id'], 'e_value': p[key]} for p in presets or [] if p.get(key) is not None]
+        if rows:
+            statement = entries.update() \
+                .where(and_(entries.c.scene_id == scene.id, entries.c.bulb_id == bindparam('e_bulb'))) \
+                .values({key: bindparam('e_value')})
+            db.session.execute(statement, rows)
+    db.session.commit()
+    return scene
+
+#WRITE THE SCENE'S PRESETS TO THE BULBS THAT DIFFER FROM THEM; RETURNS (CHANGED BULB IDS, SECONDS)
+#bulbs that have since left the location or changed hands are skipped, as capture would skip them
+def apply_scene(scene, commit=True):
+    started = time.time()
+    release_hot_state(Bulb.location_id == scene.location_id)
+    differing = db.session.query(Entry_Scene.bulb_id, Entry_Scene.power, Entry_Scene.brightness) \
+        .join(Bulb, and_(Bulb.id == Entry_Scene.bulb_id, Bulb.location_id == scene.location_id,
+            Bulb.owner_id == scene.owner_id)) \
+        .filter(Entry_Scene.scene_id == scene.id,
+            or_(Bulb.power != Entry_Scene.power, Bulb.brightness != Entry_Scene.brightness)).all()
+    rows = [{'id': id, 'power': power, 'brightness': brightness} for id, power, brightness in differing]
+    apply_bulb_rows(rows, commit=commit)
+    return [row['id'] for row in rows], time.time() - started
+
+def remove_scene(scene):
+    Entry_Scene.query.filter_by(scene_id=scene.id).delete(synchronize_session=False)
+    db.session.delete(scene)
+    db.session.commit()
@@ -0,0 +1,175 @@
+import heapq
+import threading
+import time
+from app import app, db
+from .models import Group, Scene, Schedule
+from .scenes import apply_scene
+from .state import bulb_selection, chunks, set_bulbs_state, set_groups_state
+
+######################################################################################
+##
+## SCHEDULED ACTIONS
+##
+## Timed bulb/group/scene actions live in the schedule table. The scheduler keeps
+## (fire_at, id) pairs in a heap and sleeps until the earliest one is due (or a
+## new earlier one is added). Everything due in that second is fired as one
+## batch: actions with the same target kind and values become one set-based
+## write, all in one transaction.
+##
+## Run it in the web process (SCHEDULER_ENABLED) when there is one process, or
+## on its own with:
+##
+##   python -m app.scheduler
+##
+######################################################################################
+
+class Scheduler(object):
+
+    #load(after_id) -> [(fire_at, id), ...] of enabled schedules with larger ids
+    #fire(ids, now) fires the batch and returns [(fire_at, id), ...] to run again
+    #a batch that fails is retried after retry_delay seconds, doubling up to max_retry_delay
+    def __init__(self, load, fire, reload_interval=30, clock=time.time, retry_delay=5, max_retry_delay=300):
+        self.load = load
+        self.fire = fire
+        self.reload_interval = reload_interval
+        self.clock = clock
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.condition = threading.Condition()
+        self.heap = []
+        self.last_id = 0
+        self.batches = 0
+        self.fired = 0
+        self.failed = 0
+        self.attempts = {}
+
+    def add(self, fire_at, schedule_id):
+        with self.condition:
+            heapq.heappush(self.heap, (fire_at, schedule_id))
+            self.last_id = max(self.last_id, schedule_id)
+            if self.heap[0] == (fire_at, schedule_id):
+                self.condition.notify()
+
+    #POP THE IDS OF EVERYTHING DUE AT now
+    def due(self, now):
+        with self.condition:
+            ids = set()
+            while self.heap and self.heap[0][0] <= now:
+                ids.add(heapq.heappop(self.heap)[1])
+            return sorted(ids)
+
+    def run_once(self, now):
+        ids = self.due(now)
+        if ids:
+            try:
+                again = self.fire(ids, now)
+            except Exception:
+                app.logger.exception('Scheduled batch failed, retrying.')
+                self.retry(ids, now)
+                return 0
+            for id in ids:
+                self.attempts.pop(id, None)
+            for entry in again:
+                self.add(*entry)
+            self.batches += 1
+            self.fired += len(ids)
+        return len(ids)
+
+    #PUT A FAILED BATCH BACK, EACH ID LATER THE MORE TIMES IT HAS FAILED
+    def retry(self, ids, now):
+        self.failed += 1
+        for id in ids:
+            attempts = self.attempts[id] = self.attempts.get(id, 0) + 1
+            self.add(now + min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay), id)
+
+    def run(self):
+        next_reload = 0
+        while True:
+            now = self.clock()
+            if now >= next_reload:
+                #picks up schedules created by other processes
+                for entry in self.load(self.last_id):
+                    self.add(*entry)
+                next_reload = now + self.reload_interval
+            with self.condition:
+                wake = next_reload
+                if self.heap:
+                    wake = min(wake, self.heap[0][0])
+                if wake > now:
+                    self.condition.wait(wake - now)
+                    continue
+            self.run_once(int(now))
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='scheduler')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        with self.condition:
+            return {'waiting': len(self.heap), 'batches': self.batches, 'fired': self.fired, 'failed': self.failed,
+                'next': self.heap[0][0] if self.heap else None}
+
+
+def load_schedules(after_id):
+    with app.app_context():
+        return db.session.query(Schedule.fire_at, Schedule.id) \
+            .filter(Schedule.enabled == True, Schedule.id > after_id).all()
+
+#FIRE ONE SECOND'S WORTH OF SCHEDULES IN ONE TRANSACTION
+def fire_schedules(ids, now):
+    schedules = []
+    for chunk in chunks(ids):
+        #heap entries for disabled or moved schedules are stale and skipped here
+        schedules.extend(Schedule.query.filter(Schedule.id.in_(chunk), Schedule.enabled == True,
+            Schedule.fire_at <= now))
+    batches = {}
+    for s in schedules:
+        batches.setdefault((s.action, s.owner_id, s.power, s.brightness), []).append(s.target_id)
+    for (action, owner_id, power, brightness), targets in batches.items():
+        for chunk in chunks(targets):
+            if action == 'bulb':
+                set_bulbs_state(bulb_selection(owner_id, bulb_ids=chunk), power=power, brightness=brightness,
+                    commit=False, states=False)
+            elif action == 'group':
+                owned = [id for (id,) in db.session.query(Group.id).filter(Group.id.in_(chunk), Group.owner_id == owner_id)]
+                if owned:
+                    set_groups_state(owned, power=power, brightness=brightness, commit=False)
+            elif action == 'scene':
+                for scene in Scene.query.filter(Scene.id.in_(chunk), Scene.owner_id == owner_id):
+                    apply_scene(scene, commit=False)
+    again = []
+    for s in schedules:
+        if s.repeat_seconds:
+            #skip runs missed while nothing was running
+            s.fire_at += s.repeat_seconds * (1 + (now - s.fire_at) // s.repeat_seconds)
+            again.append((s.fire_at, s.id))
+        else:
+            s.enabled = False
+    db.session.commit()
+    return again
+
+def fire_in_context(ids, now):
+    with app.app_context():
+        return fire_schedules(ids, now)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def make_scheduler():
+    return Scheduler(load_schedules, fire_in_context, reload_interval=app.config.get('SCHEDULER_RELOAD', 30))
+
+def scheduler():
+    global _scheduler
+    if not app.config.get('SCHEDULER_ENABLED', False):
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = make_scheduler()
+                _scheduler.start()
+    return _scheduler
+
+if __name__ == '__main__':
+    make_scheduler().run()
@@ -0,0 +1,217 @@
+from sqlalchemy import inspect
+from .models import User, Location, Bulb, Group
+
+######################################################################################
+##
+## BATCHED SERIALIZATION
+##
+## Renders the same JSON shapes as the model serialize() methods, but preloads the
+## owners and locations of a whole collection with one IN query each instead of
+## two lookups per bulb.
+##
+## Clients can trim the shapes with a fields spec ("id,name,bulbs.id,bulbs.power")
+## and page embedded collections by id; whatever is not asked for is neither
+## loaded nor rendered.
+##
+######################################################################################
+
+#"id,name,bulbs.power" -> {'id': None, 'name': None, 'bulbs': {'power': None}}; None KEEPS EVERYTHING
+def parse_fields(spec):
+    if not spec:
+        return None
+    fields = {}
+    for path in spec.split(','):
+        node = fields
+        keys = [k for k in path.strip().split('.') if k]
+        for i, key in enumerate(keys):
+            if i == len(keys) - 1:
+                node.setdefault(key, None)
+            else:
+                if node.get(key) is None:
+                    node[key] = {}
+                node = node[key]
+    return fields or None
+
+def wants(fields, key):
+    return fields is None or key in fields
+
+def subfields(fields, key):
+    return None if fields is None else fields.get(key)
+
+#KEEP THE ASKED-FOR KEYS, AND PAGING CURSORS ALWAYS
+def project(item, fields):
+    if fields is None:
+        return item
+    return dict((key, value) for key, value in item.items() if key in fields or key.endswith('_next_after_id'))
+
+#ONE PAGE OF query BY ASCENDING id AFTER after_id: (ITEMS, NEXT after_id OR None)
+def page(query, model, after_id=None, limit=None):
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+    query = query.order_by(model.id)
+    if limit is None:
+        return query.all(), None
+    items = query.limit(limit + 1).all()
+    if len(items) > limit:
+        return items[:limit], items[limit - 1].id
+    return items, None
+
+#LOAD ROWS BY ID, SKIPPING ONES WE ALREADY HAVE
+def _preload(model, ids, known=None):
+    found = dict(known or {})
+    missing = set(i for i in ids if i is not None and i not in found)
+    if missing:
+        for obj in model.query.filter(model.id.in_(missing)):
+            found[obj.id] = obj
+    return found
+
+def _owner(owner_id, users):
+    owner = users.get(owner_id)
+    return {
+        'owner_id': owner_id,
+        'owner_nickname': owner.nickname if owner is not None else None
+    }
+
+def _bulb(bulb, users, locations, fields=None):
+    if wants(fields, 'location'):
+        location = locations.get(bulb.location_id)
+        if location is None:
+            return {"error":"Bulb is created without a location. This shouldn't have happened."}
+    item = {
+        'id': bulb.id,
+        'name': bulb.name,
+        'bulb_type': bulb.bulb_type,
+        'power': 'Off' if bulb.power == False else 'True',
+        'brightness': bulb.brightness,
+        'version': bulb.version
+    }
+    if wants(fields, 'owner'):
+        item['owner'] = _owner(bulb.owner_id, users)
+    if wants(fields, 'location'):
+        item['location'] = {
+            'location_id': location.id,
+            'location_name': location.name
+            }
+    return project(item, fields)
+
+#BULBS
+def serialize_bulbs(bulbs, users=None, locations=None, fields=None):
+    bulbs = [b for b in bulbs if b is not None]
+    if wants(fields, 'owner'):
+        users = _preload(User, [b.owner_id for b in bulbs], users)
+    if wants(fields, 'location'):
+        locations = _preload(Location, [b.location_id for b in bulbs], locations)
+    return [_bulb(b, users, locations, fields) for b in bulbs]
+
+def serialize_bulb(bulb, fields=None):
+    return serialize_bulbs([bulb], fields=fields)[0]
+
+#LOCATIONS; WITH A limit, EACH LOCATION'S BULBS ARE PAGED AFTER bulbs_after_id
+def serialize_locations(locations, users=None, fields=None, bulbs_after_id=None, limit=None):
+    locations = [l for l in locations if l is not None]
+    bulb_fields = subfields(fields, 'bulbs')
+    members, cursors = {}, {}
+    if wants(fields, 'bulbs'):
+        unloaded = []
+        for l in locations:
+            if limit is not None or bulbs_after_id is not None:
+                members[l.id], cursors[l.id] = page(Bulb.query.filter(Bulb.location_id == l.id), Bulb,
+                    bulbs_after_id, limit)
+            elif 'bulbs' in inspect(l).unloaded:
+                unloaded.append(l.id)
+                members[l.id] = []
+            else:
+                members[l.id] = list(l.bulbs)
+        #one IN query for every location whose bulbs were not eagerly loaded
+        if unloaded:
+            for b in Bulb.query.filter(Bulb.location_id.in_(unloaded)).order_by(Bulb.id):
+                members[b.location_id].append(b)
+    bulbs = [b for l in locations for b in members.get(l.id, [])]
+    if wants(fields, 'owner') or wants(bulb_fields, 'owner'):
+        users = _preload(User, [l.owner_id for l in locations] + [b.owner_id for b in bulbs], users)
+    known = dict((l.id, l) for l in locations)
+    rendered = iter(serialize_bulbs(bulbs, users, known, bulb_fields))
+    response = []
+    for l in locations:
+        item = {
+            'id': l.id,
+            'name': l.name,
+            'owner': _owner(l.owner_id, users) if wants(fields, 'owner') else None,
+            'bulbs': [next(rendered) for b in members.get(l.id, [])]
+        }
+        if l.id in cursors:
+            item['bulbs_next_after_id'] = cursors[l.id]
+        response.append(project(item, fields))
+    return response
+
+def serialize_location(location, fields=None, bulbs_after_id=None, limit=None):
+    return serialize_locations([location], fields=fields, bulbs_after_id=bulbs_after_id, limit=limit)[0]
+
+#GROUPS
+def serialize_groups(groups, users=None, locations=None, fields=None):
+    groups = [g for g in groups if g is not None]
+    bulb_fields = subfields(fields, 'bulbs')
+    members = {}
+    if groups and wants(fields, 'bulbs'):
+        for b in Bulb.query.filter(Bulb.group_id.in_([g.id for g in groups])).order_by(Bulb.id):
+            members.setdefault(b.group_id, []).append(b)
+    bulbs = [b for g in groups for b in members.get(g.id, [])]
+    if wants(fields, 'owner') or wants(bulb_fields, 'owner'):
+        users = _preload(User, [g.owner_id for g in groups] + [b.owner_id for b in bulbs], users)
+    if wants(fields, 'location') or wants(bulb_fields, 'location'):
+        locations = _preload(Location, [g.location_id for g in groups] + [b.location_id for b in bulbs], locations)
+    response = []
+    for g in groups:
+        item = {
+            'id': g.id,
+            'name': g.name,
+            'bulbs': [_bulb(b, users, locations, bulb_fields) for b in members.get(g.id, [])],
+            'version': g.version
+        }
+        if wants(fields, 'owner'):
+            item['owner'] = _owner(g.owner_id, users)
+        if wants(fields, 'location'):
+            location = locations.get(g.location_id)
+            item['location'] = {
+                'location_id': g.location_id,
+                'location_name': location.name if location is not None else None
+            }
+        response.append(project(item, fields))
+    return response
+
+def serialize_group(group, fields=None):
+    return serialize_groups([group], fields=fields)[0]
+
+#USERS; WITH A limit, BULBS AND LOCATIONS ARE PAGED AFTER bulbs_after_id / locations_after_id
+def serialize_user(user, fields=None, bulbs_after_id=None, locations_after_id=None, limit=None):
+    users = {user.id: user}
+    item = {
+        'id': user.id,
+        'nickname': user.nickname,
+        'email': user.email
+    }
+    locations = []
+    if wants(fields, 'locations'):
+        locations, cursor = page(user.locations, Location, locations_after_id, limit)
+        if limit is not None:
+            item['locations_next_after_id'] = cursor
+    known = dict((l.id, l) for l in locations)
+    if wants(fields, 'bulbs'):
+        bulbs, cursor = page(user.bulbs, Bulb, bulbs_after_id, limit)
+        item['bulbs'] = serialize_bulbs(bulbs, users, known, subfields(fields, 'bulbs'))
+        if limit is not None:
+            item['bulbs_next_after_id'] = cursor
+    if wants(fields, 'locations'):
+        item['locations'] = serialize_locations(locations, users, subfields(fields, 'locations'))
+    return project(item, fields)
+
+#COMPACT STATES FROM (id, name, power, version) ROWS, SAME SHAPE AS Bulb.serialize_state()
+def serialize_states(rows):
+    return [{'id': id,
+        'name': name,
+        'state': {
+            'state_bool': power,
+            'state_string': 'Off' if power == False else 'On'
+        },
+        'version': version
+    } for id, name, power, version in rows]
@@ -0,0 +1,85 @@
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+
+######################################################################################
+##
+## SIMULATED BULB FLEET
+##
+## Stands in for the physical bulbs so dispatch can be exercised and benchmarked
+## without hardware. Any number of bulbs share a few UDP sockets: each command
+## datagram is applied to the addressed bulb (ignoring versions older than the
+## one it has) and acked with its id and version.
+##
+##   python -m app.simulator --port 9999 --ports 4 --loss 0.01
+##
+######################################################################################
+
+class SimulatedFleet(object):
+
+    def __init__(self, host='127.0.0.1', port=9999, ports=1, loss=0.0, latency=0.0):
+        self.loss = loss
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.bulbs = {}
+        self.latencies = []
+        self.received = 0
+        self.sockets = []
+        for offset in range(ports):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((host, port + offset))
+            self.sockets.append(sock)
+
+    def start(self):
+        for sock in self.sockets:
+            thread = threading.Thread(target=self._serve, args=(sock,), name='bulb-fleet')
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def _serve(self, sock):
+        while True:
+            data, sender = sock.recvfrom(4096)
+            if self.loss and random.random() < self.loss:
+                continue
+            if self.latency:
+                time.sleep(self.latency)
+            command = json.loads(data.decode('utf-8'))
+            with self.lock:
+                self.received += 1
+                current = self.bulbs.get(command['id'])
+                if current is None or current['version'] <= command['version']:
+                    self.bulbs[command['id']] = command
+                if 'sent_at' in command:
+                    self.latencies.append(time.time() - command['sent_at'])
+            sock.sendto(json.dumps({'id': command['id'], 'version': command['version']}).encode('utf-8'), sender)
+
+    def state(self, bulb_id):
+        with self.lock:
+            return self.bulbs.get(bulb_id)
+
+    def wait_for(self, count, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.bulbs) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a simulated bulb fleet.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--ports', type=int, default=1)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    fleet = SimulatedFleet(args.host, args.port, args.ports, args.loss, args.latency).start()
+    while True:
+        time.sleep(5)
+        with fleet.lock:
+            print('%d commands received, %d bulbs' % (fleet.received, len(fleet.bulbs)))
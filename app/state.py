@@ -0,0 +1,311 @@
+import threading
+from sqlalchemy import and_, bindparam, event, exists, not_, select
+from sqlalchemy.orm import Session
+from app import app, db
+from .models import Bulb, Group
+from .serializers import serialize_states
+from .statestore import DeviceStateStore
+from .debounce import BrightnessDebouncer
+
+######################################################################################
+##
+## SET-BASED STATE CHANGES
+##
+## Power/brightness writes for many bulbs at once. Each change is one UPDATE
+## over a criterion instead of loading and saving bulbs one by one.
+##
+######################################################################################
+
+#CRITERION FOR BULBS SELECTED BY ID LIST, LOCATION OR GROUP, SCOPED TO THE OWNER
+#(owner_id=None WHEN ACCESS WAS ALREADY CHECKED AGAINST THE ACL INDEX)
+def bulb_selection(owner_id, bulb_ids=None, location_id=None, group_id=None):
+    clauses = [Bulb.owner_id == owner_id] if owner_id is not None else []
+    if bulb_ids is not None:
+        clauses.append(Bulb.id.in_(bulb_ids))
+    if location_id is not None:
+        clauses.append(Bulb.location_id == location_id)
+    if group_id is not None:
+        clauses.append(Bulb.group_id == group_id)
+    return and_(*clauses)
+
+#A GROUP TAKES ON A POWER STATE ONCE NONE OF ITS BULBS DIFFER FROM IT
+#(ONE UPDATE WITH A NOT EXISTS AGGREGATE, INSTEAD OF SCANNING THE GROUP IN PYTHON)
+def sync_group_power(criterion, power):
+    groups = db.session.query(Bulb.group_id).filter(criterion)
+    differing = exists().where(and_(Bulb.group_id == Group.id, Bulb.power != power))
+    Group.query.filter(Group.id.in_(groups), Group.power != power, ~differing) \
+        .update({Group.power: power, Group.version: Group.version + 1}, synchronize_session=False)
+    changed(Group, Group.id.in_(select([Bulb.group_id]).where(criterion)))
+
+#APPLY POWER AND/OR BRIGHTNESS TO EVERY BULB MATCHING THE CRITERION
+#with a version, only a bulb still at that version is changed (compare-and-swap);
+#None is returned and nothing is written when it has moved on.
+def set_bulbs_state(criterion, power=None, brightness=None, commit=True, states=True, version=None):
+    values = {Bulb.version: Bulb.version + 1}
+    if power is not None:
+        values[Bulb.power] = bool(power)
+    if brightness is not None:
+        values[Bulb.brightness] = brightness
+    if len(values) > 1:
+        release_hot_state(criterion)
+        target = criterion if version is None else and_(criterion, Bulb.version == version)
+        matched = Bulb.query.filter(target).update(values, synchronize_session=False)
+        if version is not None and not matched:
+            db.session.rollback()
+            return None
+        changed(Bulb, criterion)
+    if power is not None:
+        sync_group_power(criterion, bool(power))
+    rows = None
+    if states:
+        rows = db.session.query(Bulb.id, Bulb.name, Bulb.power, Bulb.version) \
+            .filter(criterion).order_by(Bulb.id).all()
+    if commit:
+        db.session.commit()
+    return serialize_states(rows) if states else None
+
+#APPLY POWER AND/OR BRIGHTNESS TO A GROUP AND ALL OF ITS BULBS
+def set_group_state(group_id, power=None, brightness=None, commit=True, states=False):
+    return set_groups_state([group_id], power=power, brightness=brightness, commit=commit, states=states)
+
+#THE SAME FOR MANY GROUPS AT ONCE: ONE UPDATE FOR THE GROUPS, ONE FOR THEIR BULBS
+def set_groups_state(group_ids, power=None, brightness=None, commit=True, states=False):
+    release_hot_state(Bulb.group_id.in_(group_ids))
+    values = {Group.version: Group.version + 1}
+    if power is not None:
+        values[Group.power] = bool(power)
+    if brightness is not None:
+        values[Group.brightness] = brightness
+    if len(values) > 1:
+        Group.query.filter(Group.id.in_(group_ids)).update(values, synchronize_session=False)
+        changed(Group, Group.id.in_(group_ids))
+    return set_bulbs_state(Bulb.group_id.in_(group_ids), power=power, brightness=brightness,
+        commit=commit, states=states)
+
+#TOGGLES FLIP POWER INSIDE THE DATABASE (SET power = NOT power) SO CONCURRENT TOGGLES NEVER
+#LOSE A WRITE. THE UPDATE TAKES SQLITE'S WRITE LOCK UNTIL COMMIT, SO READING THE NEW STATE
+#BACK IN THE SAME TRANSACTION IS AS ATOMIC AS UPDATE ... RETURNING.
+def toggle_bulb(bulb_id, commit=True):
+    criterion = Bulb.id == bulb_id
+    release_hot_state(criterion)
+    Bulb.query.filter(criterion).update({Bulb.power: not_(Bulb.power), Bulb.version: Bulb.version + 1},
+        synchronize_session=False)
+    changed(Bulb, criterion)
+    power = db.session.query(Bulb.power).filter(criterion).scalar()
+    if power is not None:
+        sync_group_power(criterion, power)
+    if commit:
+        db.session.commit()
+    return power
+
+def toggle_group(group_id, commit=True):
+    release_hot_state(Bulb.group_id == group_id)
+    Group.query.filter_by(id=group_id).update({Group.power: not_(Group.power), Group.version: Group.version + 1},
+        synchronize_session=False)
+    changed(Group, Group.id == group_id)
+    power = db.session.query(Group.power).filter_by(id=group_id).scalar()
+    if power is not None:
+        set_bulbs_state(Bulb.group_id == group_id, power=power, commit=False, states=False)
+    if commit:
+        db.session.commit()
+    return power
+
+#PER-BULB VALUES (DICTS WITH id, power, brightness AND OPTIONALLY version) IN ONE BATCHED UPDATE
+#untracked writes (the hot store's flushes) still go to the change feed, but their listeners
+#are told by flush_hot_rows
+def apply_bulb_rows(rows, commit=True, tracked=True):
+    if rows:
+        table = Bulb.__table__
+        keys = ['id', 'power', 'brightness']
+        values = {'power': bindparam('b_power'), 'brightness': bindparam('b_brightness')}
+        if 'version' in rows[0]:
+            keys.append('version')
+            values['version'] = bindparam('b_version')
+        else:
+            values['version'] = table.c.version + 1
+        statement = table.update().where(table.c.id == bindparam('b_id')).values(**values)
+        ids = [row['id'] for row in rows]
+        if tracked:
+            for chunk in chunks(ids):
+                release_hot_state(Bulb.id.in_(chunk))
+        db.session.execute(statement, [dict(('b_' + k, row[k]) for k in keys) for row in rows])
+        for chunk in chunks(ids):
+            changed(Bulb, Bulb.id.in_(chunk), announce=tracked)
+            for power in (True, False):
+                sync_group_power(and_(Bulb.id.in_(chunk), Bulb.power == power), power)
+    if commit:
+        db.session.commit()
+
+#SQLITE LIMITS BOUND PARAMETERS PER STATEMENT
+def chunks(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+###
+### CHANGE NOTIFICATIONS
+###
+
+#listeners get a list of state rows (dicts of kind plus the columns below) once the
+#transaction that changed them has committed; hot store writes reach them when they're
+#made, or, for listeners registered with stored=True, once they have been flushed
+listeners = []
+stored_listeners = []
+
+BULB_STATE_COLUMNS = [Bulb.id, Bulb.name, Bulb.owner_id, Bulb.location_id, Bulb.group_id,
+    Bulb.power, Bulb.brightness, Bulb.version]
+GROUP_STATE_COLUMNS = [Group.id, Group.name, Group.owner_id, Group.location_id,
+    Group.power, Group.brightness, Group.version]
+
+def on_change(fn, stored=False):
+    (stored_listeners if stored else listeners).append(fn)
+    return fn
+
+#REMEMBER WHICH ROWS THE CURRENT TRANSACTION CHANGED
+#set-based changes are also kept under 'bulk_changes' for recorders that run before commit
+#(ORM flushes can be seen directly in flush events); announce=False leaves listeners out
+def changed(model, criterion, session=None, bulk=True, announce=True):
+    info = (session or db.session).info
+    if bulk:
+        info.setdefault('bulk_changes', []).append((model, criterion))
+    if (listeners or stored_listeners) and announce:
+        info.setdefault('changed_state', []).append((model, criterion))
+
+def notify(rows, to=None):
+    for fn in (listeners + stored_listeners if to is None else to):
+        try:
+            fn(rows)
+        except Exception:
+            app.logger.exception('State change listener failed.')
+
+#ROWS ARE READ BACK AFTER COMMIT (THE SESSION CAN'T EMIT SQL THEN, SO ON A FRESH CONNECTION)
+def changed_rows(changes):
+    rows = {}
+    with db.engine.connect() as connection:
+        for model, criterion in changes:
+            kind, columns = ('bulb', BULB_STATE_COLUMNS) if model is Bulb else ('group', GROUP_STATE_COLUMNS)
+            for row in connection.execute(select(columns).where(criterion)):
+                rows[(kind, row['id'])] = dict(row, kind=kind)
+    return list(rows.values())
+
+@event.listens_for(Session, 'after_flush')
+def _track_orm_changes(session, context):
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, (Bulb, Group)):
+            changed(type(obj), type(obj).id == obj.id, session, bulk=False)
+
+@event.listens_for(Session, 'after_commit')
+def _notify_after_commit(session):
+    session.info.pop('bulk_changes', None)
+    changes = session.info.pop('changed_state', None)
+    if changes:
+        notify(changed_rows(changes))
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_after_rollback(session):
+    session.info.pop('bulk_changes', None)
+    session.info.pop('changed_state', None)
+
+###
+### HOT STATE STORE (ENABLED WITH STATE_STORE_ENABLED)
+###
+
+_store = None
+_store_lock = threading.Lock()
+
+def load_bulb_state(bulb_id):
+    row = db.session.query(*BULB_STATE_COLUMNS).filter(Bulb.id == bulb_id).first()
+    if row is None:
+        return None
+    return dict(zip([c.key for c in BULB_STATE_COLUMNS], row))
+
+def flush_hot_rows(rows):
+    apply_bulb_rows(rows, tracked=False)
+    if stored_listeners:
+        notify([dict(row, kind='bulb') for row in rows], stored_listeners)
+
+def hot_store():
+    global _store
+    if not app.config.get('STATE_STORE_ENABLED', False):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = DeviceStateStore(load_bulb_state, flush_hot_rows,
+                    journal_path=app.config.get('STATE_JOURNAL', 'state.journal'),
+                    fsync=app.config.get('STATE_JOURNAL_FSYNC', False),
+                    on_set=lambda state: notify([dict(state, kind='bulb')], listeners))
+                store.start(app.config.get('STATE_FLUSH_INTERVAL', 1.0), app.app_context)
+                _store = store
+    return _store
+
+def serialize_hot_state(state):
+    return serialize_states([(state['id'], state['name'], state['power'], state['version'])])[0]
+
+#SET-BASED UPDATES WRITE PAST THE STORE: FLUSH IT BEFORE THE TRANSACTION'S FIRST WRITE,
+#AND DROP THE CACHED BULBS ONCE THE TRANSACTION COMMITS
+def release_hot_state(criterion):
+    store = hot_store()
+    if store is None:
+        return
+    if 'evict_hot_state' not in db.session.info:
+        store.flush()
+    ids = [id for (id,) in db.session.query(Bulb.id).filter(criterion)]
+    db.session.info.setdefault('evict_hot_state', set()).update(ids)
+
+@event.listens_for(Session, 'after_commit')
+def _evict_after_commit(session):
+    ids = session.info.pop('evict_hot_state', None)
+    if ids and _store is not None:
+        _store.evict(ids)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_after_rollback(session):
+    ids = session.info.pop('evict_hot_state', None)
+    if ids and _store is not None:
+        _store.evict(ids)
+
+###
+### DEBOUNCED BRIGHTNESS (ENABLED WITH A BRIGHTNESS_DEBOUNCE_WINDOW ABOVE 0)
+###
+
+_debouncer = None
+
+#WRITE [(kind, id, brightness), ...] IN ORDER, RUNS OF BULBS AS ONE BATCHED UPDATE, ONE TRANSACTION
+def write_brightness(items):
+    table = Bulb.__table__
+    statement = table.update().where(table.c.id == bindparam('b_id')) \
+        .values(brightness=bindparam('b_brightness'), version=table.c.version + 1)
+    run = []
+    for kind, id, value in items + [(None, None, None)]:
+        if kind == 'bulb':
+            run.append({'b_id': id, 'b_brightness': value})
+            continue
+        if run:
+            criterion = Bulb.id.in_([r['b_id'] for r in run])
+            release_hot_state(criterion)
+            db.session.execute(statement, run)
+            changed(Bulb, criterion)
+            run = []
+        if kind == 'group':
+            set_group_state(id, brightness=value, commit=False)
+    db.session.commit()
+
+def brightness_debouncer():
+    global _debouncer
+    window = app.config.get('BRIGHTNESS_DEBOUNCE_WINDOW', 0)
+    if not window:
+        return None
+    if _debouncer is None:
+        with _store_lock:
+            if _debouncer is None:
+                _debouncer = BrightnessDebouncer(window, write_brightness, context=app.app_context)
+    return _debouncer
+
+def stats():
+    store = hot_store()
+    debouncer = brightness_debouncer()
+    return {
+        'state_store': store.stats() if store else None,
+        'brightness_debounce': debouncer.stats() if debouncer else None
+    }
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+
+######################################################################################
+##
+## HOT DEVICE-STATE STORE
+##
+## Keeps power/brightness of recently used bulbs in memory, keyed by bulb id.
+## Reads are served from memory; writes are journaled, then coalesced and
+## written to the bulb table in one batch every flush interval.
+##
+## The journal is appended before a write is acknowledged and only dropped once
+## the batch holding it has been committed. A restarted process replays it, so
+## a crash loses no acknowledged write (set fsync to also survive power loss).
+##
+## The store assumes it is the only writer of its cached bulbs: set-based
+## updates must call flush() and evict() around their own UPDATEs.
+##
+######################################################################################
+
+class DeviceStateStore(object):
+
+    def __init__(self, loader, writer, journal_path=None, fsync=False, on_set=None):
+        #loader(bulb_id) -> dict with id, name, owner_id, power, brightness, version (or None)
+        #writer(rows) persists a list of such dicts in one transaction
+        #on_set(state) is called with every acknowledged write
+        self.loader = loader
+        self.writer = writer
+        self.on_set = on_set
+        self.journal_path = journal_path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.states = {}
+        self.dirty = {}
+        self.journal = None
+        self.reads = 0
+        self.writes = 0
+        self.flushed = 0
+        if journal_path:
+            self.replay()
+            self.journal = open(journal_path, 'a')
+
+    def get(self, bulb_id):
+        with self.lock:
+            state = self.states.get(bulb_id)
+            self.reads += 1
+        if state is None:
+            state = self.loader(bulb_id)
+            if state is None:
+                return None
+            with self.lock:
+                state = self.states.setdefault(bulb_id, state)
+        return dict(state)
+
+    #CHANGE A BULB; WITH A VERSION THIS IS A COMPARE-AND-SWAP (None WHEN IT HAS MOVED ON)
+    def set(self, bulb_id, power=None, brightness=None, version=None):
+        if self.get(bulb_id) is None:
+            return None
+        with self.lock:
+            state = self.states.get(bulb_id)
+            if state is None or (version is not None and state['version'] != version):
+                return None
+            if power is not None:
+                state['power'] = bool(power)
+            if brightness is not None:
+                state['brightness'] = brightness
+            state['version'] += 1
+            self.dirty[bulb_id] = state
+            self.writes += 1
+            self._journal(state)
+            state = dict(state)
+        if self.on_set is not None:
+            self.on_set(state)
+        return state
+
+    def _journal(self, state):
+        if self.journal is None:
+            return
+        self.journal.write(json.dumps(state) + '\n')
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+    #MOVE THE JOURNAL ASIDE UNTIL ITS BATCH IS COMMITTED (APPENDING IF A FAILED BATCH IS STILL THERE)
+    def _rotate(self):
+        self.journal.close()
+        flushing = self.journal_path + '.flushing'
+        if os.path.exists(flushing):
+            with open(flushing, 'a') as out:
+                with open(self.journal_path) as current:
+                    out.write(current.read())
+            os.remove(self.journal_path)
+        else:
+            os.rename(self.journal_path, flushing)
+        self.journal = open(self.journal_path, 'a')
+
+    #WRITE EVERY PENDING CHANGE IN ONE BATCH
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending = self.dirty
+                self.dirty = {}
+                if not pending:
+                    return 0
+                rows = [dict(s) for s in pending.values()]
+                if self.journal is not None:
+                    self._rotate()
+            try:
+                self.writer(rows)
+            except Exception:
+                #keep the changes pending (newer writes win) and retry on the next flush
+                with self.lock:
+                    for row in rows:
+                        self.dirty.setdefault(row['id'], self.states.get(row['id'], row))
+                raise
+            if self.journal_path:
+                os.remove(self.journal_path + '.flushing')
+            with self.lock:
+                self.flushed += len(rows)
+            return len(rows)
+
+    def evict(self, bulb_ids):
+        with self.lock:
+            for bulb_id in bulb_ids:
+                if bulb_id not in self.dirty:
+                    self.states.pop(bulb_id, None)
+
+    #APPLY WRITES LEFT IN THE JOURNAL BY A PREVIOUS PROCESS
+    def replay(self):
+        rows = {}
+        for path in (self.journal_path + '.flushing', self.journal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        state = json.loads(line)
+                    except ValueError:
+                        #a torn last line from a crash mid-write was never acknowledged
+                        continue
+                    rows[state['id']] = state
+        if rows:
+            self.writer(list(rows.values()))
+        for path in (self.journal_path + '.flushing', self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            return {'cached': len(self.states), 'pending': len(self.dirty), 'reads': self.reads,
+                'writes': self.writes, 'flushed': self.flushed}
+
+    #FLUSH EVERY interval SECONDS ON A DAEMON THREAD; context() WRAPS EACH FLUSH
+    def start(self, interval, context):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    with context():
+                        self.flush()
+                except Exception:
+                    continue
+        thread = threading.Thread(target=run, name='state-flush')
+        thread.daemon = True
+        thread.start()
+        return thread
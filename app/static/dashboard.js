@@ -0,0 +1,59 @@
+// Dashboard controls without page reloads: switch and dim forms and delete links
+// inside #bulbs and #groups are sent as XHR, and the bulbs and groups that
+// changed come back as HTML (fragments/items.html) and are swapped in by id.
+// Without JavaScript the same forms post and redirect as before.
+(function () {
+  'use strict';
+
+  function patch(html) {
+    var holder = document.createElement('div');
+    holder.innerHTML = html;
+    var items = holder.querySelectorAll('[id]');
+    for (var i = 0; i < items.length; i++) {
+      var item = items[i];
+      var current = document.getElementById(item.id);
+      if (item.getAttribute('data-deleted')) {
+        if (current) current.parentNode.removeChild(current);
+      } else if (current) {
+        // answers can arrive out of order; never go back to an older version
+        var shown = parseInt(current.getAttribute('data-version'), 10);
+        var sent = parseInt(item.getAttribute('data-version'), 10);
+        if (!(shown > sent)) current.parentNode.replaceChild(item, current);
+      }
+    }
+  }
+
+  function send(method, url, body, fallback) {
+    var xhr = new XMLHttpRequest();
+    xhr.open(method, url);
+    xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+    xhr.setRequestHeader('Accept', 'text/html');
+    xhr.onload = function () {
+      if (xhr.status >= 200 && xhr.status < 300) {
+        patch(xhr.responseText);
+      } else {
+        fallback();
+      }
+    };
+    xhr.onerror = fallback;
+    xhr.send(body);
+  }
+
+  function inDashboard(element) {
+    return element.closest && element.closest('#bulbs, #groups');
+  }
+
+  document.addEventListener('submit', function (event) {
+    var form = event.target;
+    if (!inDashboard(form)) return;
+    event.preventDefault();
+    send('POST', form.action, new FormData(form), function () { form.submit(); });
+  });
+
+  document.addEventListener('click', function (event) {
+    var link = event.target;
+    if (link.tagName !== 'A' || link.className !== 'delete' || !inDashboard(link)) return;
+    event.preventDefault();
+    send('GET', link.href, null, function () { window.location = link.href; });
+  });
+})();
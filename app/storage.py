@@ -0,0 +1,105 @@
+import sqlite3
+import threading
+from flask import request, _app_ctx_stack
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Select
+from app import app, db
+
+######################################################################################
+##
+## SQLITE STORAGE PROFILE
+##
+## Every SQLite connection is opened with WAL and the SQLITE_* pragmas, so
+## readers no longer wait on the writer and a writer waits (busy_timeout)
+## instead of failing with "database is locked". File databases get pooled
+## connections instead of one new connection per checkout.
+##
+## Read-only requests (GET) send their SELECTs to a separate pool of query_only
+## connections. Once such a request writes anything, the rest of it stays on the
+## write connection so it reads its own writes.
+##
+######################################################################################
+
+def in_memory(uri):
+    return make_url(uri).database in (None, '', ':memory:')
+
+#POOL AND DRIVER OPTIONS FOR THE WRITE ENGINE (NOTHING FOR IN-MEMORY DATABASES)
+def engine_options(uri):
+    if not uri.startswith('sqlite') or in_memory(uri):
+        return {}
+    return {
+        'poolclass': QueuePool,
+        'pool_size': app.config.get('SQLITE_POOL_SIZE', 5),
+        'max_overflow': app.config.get('SQLITE_POOL_OVERFLOW', 10),
+        'connect_args': {'check_same_thread': False, 'timeout': app.config.get('SQLITE_BUSY_TIMEOUT', 30)}
+    }
+
+@event.listens_for(Engine, 'connect')
+def _apply_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode = %s' % ('WAL' if app.config.get('SQLITE_WAL', True) else 'DELETE'))
+    cursor.execute('PRAGMA synchronous = %s' % app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL'))
+    #negative: KiB rather than pages
+    cursor.execute('PRAGMA cache_size = -%d' % app.config.get('SQLITE_CACHE_SIZE_KB', 65536))
+    cursor.execute('PRAGMA mmap_size = %d' % app.config.get('SQLITE_MMAP_SIZE', 268435456))
+    cursor.execute('PRAGMA busy_timeout = %d' % (1000 * app.config.get('SQLITE_BUSY_TIMEOUT', 30)))
+    cursor.close()
+
+def _query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+_read_engines = {}
+_read_lock = threading.Lock()
+
+#THE READ-ONLY ENGINE FOR THE CONFIGURED DATABASE, OR None WHEN READS CAN'T BE SPLIT OFF
+def read_engine():
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if not app.config.get('SQLITE_READ_ROUTING', True) or not uri.startswith('sqlite') or in_memory(uri):
+        return None
+    engine = _read_engines.get(uri)
+    if engine is None:
+        with _read_lock:
+            engine = _read_engines.get(uri)
+            if engine is None:
+                engine = create_engine(uri, poolclass=QueuePool,
+                    pool_size=app.config.get('SQLITE_READ_POOL_SIZE', 10),
+                    max_overflow=app.config.get('SQLITE_POOL_OVERFLOW', 10),
+                    connect_args={'check_same_thread': False, 'timeout': app.config.get('SQLITE_BUSY_TIMEOUT', 30)})
+                event.listen(engine, 'connect', _query_only)
+                _read_engines[uri] = engine
+    return engine
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('read_only') and not self.info.get('wrote'):
+            if isinstance(clause, Select) and not self._flushing:
+                engine = read_engine()
+                if engine is not None:
+                    return engine
+            else:
+                self.info['wrote'] = True
+        return SignallingSession.get_bind(self, mapper, clause)
+
+def read_only():
+    db.session.info['read_only'] = True
+
+def init_storage():
+    options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.session = scoped_session(sessionmaker(class_=RoutingSession, db=db, query_cls=db.Query),
+        scopefunc=_app_ctx_stack.__ident_func__)
+
+    @app.before_request
+    def _route_reads():
+        if request.method == 'GET':
+            read_only()
@@ -2,14 +2,42 @@ from flask import render_template, flash, redirect, make_response, session, url_
 from flask_login import login_user, logout_user, current_user, login_required, current_user
 from flask_jwt import JWT, jwt_required, current_identity
 from sqlalchemy.sql import func
+from sqlalchemy.orm.exc import StaleDataError
 import dateutil.parser
 import datetime
-from app import app, db, lm, bcrypt
+import time
+from app import app, db, lm
 from .token import generate_confirmation_token, confirm_token
 from .email import send_email
 from .forms import LoginForm, EditNicknameForm, CreateForm, AddBulbForm, AddLocationForm, AddGroupForm, LocationSelector
-from .models import User, Location, Bulb, Group, Scene, Shared_control
+from .models import User, Location, Bulb, Group, Scene, Schedule, Shared_control
 from .decorators import check_confirmed
+from .state import bulb_selection, set_bulbs_state, set_group_state, toggle_bulb, toggle_group, \
+  hot_store, serialize_hot_state, brightness_debouncer, stats, changed_rows, release_hot_state
+from .events import event_stream
+from .changes import changes_since
+from .dispatch import dispatcher
+from .scenes import capture_scene, apply_scene, remove_scene
+from .scheduler import scheduler
+from .identity import cached_user, user_cache
+from .acl import allowed, allowed_all, access_index
+from .passwords import PasswordBusy, verify_user, stats as password_stats
+from .storage import init_storage
+from .instrument import init_instrumentation
+from .export import export_response
+from .choices import location_choices as location_choices_for, bulb_choices, choice_cache
+from .fragments import dashboard_fragments, fragment_cache
+from .history import history_log, history_range, pick_resolution, RESOLUTIONS as HISTORY_RESOLUTIONS
+from .etags import bulb_stamp, group_stamp, location_stamp, user_stamp, collection_stamp, etag_for, is_fresh, \
+  not_modified, with_etag
+from .serializers import parse_fields, page, serialize_bulb, serialize_bulbs, serialize_group, \
+  serialize_groups, serialize_location, serialize_locations, serialize_user
+
+init_storage()
+init_instrumentation()
+history_log()
+#schedules already in the table fire without waiting for a request to create one
+scheduler()
 
 
 ######################################################################################
@@ -26,7 +54,7 @@ from .decorators import check_confirmed
 def index():
   user=g.user
   #grab list of user's locations for group and bulb selectors
-  location_choices = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
+  location_choices = location_choices_for(user.id)
   #create a default location w/ name "home" for user
   if len(location_choices) == 0:
     location = Location(name="Home", owner_id=user.id)
@@ -40,30 +68,19 @@ def index():
     db.session.add(user)
     db.session.commit()
     return redirect(redirect_url())
-  last_location_name = Location.query.get(user.last_location).name
-  #grab all the bulbs and groups from their location to display for control
-  bulbs = user.bulbs.filter_by(location_id=user.last_location)
-  groups = user.groups.filter_by(location_id=user.last_location)
-  #create forms to add new locations, groups, and bulbs
-  location_form=AddLocationForm()
-  bulb_form=AddBulbForm()
-  group_form = AddGroupForm()
-  #add form to select current location
-  location_selection_form = LocationSelector()
-  bulb_form.location.choices = location_choices
-  group_form.location.choices = location_choices
-  location_selection_form.selector.choices = location_choices
-  #grab list of user's bulbs for group add
-  group_form.bulbs.choices = [(bulb.id, bulb.name) for bulb in Bulb.query.filter_by(owner_id=user.id)]
-  return render_template('index.html', title='Home', user=user,
-    bulbs=bulbs, groups=groups, current_location=last_location_name, location_form=location_form, bulb_form=bulb_form, group_form=group_form,
-    location_selector=location_selection_form)
+  #the name comes with the choices; the lists and forms come from the fragment cache
+  last_location_name = dict(location_choices).get(user.last_location)
+  if last_location_name is None:
+    last_location_name = Location.query.get(user.last_location).name
+  fragments = dashboard_fragments(user, location_choices)
+  return render_template('index.html', title='Home', user=user, current_location=last_location_name,
+    fragments=fragments)
 
 #ADD BULB FORM RENDER (WORKS WITH @APP.ROUTE(... METHODS=['POST']) IN BULB CONTROLS)
 @app.route('/bulb/add', methods=['GET'])
 @login_required
 def addBulb():
-  locations = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
+  locations = location_choices_for(g.user.id)
   form = AddBulbForm(request.form)
   form.location.choices = locations
   return render_template('add_bulb.html', form=form, title="Adding bulb")
@@ -72,17 +89,18 @@ def addBulb():
 @app.route('/group/add', methods=['GET'])
 @login_required
 def addGroup():
-  locations = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
-  bulbs = [(bulb.id, bulb.name) for bulb in Bulb.query.filter_by(owner_id=user.id)]
+  locations = location_choices_for(g.user.id)
+  bulbs = bulb_choices(g.user.id)
   form = AddGroupForm(request.form)
   form.location.choices = locations
+  form.bulbs.choices = bulbs
   return render_template('add_group.html', form=form, title="Adding group")
 
 #LOCATION SWITCH FORM
 @app.route('/location/switch', methods=['GET'])
 @login_required
 def switchLocation():
-  locations = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
+  locations = location_choices_for(g.user.id)
   form = LocationSelector(request.form)
   form.selector.choices = locations
   return render_template('switch_location.html', form=form, title="Changing location")
@@ -172,7 +190,7 @@ def login():
       user = User.query.filter_by(email=func.lower(form.email.data)).first()
       remember = form.remember_me.data
       if user:
-        if bcrypt.check_password_hash(user.password, form.password.data):
+        if verify_user(user, form.password.data):
             user.authenticated = True
             db.session.add(user)
             db.session.commit()
@@ -213,50 +231,48 @@ def logout():
 def switchBulb(id):
   user= g.user
   bulb = Bulb.query.get(id)
-  old_state = bulb.power
-  if bulb is not None and bulb.owner == user:
-    new_state = not bulb.power
-    bulb.power = new_state
-    db.session.add(bulb)
-    #db.session.commit()
-    # if this is the last bulb in a group to change state, change the group's state.
-    group = bulb.group
-    if group is not None:
-      group_should_change = True
-      for bulb in group.bulbs:
-        if bulb.power == old_state:
-          group_should_change = False
-      if group_should_change:
-        group.power = new_state
-      db.session.add(group)
-    db.session.commit()
-  return redirect(redirect_url())
+  if bulb is None or bulb.owner != user:
+    return control_failed("No permissions to switch this bulb, or bulb does not exist.")
+  # if this is the last bulb in a group to change state, the group's state changes with it.
+  group_id = bulb.group_id
+  toggle_bulb(bulb.id)
+  return control_done([(Bulb, Bulb.id == id), (Group, Group.id == group_id)])
+
+#BRIGHTNESS FROM A DIM FORM, None UNLESS IT'S A WHOLE NUMBER FROM 0 TO 100
+def form_brightness():
+  value = request.form.get("brightness", type=int)
+  return value if value is not None and 0 <= value <= 100 else None
 
 #BULB BRIGHTNESS CONTROL
 @app.route('/bulb/<int:id>/dim', methods=['POST'])
 @login_required
 def dimBulb(id):
   user = g.user
-  bulb = Bulb.query.get(id)
-  value = request.form.get("brightness")
+  store = hot_store()
+  bulb = store.get(id) if store else Bulb.query.get(id)
+  value = form_brightness()
   if bulb is None:
-    flash("Bulb not found. Could not set brightness.")
-    return redirect(redirect_url())
-  if bulb.owner != user:
-    flash("No permissions to set brightness on this bulb.")
-    flash(bulb.owner)
-    return redirect(redirect_url())
-  bulb.brightness = value
-  db.session.add(bulb)
-  db.session.commit()
-  return redirect(redirect_url())
+    return control_failed("Bulb not found. Could not set brightness.", 404)
+  if (bulb['owner_id'] if store else bulb.owner_id) != user.id:
+    return control_failed("No permissions to set brightness on this bulb.")
+  if value is None:
+    return control_failed("Brightness must be a whole number from 0 to 100.", 400)
+  debouncer = brightness_debouncer()
+  if store:
+    store.set(id, brightness=value)
+    return control_done(pending={('bulb', id): {'brightness': value}})
+  elif debouncer:
+    debouncer.submit('bulb', id, value)
+    return control_done([(Bulb, Bulb.id == id)], pending={('bulb', id): {'brightness': value}})
+  set_bulbs_state(Bulb.id == id, brightness=value, states=False)
+  return control_done([(Bulb, Bulb.id == id)])
 
 #ADD BULB
 @app.route('/bulb/add', methods=['POST'])
 @login_required
 def validateBulb():
   user = g.user
-  locations = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
+  locations = location_choices_for(user.id)
   form = AddBulbForm(request.form)
   form.location.choices = locations
   if form.validate_on_submit():
@@ -274,13 +290,15 @@ def validateBulb():
 def deleteBulb(id):
   user = g.user
   bulb = Bulb.query.get(id)
-  if bulb is not None and bulb.owner_id == user.id:
-    db.session.delete(bulb)
-    db.session.commit()
+  if bulb is None or bulb.owner_id != user.id:
+    return control_failed("Error deleting bulb.")
+  #the hot store flushes first and drops the bulb once this commits
+  release_hot_state(Bulb.id == id)
+  db.session.delete(bulb)
+  db.session.commit()
+  if not is_xhr():
     flash("Bulb \"" + bulb.name + "\" deleted.")
-  else:
-    flash("Error deleting bulb \"" + bulb.name + "\".")
-  return redirect(redirect_url())
+  return control_done(deleted=[('bulb', id)])
 
 ### GROUP CONTROLS
 #GROUP SWITCH (POWER ON/OFF)
@@ -289,15 +307,10 @@ def deleteBulb(id):
 def switchGroup(id):
   user = g.user
   group = Group.query.get(id)
-  if group is not None and group.owner == user:
-    group.power = not group.power
-    db.session.add(group)
-    bulbs = group.bulbs.all()
-    for bulb in bulbs:
-      bulb.power =  group.power
-      db.session.add(bulb)
-    db.session.commit()
-  return redirect(redirect_url())
+  if group is None or group.owner != user:
+    return control_failed("No permissions to switch this group, or group does not exist.")
+  toggle_group(group.id)
+  return control_done([(Group, Group.id == id), (Bulb, Bulb.group_id == id)])
 
 #GROUP BRIGHTNESS CONTROL
 @app.route('/group/<int:id>/dim', methods=['POST'])
@@ -305,29 +318,27 @@ def switchGroup(id):
 def dimGroup(id):
   user = g.user
   group = Group.query.get(id)
-  value = request.form.get("brightness")
+  value = form_brightness()
   if group is None:
-    flash("Group not found. Could not set brightness.")
-    return redirect(redirect_url())
+    return control_failed("Group not found. Could not set brightness.", 404)
   if group.owner != user:
-    flash("No permissions to set brightness on this group.")
-    return redirect(redirect_url())
-  group.brightness = value
-  db.session.add(group)
-  bulbs = group.bulbs.all()
-  for bulb in bulbs:
-    bulb.brightness = group.brightness
-    db.session.add(bulb)
-  db.session.commit()
-  return redirect(redirect_url())
+    return control_failed("No permissions to set brightness on this group.")
+  if value is None:
+    return control_failed("Brightness must be a whole number from 0 to 100.", 400)
+  debouncer = brightness_debouncer()
+  if debouncer:
+    debouncer.submit('group', group.id, value)
+    return control_done([(Group, Group.id == id)], pending={('group', id): {'brightness': value}})
+  set_group_state(group.id, brightness=value)
+  return control_done([(Group, Group.id == id), (Bulb, Bulb.group_id == id)])
 
 #ADD GROUP
 @app.route('/group/add', methods=['POST'])
 @login_required
 def validateGroup():
   user = g.user
-  locations = [(location.id, location.name) for location in Location.query.filter_by(owner_id=user.id)]
-  bulbs = [(bulb.id, bulb.name) for bulb in Bulb.query.filter_by(owner_id=user.id)]
+  locations = location_choices_for(user.id)
+  bulbs = bulb_choices(user.id)
   form = AddGroupForm(request.form)
   form.location.choices = locations
   form.bulbs.choices = bulbs
@@ -347,13 +358,13 @@ def validateGroup():
 def deleteGroup(id):
   user = g.user
   group = Group.query.get(id)
-  if group is not None and group.owner_id == user.id:
-    db.session.delete(group)
-    db.session.commit()
+  if group is None or group.owner_id != user.id:
+    return control_failed("Error deleting group.")
+  db.session.delete(group)
+  db.session.commit()
+  if not is_xhr():
     flash("Group \"" + group.name + "\" deleted.")
-  else:
-    flash("Error deleting group \"" + group.name + "\".")
-  return redirect(redirect_url())
+  return control_done(deleted=[('group', id)])
 
 ### LOCATION CONTROLS
 #ADD LOCATION
@@ -378,6 +389,7 @@ def deleteLocation(id):
   user = g.user
   location = Location.query.get(id)
   if location is not None and location.owner_id == user.id:
+    release_hot_state(Bulb.location_id == id)
     db.session.delete(location)
     db.session.commit()
     flash("Location \"" + location.name + "\" deleted.")
@@ -448,19 +460,20 @@ def authenticate(email, password):
   print (email + ": " + password)
   user = User.query.filter_by(email=func.lower(email)).first()
   print user
-  if user and bcrypt.check_password_hash(user.password, password):
+  if user and verify_user(user, password):
+    db.session.commit()
     return user
   else:
     return bad_request("Password not accepted.")
 def identity(payload):
   id = payload['identity']
-  return User.query.get(id)
+  return cached_user(id)
 jwt = JWT(app, authenticate, identity)
 
 #LOGIN-MANAGER
 @lm.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return cached_user(int(id))
 
 #GLOBALS MANAGER
 @app.before_request
@@ -480,6 +493,15 @@ def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
 
+#TOO MANY LOGINS/SIGNUPS WAITING ON PASSWORD HASHING
+@app.errorhandler(PasswordBusy)
+def password_busy_error(error):
+    db.session.rollback()
+    response = jsonify({"error": "Too many sign-in requests, try again shortly."})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
 # @app.errorhandler(400)
 # def bad_request_error(error):
 #   db.session.rollback()
@@ -493,6 +515,39 @@ def redirect_url(default='index'):
   return request.args.get('next') or \
          request.referrer or \
          url_for(default)
+#XHR CONTROLS GET THE CHANGED BULBS AND GROUPS BACK (JSON STATE ROWS, OR THEIR HTML IF THEY
+#ACCEPT text/html) INSTEAD OF A REDIRECT AND A FULL DASHBOARD RENDER
+def is_xhr():
+  return request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+#pending: {(kind, id): values} accepted but not yet written (debounced or in the hot store)
+def control_done(changes=(), deleted=(), pending=None):
+  if not is_xhr():
+    return redirect(redirect_url())
+  rows = changed_rows(changes) if changes else []
+  if pending:
+    found = set((row['kind'], row['id']) for row in rows)
+    store = hot_store()
+    for (kind, id), values in pending.items():
+      #a bulb deleted since is left out
+      state = store.get(id) if (kind, id) not in found and kind == 'bulb' and store else None
+      if state is not None:
+        rows.append(dict(state, kind=kind))
+    for row in rows:
+      row.update(pending.get((row['kind'], row['id']), {}))
+  rows.sort(key=lambda row: (row['kind'], row['id']))
+  if request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'text/html':
+    response = make_response(render_template('fragments/items.html', rows=rows, deleted=deleted))
+  else:
+    response = jsonify({'changes': rows, 'deleted': [{'kind': kind, 'id': id} for kind, id in deleted]})
+  response.status_code = 202 if pending else 200
+  return response
+def control_failed(message, status=403):
+  if not is_xhr():
+    flash(message)
+    return redirect(redirect_url())
+  response = jsonify({"error":message})
+  response.status_code = status
+  return response
 def bad_request(message):
   response = jsonify({"error":message})
   response.status_code = 400
@@ -501,12 +556,41 @@ def not_found():
   response = jsonify()
   response.status_code = 404
   return response
+#AN ID FROM A REQUEST BODY AS AN int, None IF IT ISN'T ONE
+def as_id(value):
+  if isinstance(value, bool):
+    return None
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+#A LIST OF IDS FROM A REQUEST BODY AS ints, None IF IT ISN'T ONE
+def as_ids(values):
+  if type(values) is not list:
+    return None
+  ids = [as_id(value) for value in values]
+  return None if None in ids else ids
+#A BRIGHTNESS FROM A REQUEST BODY: A WHOLE NUMBER FROM 0 TO 100
+def valid_brightness(value):
+  return type(value) is int and 0 <= value <= 100
+#(fields, after_id, limit) FROM THE QUERY STRING, limit CAPPED AT PAGE_MAX
+def paging_args(default_limit=None):
+  limit = request.args.get('limit', default_limit, type=int)
+  if limit is not None:
+    limit = max(1, min(limit, app.config.get('PAGE_MAX', 1000)))
+  return parse_fields(request.args.get('fields')), request.args.get('after_id', type=int), limit
+def conflict(message):
+  response = jsonify({"error":message})
+  response.status_code = 409
+  return response
 
 def created(object):
   type_ref = {Bulb: 'get_bulb',
               Location: 'get_location',
               Group: 'get_group',
-              User: 'get_user'
+              User: 'get_user',
+              Scene: 'get_scene',
+              Schedule: 'get_schedule'
   }
   response = jsonify(object.serialize())
   response.status_code = 201
@@ -611,11 +695,13 @@ def create_bulb():
   required_keys = [u'name', u'location_id', u'bulb_type']
   if not set(required_keys) <= set(content.keys()):
     return bad_request("Missing either \"name\", \"location_id\", or \"bulb_type\" in request.")
-  location = Location.query.get(content['location_id'])
-  if location is None or location.owner_id is not current_identity.id:
+  location_id = as_id(content['location_id'])
+  if location_id is None:
+    return bad_request("Attribute \"location_id\" must be an integer.")
+  if not allowed(current_identity.id, 'location', location_id, own=True):
     return bad_request("User does not have permission to create bulbs on this location, or location does not exist.")
   bulb = Bulb(name=content['name'], owner=current_identity, owner_id=current_identity.id,
-    location_id=content['location_id'], bulb_type=content['bulb_type'])
+    location_id=location_id, bulb_type=content['bulb_type'])
   db.session.add(bulb)
   db.session.commit()
   return created(bulb)
@@ -631,15 +717,25 @@ def update_bulb():
   bulb = Bulb.query.get(content['id'])
   if bulb is None:
     return not_found()
-  if bulb.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'bulb', bulb.id, own=True):
     return bad_request("User does not have permission to update this bulb.")
+  #the hot store flushes first (its commit reloads the bulb) and drops the bulb once this commits
+  release_hot_state(Bulb.id == bulb.id)
+  if 'version' in content and content['version'] != bulb.version:
+    return conflict("Bulb was changed by another request. Reload it and retry.")
   for key in content.keys():
+    if key in ['id', 'version']:
+      continue
     try:
       setattr(bulb, key, content[key])
     except AttributeError:
       continue
   db.session.add(bulb)
-  db.session.commit()
+  try:
+    db.session.commit()
+  except StaleDataError:
+    db.session.rollback()
+    return conflict("Bulb was changed by another request. Reload it and retry.")
   return jsonify(bulb.serialize())
 
 #DELETE BULB
@@ -653,31 +749,84 @@ def delete_bulb():
   bulb = Bulb.query.get(content['id'])
   if bulb is None:
     return not_found()
-  if bulb.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'bulb', bulb.id, own=True):
     return bad_request("User does not have permission to delete this bulb.")
+  release_hot_state(Bulb.id == bulb.id)
   db.session.delete(bulb)
   db.session.commit()
   return successfully_deleted()
 
+#LIST BULBS, GROUPS OR LOCATIONS (OWNED, OR ALL IN ONE ACCESSIBLE location_id), PAGED BY after_id
+@app.route('/api/a/bulbs', methods=['GET'], defaults={'kind': 'bulb'})
+@app.route('/api/a/groups', methods=['GET'], defaults={'kind': 'group'})
+@app.route('/api/a/locations', methods=['GET'], defaults={'kind': 'location'})
+@jwt_required()
+def list_collection(kind):
+  fields, after_id, limit = paging_args(app.config.get('PAGE_SIZE', 100))
+  model = {'bulb': Bulb, 'group': Group, 'location': Location}[kind]
+  location_id = request.args.get('location_id', type=int)
+  if location_id is not None and kind != 'location':
+    if not allowed(current_identity.id, 'location', location_id):
+      return bad_request("User does not have permission to view this location, or location does not exist.")
+    criterion = model.location_id == location_id
+  else:
+    criterion = model.owner_id == current_identity.id
+  etag = etag_for(collection_stamp(model, criterion))
+  if is_fresh(etag):
+    return not_modified(etag)
+  items, next_after_id = page(model.query.filter(criterion), model, after_id, limit)
+  serializers = {'bulb': serialize_bulbs, 'group': serialize_groups, 'location': serialize_locations}
+  return with_etag(jsonify({'items': serializers[kind](items, fields=fields), 'next_after_id': next_after_id}), etag)
+
 #GET BULB
 @app.route('/api/a/bulb/<int:id>', methods=['GET'])
 @jwt_required()
 def get_bulb(id):
-  bulb = Bulb.query.get(id)
-  if bulb == None:
+  stamp = bulb_stamp(id)
+  if stamp == None:
     return not_found()
-  if bulb.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'bulb', id):
     return bad_request("User does not have permission to view this bulb.")
-  return jsonify(bulb.serialize())
+  etag = etag_for(stamp)
+  if is_fresh(etag):
+    return not_modified(etag)
+  bulb = Bulb.query.get(id)
+  return with_etag(jsonify(serialize_bulb(bulb, fields=parse_fields(request.args.get('fields')))), etag)
+
+#STATE HISTORY OF A BULB OR GROUP FROM THE ROLLUPS (?start=&end= UNIX TIME, ?resolution=minute|hour|day)
+@app.route('/api/a/bulb/<int:id>/history', methods=['GET'], defaults={'kind': 'bulb'})
+@app.route('/api/a/group/<int:id>/history', methods=['GET'], defaults={'kind': 'group'})
+@jwt_required()
+def get_history(kind, id):
+  if not allowed(current_identity.id, kind, id):
+    return bad_request("User does not have permission to view this " + kind + ", or it does not exist.")
+  end = request.args.get('end', int(time.time()), type=int)
+  start = request.args.get('start', end - 86400, type=int)
+  resolution = request.args.get('resolution')
+  if resolution is not None and resolution not in HISTORY_RESOLUTIONS:
+    return bad_request("\"resolution\" must be one of: minute, hour, day.")
+  if start >= end:
+    return bad_request("\"start\" must be before \"end\".")
+  resolution = HISTORY_RESOLUTIONS[resolution] if resolution else \
+    pick_resolution(start, end, app.config.get('HISTORY_MAX_BUCKETS', 1000))
+  return jsonify(history_range(kind, id, start, end, resolution))
 
 #GET BULB POWER
 @app.route('/api/a/bulb/<int:id>/power', methods=['GET'])
 @jwt_required()
 def get_bulb_state(id):
+  store = hot_store()
+  if store:
+    state = store.get(id)
+    if state == None:
+      return not_found()
+    if not allowed(current_identity.id, 'bulb', id):
+      return bad_request("User does not have permission to view this bulb.")
+    return jsonify(serialize_hot_state(state))
   bulb = Bulb.query.get(id)
   if bulb == None:
-    not_found()
-  if bulb.owner_id is not current_identity.id:
+    return not_found()
+  if not allowed(current_identity.id, 'bulb', bulb.id):
     return bad_request("User does not have permission to view this bulb.")
   return jsonify(bulb.serialize_state())
 
@@ -685,15 +834,90 @@ def get_bulb_state(id):
 @app.route('/api/a/bulb/<int:id>/power', methods=['POST', 'PUT', 'PATCH'])
 @jwt_required()
 def change_bulb_state(id):
-  bulb = Bulb.query.get(id)
+  store = hot_store()
+  bulb = store.get(id) if store else Bulb.query.get(id)
   if bulb == None:
     return not_found()
+  if not allowed(current_identity.id, 'bulb', id):
+    return bad_request("User does not have permission to change this bulb.")
   content = request.get_json()
-  if content['state'] == None or content['state'] not in [0, 1]:
+  if content.get('state') == None or content['state'] not in [0, 1]:
     return bad_request("Attribute \"state\" must be set to either 1 (on) or 0 (off)")
-  bulb.power = content['state']
-  db.session.commit()
-  return jsonify(bulb.serialize_state()), 200;
+  if store:
+    state = store.set(id, power=content['state'], version=content.get('version'))
+    states = [serialize_hot_state(state)] if state else None
+  else:
+    states = set_bulbs_state(Bulb.id == id, power=content['state'], version=content.get('version'))
+  if states is None:
+    return conflict("Bulb was changed by another request. Reload it and retry.")
+  return jsonify(states[0]), 200;
+
+#CHANGE POWER/BRIGHTNESS OF MANY BULBS
+@app.route('/api/a/bulbs/state', methods=['POST', 'PUT', 'PATCH'])
+@jwt_required()
+def change_bulbs_state():
+  content = request.get_json(force=True)
+  selectors = [u'bulb_ids', u'location_id', u'group_id']
+  if not set(selectors) & set(content.keys()):
+    return bad_request("One of \"bulb_ids\", \"location_id\" or \"group_id\" is required to select bulbs.")
+  bulb_ids = content.get('bulb_ids')
+  if bulb_ids is not None:
+    bulb_ids = as_ids(bulb_ids)
+    if bulb_ids is None:
+      return bad_request("Attribute \"bulb_ids\" must be a list of integers.")
+  selected = {}
+  for kind in ['location', 'group']:
+    if content.get(kind + '_id') is not None:
+      selected[kind] = as_id(content[kind + '_id'])
+      if selected[kind] is None:
+        return bad_request("Attribute \"%s_id\" must be an integer." % kind)
+  state = content.get('state')
+  brightness = content.get('brightness')
+  if state is None and brightness is None:
+    return bad_request("Set \"state\" and/or \"brightness\" to change.")
+  if state is not None and state not in [0, 1]:
+    return bad_request("Attribute \"state\" must be set to either 1 (on) or 0 (off)")
+  if brightness is not None and not valid_brightness(brightness):
+    return bad_request("Attribute \"brightness\" must be an integer from 0 to 100.")
+  if bulb_ids is not None and not allowed_all(current_identity.id, 'bulb', bulb_ids):
+    return bad_request("User does not have permission on every bulb, or a bulb does not exist.")
+  for kind, id in selected.items():
+    if not allowed(current_identity.id, kind, id):
+      return bad_request("User does not have permission on this %s, or it does not exist." % kind)
+  #access is checked above, so shared bulbs are included
+  criterion = bulb_selection(None, bulb_ids=bulb_ids,
+    location_id=selected.get('location'), group_id=selected.get('group'))
+  return jsonify({'bulbs': set_bulbs_state(criterion, power=state, brightness=brightness)}), 200
+
+#STATE PATH COUNTERS
+@app.route('/api/a/stats', methods=['GET'])
+@jwt_required()
+def get_stats():
+  response = stats()
+  sender = dispatcher()
+  response['dispatch'] = sender.stats() if sender else None
+  timer = scheduler()
+  response['scheduler'] = timer.stats() if timer else None
+  response['user_cache'] = user_cache().stats()
+  response['passwords'] = password_stats()
+  response['acl'] = access_index().stats()
+  response['choices'] = choice_cache().stats()
+  if fragment_cache() is not None:
+    response['fragments'] = fragment_cache().stats()
+  log = history_log()
+  response['history'] = log.stats() if log else None
+  return jsonify(response)
+
+#STREAM STATE CHANGES (SERVER-SENT EVENTS), FOR THE USER OR ONE OF THEIR LOCATIONS
+@app.route('/api/a/stream', methods=['GET'])
+@jwt_required()
+def stream_state():
+  location_id = request.args.get('location_id', type=int)
+  if location_id is not None:
+    if not allowed(current_identity.id, 'location', location_id):
+      return bad_request("User does not have permission to watch this location, or location does not exist.")
+  last_id = request.headers.get('Last-Event-ID', type=int)
+  return event_stream(current_identity.id, location_id, last_id)
 
 ###
 # GROUPS
@@ -707,20 +931,19 @@ def create_group():
   required_keys = [u'name', u'location_id', u'bulb_ids']
   if not set(required_keys) <= set(content.keys()):
     return bad_request("Missing either \"name\", \"location_id\", or \"bulb_ids\" in request.")
-  location = Location.query.get(content['location_id'])
-  if location is None or location.owner_id is not current_identity.id:
+  location_id = as_id(content['location_id'])
+  if location_id is None:
+    return bad_request("Attribute \"location_id\" must be an integer.")
+  if not allowed(current_identity.id, 'location', location_id, own=True):
     return bad_request("User does not have permission to create groups on this location, or location does not exist.")
-  if "bulb_ids" not in content or type(content['bulb_ids']) is not list:
-    return bad_request("Group must contain at least one bulb, with \"bulb_ids\" as a list.")
-  bulbs = []
-  for b in content['bulb_ids']:
-    bulb = Bulb.query.get(b)
-    if bulb.owner_id == current_identity.id:
-      bulbs.append(bulb)
-    else:
-      return bad_request("User does not have permissions on bulb #" + b +", or bulb does not exist.")
+  bulb_ids = as_ids(content['bulb_ids'])
+  if bulb_ids is None:
+    return bad_request("Group must contain at least one bulb, with \"bulb_ids\" as a list of integers.")
+  if not allowed_all(current_identity.id, 'bulb', bulb_ids, own=True):
+    return bad_request("User does not have permissions on every bulb, or a bulb does not exist.")
+  bulbs = Bulb.query.filter(Bulb.id.in_(bulb_ids)).all()
   group = Group(name=content['name'], owner=current_identity, owner_id = current_identity.id,
-    location_id=content['location_id'], bulbs=bulbs)
+    location_id=location_id, bulbs=bulbs)
   db.session.add(group)
   db.session.commit()
   return created(group)
@@ -736,15 +959,23 @@ def update_group():
   group = Group.query.get(content['id'])
   if group is None:
     return not_found()
-  if group.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'group', group.id, own=True):
     return bad_request("User does not have permission to update this group.")
+  if 'version' in content and content['version'] != group.version:
+    return conflict("Group was changed by another request. Reload it and retry.")
   for key in content.keys():
+    if key in ['id', 'version']:
+      continue
     try:
       setattr(group, key, content[key])
     except AttributeError:
       continue
   db.session.add(group)
-  db.session.commit()
+  try:
+    db.session.commit()
+  except StaleDataError:
+    db.session.rollback()
+    return conflict("Group was changed by another request. Reload it and retry.")
   return jsonify(group.serialize())
 
 #DELETE GROUP
@@ -758,7 +989,7 @@ def delete_group():
   group = Group.query.get(content['id'])
   if group is None:
     return not_found()
-  if group.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'group', group.id, own=True):
     return bad_request("User does not have permission to delete this group.")
   db.session.delete(group)
   db.session.commit()
@@ -768,12 +999,16 @@ def delete_group():
 @app.route('/api/a/group/<int:id>', methods=['GET'])
 @jwt_required()
 def get_group(id):
-  group = Group.query.get(id)
-  if group == None:
+  stamp = group_stamp(id)
+  if stamp == None:
     return not_found()
-  if group.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'group', id):
     return bad_request("User does not have permission to view this group.")
-  return jsonify(group.serialize())
+  etag = etag_for(stamp)
+  if is_fresh(etag):
+    return not_modified(etag)
+  group = Group.query.get(id)
+  return with_etag(jsonify(serialize_group(group, fields=parse_fields(request.args.get('fields')))), etag)
 
 ###
 # LOCATIONS
@@ -783,10 +1018,18 @@ def get_group(id):
 @app.route('/api/a/location/<int:id>', methods=['GET'])
 @jwt_required()
 def get_location(id):
+  fields, after_id, limit = paging_args()
+  after_id = request.args.get('bulbs_after_id', after_id, type=int)
+  stamp = location_stamp(id)
+  if stamp == None:
+    return not_found()
+  if not allowed(current_identity.id, 'location', id):
+    return bad_request("User does not have permission to view this location.")
+  etag = etag_for(stamp)
+  if is_fresh(etag):
+    return not_modified(etag)
   location = Location.query.get(id)
-  if location == None:
-    not_found()
-  return jsonify(location.serialize())
+  return with_etag(jsonify(serialize_location(location, fields=fields, bulbs_after_id=after_id, limit=limit)), etag)
 
 #ADD LOCATION
 @app.route('/api/a/location', methods=['POST'])
@@ -796,21 +1039,23 @@ def create_location():
   required_keys = [u'name']
   if not set(required_keys) <= set(content.keys()):
     return bad_request("Missing \"name\" attribute.")
+  group_ids = as_ids(content.get('group_ids', []))
+  bulb_ids = as_ids(content.get('bulb_ids', []))
+  if group_ids is None or bulb_ids is None:
+    return bad_request("Attributes \"group_ids\" and \"bulb_ids\" must be lists of integers.")
+  bulb_ids = [b for b in bulb_ids if allowed(current_identity.id, 'bulb', b, own=True)]
+  if bulb_ids:
+    #the bulbs move here: flush them from the hot store before the location joins the session
+    release_hot_state(Bulb.id.in_(bulb_ids))
   location = Location(name=content['name'], owner=current_identity, owner_id=current_identity.id)
-  if "group_ids" in content and type(content['group_ids']) is list:
+  if group_ids:
     groups = []
-    for g in content['group_ids']:
-      group = Group.query.get(g)
-      if group.owner_id == current_identity.id:
-        groups.append(group)
+    for g in group_ids:
+      if allowed(current_identity.id, 'group', g, own=True):
+        groups.append(Group.query.get(g))
     location.groups = groups
-  if "bulb_ids" in content and type(content['group_ids']) is list:
-    bulbs = []
-    for b in content['bulb_ids']:
-      bulb = Bulb.query.get(b)
-      if bulb.owner_id == current_identity.id:
-        bulbs.append(bulb)
-    location.bulbs = bulbs
+  if bulb_ids:
+    location.bulbs = [Bulb.query.get(b) for b in bulb_ids]
   db.session.add(location)
   db.session.commit()
   return created(location)
@@ -826,8 +1071,10 @@ def update_location():
   location = Location.query.get(content['id'])
   if location is None:
     return not_found()
-  if location.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'location', location.id, own=True):
     return bad_request("User does not have permission to update this location.")
+  #its bulbs may move or change hands: flush them from the hot store first
+  release_hot_state(Bulb.location_id == location.id)
   for key in content.keys():
     try:
       setattr(location, key, content[key])
@@ -848,8 +1095,9 @@ def delete_location():
   location = Location.query.get(content['id'])
   if location is None:
     return not_found()
-  if location.owner_id is not current_identity.id:
+  if not allowed(current_identity.id, 'location', location.id, own=True):
     return bad_request("User does not have permission to delete this location.")
+  release_hot_state(Bulb.location_id == location.id)
   db.session.delete(location)
   db.session.commit()
   return successfully_deleted()
@@ -862,10 +1110,24 @@ def delete_location():
 @app.route('/api/a/user/<int:id>', methods=['GET'])
 @jwt_required()
 def get_user(id):
-  user = User.query.get(id)
-  if user == None:
+  if id != current_identity.id:
+    return bad_request("User does not have permission to view this user.")
+  fields, after_id, limit = paging_args()
+  stamp = user_stamp(id)
+  if stamp == None:
     return not_found()
-  return jsonify(user.serialize())
+  etag = etag_for(stamp)
+  if is_fresh(etag):
+    return not_modified(etag)
+  user = User.query.get(id)
+  return with_etag(jsonify(serialize_user(user, fields=fields, bulbs_after_id=request.args.get('bulbs_after_id', after_id, type=int),
+    locations_after_id=request.args.get('locations_after_id', after_id, type=int), limit=limit)), etag)
+
+#EXPORT THE USER'S FLEET (STREAMED NDJSON: USER, LOCATIONS, GROUPS, BULBS, SHARED CONTROLS)
+@app.route('/api/a/export', methods=['GET'])
+@jwt_required()
+def export_fleet():
+  return export_response(current_identity.id)
 
 #ADD USER
 @app.route('/api/a/user', methods=['POST'])
@@ -898,12 +1160,17 @@ def update_user():
   required_keys = [u'id']
   if not set(required_keys) <= set(content.keys()):
     return bad_request("User ID as \"id\" is required to update a user.")
-  user = User.query.get(content['id'])
+  id = as_id(content['id'])
+  if id is None:
+    return bad_request("Attribute \"id\" must be an integer.")
+  if id != current_identity.id:
+    return bad_request("User does not have permission to update this user.")
+  user = User.query.get(id)
   if user is None:
     return not_found()
-  if user.id is not current_identity.id:
-    return bad_request("User does not have permission to update this user.")
   for key in content.keys():
+    if key == 'id':
+      continue
     try:
       setattr(user, key, content[key])
     except AttributeError:
@@ -920,51 +1187,95 @@ def delete_user():
   required_keys = [u'id']
   if not set(required_keys) <= set(content.keys()):
     return bad_request("User ID as \"id\" is required to delete a user.")
-  user = User.query.get(content['id'])
+  id = as_id(content['id'])
+  if id is None:
+    return bad_request("Attribute \"id\" must be an integer.")
+  if id != current_identity.id:
+    return bad_request("User does not have permission to delete this user.")
+  user = User.query.get(id)
   if user is None:
     return not_found()
-  if user.id is not current_identity.id:
-    return bad_request("User does not have permission to delete this user.")
   db.session.delete(user)
   db.session.commit()
   return successfully_deleted()
 
+###
+# CHANGE FEED
+###
+
+#CHANGES SINCE A CURSOR (PAGED; FOLLOW "cursor" WHILE "more" IS TRUE)
+@app.route('/api/a/changes', methods=['GET'])
+@jwt_required()
+def get_changes():
+  since = request.args.get('since', 0, type=int)
+  page_size = app.config.get('CHANGE_FEED_PAGE', 500)
+  limit = min(request.args.get('limit', page_size, type=int), page_size)
+  if since < 0 or limit < 1:
+    return bad_request("\"since\" must be a cursor from a previous response and \"limit\" positive.")
+  return jsonify(changes_since(current_identity.id, since, limit))
+
 ###
 # SCENES
 ###
+#SCENE PRESETS: A LIST OF {bulb_id, power, brightness} WITH AN INTEGER bulb_id;
+#power (true/false or 1/0) AND brightness (0 TO 100) MAY BE LEFT OUT TO KEEP THE CURRENT VALUE
+def valid_presets(presets):
+  if type(presets) is not list:
+    return False
+  for preset in presets:
+    if type(preset) is not dict or type(preset.get('bulb_id')) is not int:
+      return False
+    if preset.get('power') not in [None, True, False]:
+      return False
+    if preset.get('brightness') is not None and not valid_brightness(preset['brightness']):
+      return False
+  return True
+
 # --CREATE SCENE--#
+# captures the current state of every bulb in the location; "bulbs" presets override it
 @app.route('/api/a/scene', methods=['POST'])
-# @jwt_required
+@jwt_required()
 def create_scene():
   content = request.get_json(force=True)
-  required_keys = [u'name', u'bulbs']  # We Need Name and bulb_id to Create a Scene
+  required_keys = [u'name', u'location_id']
   if not set(required_keys) <= set(content.keys()):
-    return bad_request("Missing \"name\", \"bulb_ids\" in your Request")
-  if "bulb_ids" not in content or type(content['bulb_ids']) is not list:
-    return bad_request("A Scene Must Have Atleast one Bulb, with \"bulb_ids\".")
-  bulbs = []
-  for b in content['bulbs']:
-
-    bulb = Bulb.query.get(b.get('bulb_id'))
-    if (bulb.owner_id == current_identity.id) or (bulb.friend_id == current_identity.id):
-      # set a "brightness" and "color" fields
-
-      bulb.brightness = b.get('brightness')
-      bulb.color = b.get('color')
-      bulbs.append(bulb)
-
-    else:
-      return bad_request("User doesn\t have permission on bulb #" + b + " ")
-
-  scene = Scene(name=content(name), owner=current_identity, owner_id=current_identity.id, bulbs=bulbs)
-  db.session.add(scene)
-  db.session.commit()
+    return bad_request("Missing \"name\" or \"location_id\" in your Request")
+  if "bulbs" in content and not valid_presets(content['bulbs']):
+    return bad_request("Scene presets must be a list of {\"bulb_id\", \"power\", \"brightness\"} as \"bulbs\".")
+  location_id = as_id(content['location_id'])
+  if location_id is None:
+    return bad_request("Attribute \"location_id\" must be an integer.")
+  if not allowed(current_identity.id, 'location', location_id, own=True):
+    return bad_request("User does not have permission to create scenes on this location, or location does not exist.")
+  scene = capture_scene(current_identity.id, location_id, content['name'], content.get('bulbs'))
   return created(scene)
 
+# --GET SCENE--#
+@app.route('/api/a/scene/<int:id>', methods=['GET'])
+@jwt_required()
+def get_scene(id):
+  scene = Scene.query.get(id)
+  if scene is None:
+    return not_found()
+  if scene.owner_id != current_identity.id:
+    return bad_request("User does not have permission to view this scene.")
+  return jsonify(scene.serialize())
+
+# --APPLY SCENE--#
+@app.route('/api/a/scene/<int:id>/apply', methods=['POST'])
+@jwt_required()
+def apply_scene_presets(id):
+  scene = Scene.query.get(id)
+  if scene is None:
+    return not_found()
+  if scene.owner_id != current_identity.id:
+    return bad_request("User does not have permission to apply this scene.")
+  changed, elapsed = apply_scene(scene)
+  return jsonify({'id': scene.id, 'changed': changed, 'elapsed_ms': round(elapsed * 1000, 3)})
 
 # --DELETE SCENE--#
 @app.route('/api/a/scene', methods=['DELETE'])
-# @jwt_required
+@jwt_required()
 def delete_scene():
   content = request.get_json(force=True)
   required_keys = [u'id']
@@ -973,11 +1284,10 @@ def delete_scene():
   scene = Scene.query.get(content['id'])
   if scene is None:
     return not_found()
-  if scene.owner_id is not current_identity.id:
+  if scene.owner_id != current_identity.id:
     return bad_request("You don\t have permission to make a delete request")
-  db.session.delete(scene)
-  db.session.commit()
-  #return delete()
+  remove_scene(scene)
+  return successfully_deleted()
 
 
 # --UPDATE SCENE--#
@@ -995,9 +1305,87 @@ def update_scene():
     return bad_request("You are Not Allowed to Update")
 
 
+###
+# SCHEDULES
+###
+SCHEDULE_TARGETS = {'bulb': Bulb, 'group': Group, 'scene': Scene}
+
+# --CREATE SCHEDULE--#
+# fires "action" ('bulb', 'group' or 'scene') on "target_id" at unix time "fire_at",
+# then every "repeat_seconds" if given
+@app.route('/api/a/schedule', methods=['POST'])
+@jwt_required()
+def create_schedule():
+  content = request.get_json(force=True)
+  required_keys = [u'action', u'target_id', u'fire_at']
+  if not set(required_keys) <= set(content.keys()):
+    return bad_request("Missing \"action\", \"target_id\" or \"fire_at\" in your Request")
+  model = SCHEDULE_TARGETS.get(content['action']) if content['action'] in list(SCHEDULE_TARGETS) else None
+  if model is None:
+    return bad_request("Schedule action must be one of \"bulb\", \"group\" or \"scene\".")
+  power = content.get('power')
+  brightness = content.get('brightness')
+  if model is not Scene and power is None and brightness is None:
+    return bad_request("Bulb and group schedules need a \"power\" and/or \"brightness\".")
+  if power not in [None, True, False] or (brightness is not None and not valid_brightness(brightness)):
+    return bad_request("Attribute \"power\" must be true/false or 1/0, and \"brightness\" from 0 to 100.")
+  target_id = as_id(content['target_id'])
+  if target_id is None:
+    return bad_request("Attribute \"target_id\" must be an integer.")
+  fire_at = content['fire_at']
+  repeat_seconds = content.get('repeat_seconds')
+  if type(fire_at) is not int or (repeat_seconds is not None and (type(repeat_seconds) is not int or repeat_seconds < 1)):
+    return bad_request("Attribute \"fire_at\" must be a unix time, and \"repeat_seconds\" a positive integer.")
+  #scenes aren't in the access index; only their owner may use them
+  if model is Scene:
+    scene = Scene.query.get(target_id)
+    permitted = scene is not None and scene.owner_id == current_identity.id
+  else:
+    permitted = allowed(current_identity.id, content['action'], target_id, own=True)
+  if not permitted:
+    return bad_request("User does not have permission on this target, or it does not exist.")
+  schedule = Schedule(owner_id=current_identity.id, action=content['action'], target_id=target_id,
+    power=None if power is None else bool(power), brightness=brightness, fire_at=fire_at,
+    repeat_seconds=repeat_seconds, enabled=True)
+  db.session.add(schedule)
+  db.session.commit()
+  timer = scheduler()
+  if timer is not None:
+    timer.add(schedule.fire_at, schedule.id)
+  return created(schedule)
+
+# --GET SCHEDULE--#
+@app.route('/api/a/schedule/<int:id>', methods=['GET'])
+@jwt_required()
+def get_schedule(id):
+  schedule = Schedule.query.get(id)
+  if schedule is None:
+    return not_found()
+  if schedule.owner_id != current_identity.id:
+    return bad_request("User does not have permission to view this schedule.")
+  return jsonify(schedule.serialize())
+
+# --DELETE SCHEDULE--#
+@app.route('/api/a/schedule', methods=['DELETE'])
+@jwt_required()
+def delete_schedule():
+  content = request.get_json(force=True)
+  required_keys = [u'id']
+  if not set(required_keys) <= set(content.keys()):
+    return bad_request("schedule.id is required to delete this schedule")
+  schedule = Schedule.query.get(content['id'])
+  if schedule is None:
+    return not_found()
+  if schedule.owner_id != current_identity.id:
+    return bad_request("You don\'t have permission to make a delete request")
+  #its heap entry is skipped when it comes due
+  db.session.delete(schedule)
+  db.session.commit()
+  return successfully_deleted()
+
 # --CHANGE OWNER--#
 @app.route('/api/a/share/location', methods=['PUT'])
-# @jwt_required()
+@jwt_required()
 def add_friend():
   content = request.get_json(force=True)
   required_keys = [u'location_id', u'email']
@@ -1005,15 +1393,18 @@ def add_friend():
   if not set(required_keys) <= set(content.keys()):
       return bad_request("Please Enter the scene 'location_id' and 'email' to share location")
 
-  location = Location.query.get(int(content['location_id']))
+  location_id = as_id(content['location_id'])
+  if location_id is None:
+    return bad_request("Attribute \"location_id\" must be an integer.")
+  location = Location.query.get(location_id)
   user = User.query.filter_by(email=content['email']).first()
 
   if user:
     if location:
-        if location.owner_id is not current_identity.id:
-            return bad_request("You don\t have permission")
+        if not allowed(current_identity.id, 'location', location.id, own=True):
+            return bad_request("You don\'t have permission")
         else:
-          shared_ctrl = Shared_control(email=content['email'], location_id=int(content['location_id']))
+          shared_ctrl = Shared_control(email=content['email'], location_id=location_id)
           db.session.add(shared_ctrl)
           db.session.commit()
           return created(shared_ctrl)
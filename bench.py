@@ -0,0 +1,177 @@
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from app import app, db
+from app.models import User, Location, Bulb, Group, Schedule
+from app.state import set_bulbs_state, load_bulb_state, apply_bulb_rows
+from app.statestore import DeviceStateStore
+from app.dispatch import CommandDispatcher, UdpTransport
+from app.simulator import SimulatedFleet
+from app.scheduler import fire_schedules
+from app.storage import engine_options, read_only
+
+######################################################################################
+##
+## BENCHMARKS
+##
+##   python bench.py state --bulbs 300 --ops 5000
+##   python bench.py dispatch --bulbs 10000 --workers 32
+##   python bench.py schedule --bulbs 10000 --ops 20000
+##   python bench.py storage --readers 8 --writers 2 [--baseline]
+##
+######################################################################################
+
+#FRESH FILE DATABASE WITH ONE USER AND A FLEET OF BULBS
+def setup_fleet(bulbs, groups=1):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    db.create_all()
+    user = User(email='bench@example.com', nickname='bench', password='bench', confirmed=True)
+    db.session.add(user)
+    db.session.flush()
+    location = Location(name='Bench', owner_id=user.id)
+    db.session.add(location)
+    db.session.flush()
+    group_ids = []
+    for i in range(groups):
+        group = Group(name='Group %d' % i, owner_id=user.id, location_id=location.id)
+        db.session.add(group)
+        db.session.flush()
+        group_ids.append(group.id)
+    db.session.execute(Bulb.__table__.insert(), [{'name': 'Bulb %d' % i, 'bulb_type': 'life',
+        'owner_id': user.id, 'location_id': location.id, 'group_id': group_ids[i % groups],
+        'power': False, 'brightness': 10, 'version': 1} for i in range(bulbs)])
+    db.session.commit()
+    return path, [id for (id,) in db.session.query(Bulb.id)]
+
+def report(name, ops, elapsed):
+    print('%-28s %8d ops %8.3fs %10.0f ops/s' % (name, ops, elapsed, ops / max(elapsed, 1e-9)))
+
+def timed(name, ops, fn):
+    started = time.time()
+    for i in range(ops):
+        fn(i)
+    report(name, ops, time.time() - started)
+
+#STATE READS/WRITES: DIRECT SQLITE VS THE HOT STATE STORE
+def bench_state(args):
+    path, ids = setup_fleet(args.bulbs)
+    pick = lambda i: ids[i % len(ids)]
+    try:
+        timed('sqlite read', args.ops, lambda i: Bulb.query.get(pick(i)).serialize_state())
+        timed('sqlite write', args.ops, lambda i: set_bulbs_state(Bulb.id == pick(i),
+            brightness=random.randint(0, 100), states=False))
+        store = DeviceStateStore(load_bulb_state, apply_bulb_rows, journal_path=path + '.journal')
+        timed('store read', args.ops, lambda i: store.get(pick(i)))
+        timed('store write', args.ops, lambda i: store.set(pick(i), brightness=random.randint(0, 100)))
+        timed('store flush', 1, lambda i: store.flush())
+    finally:
+        db.session.remove()
+        for suffix in ('', '.journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+#FAN-OUT OF ONE COMMAND PER BULB TO A SIMULATED FLEET
+def bench_dispatch(args):
+    fleet = SimulatedFleet(port=args.port, ports=args.ports, loss=args.loss).start()
+    sender = CommandDispatcher(UdpTransport(lambda id: ('127.0.0.1', args.port + id % args.ports)),
+        workers=args.workers, queue_size=args.bulbs)
+    started = time.time()
+    for id in range(args.bulbs):
+        sender.submit({'id': id, 'power': True, 'brightness': 50, 'version': 1, 'sent_at': time.time()})
+    sender.join()
+    report('dispatch fan-out', args.bulbs, time.time() - started)
+    latencies = sorted(fleet.latencies)
+    for p in (50, 90, 99):
+        print('  p%d latency %.1fms' % (p, 1000 * latencies[min(len(latencies) - 1, len(latencies) * p // 100)]))
+    print('  %r' % sender.stats())
+
+#SCHEDULED ACTIONS: --ops actions spread over ten seconds, fired a second at a time
+def bench_schedule(args):
+    path, ids = setup_fleet(args.bulbs, groups=10)
+    try:
+        owner_id = User.query.first().id
+        db.session.execute(Schedule.__table__.insert(), [{'owner_id': owner_id, 'action': 'bulb',
+            'target_id': ids[i % len(ids)], 'power': i % 2 == 0, 'brightness': None, 'fire_at': i % 10,
+            'enabled': True} for i in range(args.ops)])
+        db.session.commit()
+        due = {}
+        for fire_at, id in db.session.query(Schedule.fire_at, Schedule.id):
+            due.setdefault(fire_at, []).append(id)
+        started = time.time()
+        for second in sorted(due):
+            fire_schedules(due[second], second)
+        report('scheduled actions', args.ops, time.time() - started)
+    finally:
+        db.session.remove()
+        os.remove(path)
+
+#CONCURRENT READERS AND WRITERS FOR --seconds; --baseline USES SQLITE'S DEFAULTS INSTEAD OF THE PROFILE
+def bench_storage(args):
+    if args.baseline:
+        app.config.update(SQLITE_WAL=False, SQLITE_READ_ROUTING=False, SQLITE_BUSY_TIMEOUT=5,
+            SQLITE_SYNCHRONOUS='FULL')
+    path, ids = setup_fleet(args.bulbs, groups=10)
+    counts = {'read': 0, 'write': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.time() + args.seconds
+    def work(kind):
+        with app.app_context():
+            while time.time() < deadline:
+                try:
+                    if kind == 'read':
+                        read_only()
+                        Bulb.query.filter(Bulb.group_id == random.randint(1, 10)).all()
+                    else:
+                        set_bulbs_state(Bulb.id == random.choice(ids), power=random.random() < 0.5, states=False)
+                    counter = kind
+                except Exception as e:
+                    db.session.rollback()
+                    if 'locked' not in str(e):
+                        raise
+                    counter = 'locked'
+                finally:
+                    db.session.remove()
+                with lock:
+                    counts[counter] += 1
+    threads = [threading.Thread(target=work, args=('read',)) for i in range(args.readers)] + \
+        [threading.Thread(target=work, args=('write',)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report('concurrent reads', counts['read'], args.seconds)
+    report('concurrent writes', counts['write'], args.seconds)
+    print('  %d "database is locked" errors' % counts['locked'])
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+BENCHMARKS = {
+    'state': bench_state,
+    'dispatch': bench_dispatch,
+    'schedule': bench_schedule,
+    'storage': bench_storage,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the device state paths.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--bulbs', type=int, default=300)
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--port', type=int, default=19999)
+    parser.add_argument('--ports', type=int, default=4)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--baseline', action='store_true')
+    args = parser.parse_args()
+    with app.app_context():
+        BENCHMARKS[args.benchmark](args)
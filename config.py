@@ -2,4 +2,95 @@
 WTF_CSRF_ENABLED = True
 SECRET_KEY = 'you-will-never-guess'
 
-SQLALCHEMY_DATABASE_URI = 'sqlite3:///'posts.db
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = 'sqlite:///posts.db'
+
+#SQLITE STORAGE PROFILE (app/storage.py): pragmas for every connection, pooling, read routing
+SQLITE_WAL = True #readers don't block the writer or each other
+SQLITE_SYNCHRONOUS = 'NORMAL' #durable in WAL except for the last commits on power loss; FULL to fsync every commit
+SQLITE_CACHE_SIZE_KB = 65536 #page cache per connection
+SQLITE_MMAP_SIZE = 268435456 #bytes of the file read through mmap
+SQLITE_BUSY_TIMEOUT = 30 #seconds a connection waits for the write lock before "database is locked"
+SQLITE_POOL_SIZE = 5 #write connections kept per worker process
+SQLITE_POOL_OVERFLOW = 10
+SQLITE_READ_ROUTING = True #GET requests read through a separate pool of query_only connections
+SQLITE_READ_POOL_SIZE = 10
+
+#HOT DEVICE-STATE STORE (app/statestore.py): serve bulb state from memory and write it behind
+STATE_STORE_ENABLED = False
+STATE_FLUSH_INTERVAL = 1.0 #seconds between batched writes to the bulb table
+STATE_JOURNAL = 'state.journal'
+STATE_JOURNAL_FSYNC = False #fsync every journaled write to also survive power loss
+
+#DEBOUNCED BRIGHTNESS (app/debounce.py): keep only the last slider value per bulb/group
+#within this many seconds and write them in one transaction. 0 (the default) writes every
+#change; 0.25 suits sliders
+BRIGHTNESS_DEBOUNCE_WINDOW = 0
+
+#SERVER-SENT EVENTS (app/events.py): seconds between keepalive comments on idle streams
+SSE_KEEPALIVE = 15
+
+#CHANGE FEED (app/changes.py): most changes returned per page of GET /api/a/changes
+CHANGE_FEED_PAGE = 500
+
+#DEVICE COMMAND DISPATCH (app/dispatch.py): send committed bulb changes to the bulbs
+DISPATCH_ENABLED = False
+DEVICE_GATEWAY = ('127.0.0.1', 9999) #python -m app.simulator listens here by default
+DEVICE_GATEWAY_PORTS = 1
+DISPATCH_WORKERS = 8
+DISPATCH_QUEUE_SIZE = 10000
+DISPATCH_RETRIES = 3
+DISPATCH_BACKOFF = 0.05 #seconds before the first retry, doubled for each one after
+DISPATCH_TIMEOUT = 0.5 #seconds to wait for a bulb's ack
+
+#SCHEDULER (app/scheduler.py): fire timed bulb/group/scene actions from the web process.
+#Leave it off when running several processes and run python -m app.scheduler once instead.
+SCHEDULER_ENABLED = False
+SCHEDULER_RELOAD = 30 #seconds between checks for schedules added by other processes
+
+#USER IDENTITY CACHE (app/identity.py): users looked up by JWT identity() and load_user
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 60 #seconds a cached user may be stale after a change made in another process
+
+#PASSWORD HASHING (app/passwords.py)
+BCRYPT_LOG_ROUNDS = 12 #existing hashes with another cost are redone at their next login
+PASSWORD_WORKERS = 2 #bcrypt processes; 0 hashes on the request thread
+PASSWORD_MAX_CONCURRENT = 8 #auth requests allowed to wait on the pool, the rest get a 503
+PASSWORD_TIMEOUT = 10
+
+#ACCESS CONTROL INDEX (app/acl.py): per-user ids of owned and shared locations, groups and bulbs
+ACL_INDEX_SIZE = 10000
+ACL_INDEX_TTL = 300 #seconds an index may be stale after a change made in another process
+
+#CACHED (id, name) CHOICES FOR THE LOCATION AND BULB DROPDOWNS (app/choices.py)
+CHOICE_CACHE_SIZE = 10000
+CHOICE_CACHE_TTL = 300 #seconds a list may be stale after a change made in another process
+
+#RENDERED DASHBOARD FRAGMENTS (app/fragments.py): 'memory', 'disk' or None
+FRAGMENT_CACHE = 'memory'
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_TTL = 300 #seconds a fragment may be stale after a change made in another process
+FRAGMENT_CACHE_DIR = 'fragments' #disk backend only; one directory per process
+
+#SQL INSTRUMENTATION (app/instrument.py): debug and test responses carry X-SQL-Count,
+#X-SQL-Time, X-SQL-Slowest-Time and X-SQL-Slowest headers; otherwise log one line per request
+SQL_LOG_REQUESTS = True
+
+#FLEET EXPORT (app/export.py): rows read and written per chunk of GET /api/a/export
+EXPORT_BATCH = 1000
+
+#PAGING (app/serializers.py): default and largest "limit" for collections paged by "after_id"
+PAGE_SIZE = 100
+PAGE_MAX = 1000
+
+#STATE HISTORY (app/history.py): batched append-only log of power/brightness changes, rolled up
+#into minute, hour and day buckets
+HISTORY_ENABLED = False
+HISTORY_BATCH = 500 #rows per insert
+HISTORY_FLUSH_INTERVAL = 1.0 #seconds a change may wait in the buffer
+HISTORY_MAINTENANCE_INTERVAL = 60 #seconds between rollup/retention passes; 0 leaves them to "python -m app.history maintain"
+HISTORY_ROLLUP_LAG = 10 #seconds a bucket stays open after it ends, for buffered changes to land
+HISTORY_RETENTION = 2 * 86400 #seconds raw rows are kept (they stay until the day rollup has them)
+HISTORY_ROLLUP_RETENTION = {'minute': 7 * 86400, 'hour': 400 * 86400, 'day': None}
+HISTORY_COMPACT_INTERVAL = 86400 #seconds between ANALYZE (and VACUUM) runs
+HISTORY_VACUUM_FREE_RATIO = 0.2 #VACUUM once this share of the database's pages is free
+HISTORY_MAX_BUCKETS = 1000 #range queries without a resolution use the finest one within this many buckets
@@ -1,17 +1,1292 @@
-from flask import Flask 
-from app import app
+from flask import Flask
+from app import app, db
+from app.models import User, Location, Bulb, Group, Schedule, Scene
+from app.state import set_bulbs_state, set_group_state, toggle_bulb, toggle_group, load_bulb_state, apply_bulb_rows
+from app.statestore import DeviceStateStore
+from app import state as app_state
+from app.debounce import BrightnessDebouncer
+from app.state import write_brightness
+from app.events import EventBroker, broker
+from app.dispatch import CommandDispatcher, UdpTransport
+from app.simulator import SimulatedFleet
+from app.scheduler import Scheduler, fire_schedules
+from app.cache import TTLCache, DiskCache
+from app.identity import user_cache
+from app import passwords
+from app.acl import access_index, allowed
+from app.storage import engine_options, read_engine
+from app.diagnostics import report as plan_report
+from app.migrate import add_missing_indexes
+from app.loader import BulkLoader, synthetic_fleet, read_records
+from app.choices import choice_cache, location_choices, bulb_choices
+from app.fragments import fragment_cache
+from app.views import control_done
+from app.history import HistoryLog, write_history, maintain, history_range, compact
+from app.models import State_history, State_rollup
+from app.models import Shared_control
+from sqlalchemy import event, inspect
+import json
+import multiprocessing
+import os
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 
 class FlaskTestCase(unittest.TestCase):
 
-	 def test_index(self):
-	     tester = app.test_client(self)
-	     response = tester.get('/login', content_type="html/text")
-	     self.assertEqual(response.status_code, 200)
+    def test_index(self):
+        tester = app.test_client(self)
+        response = tester.get('/login', content_type="html/text")
+        self.assertEqual(response.status_code, 200)
 
 
-     def test_login_page_loads(self):
-     	 tester = app.test_client(self) 
-     	 response = tester.get('/login', content-type="html/test")
-     	 self.assertTrue(b'Please Login' in response.data)
\ No newline at end of file
+    def test_login_page_loads(self):
+        tester = app.test_client(self)
+        response = tester.get('/login', content_type="html/test")
+        self.assertTrue(b'Please Login' in response.data)
+
+
+class ApiTestCase(unittest.TestCase):
+
+    database_uri = 'sqlite://'
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.database_uri
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(self.database_uri)
+        self.ctx = app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(email='owner@example.com', nickname='owner', password='secret', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+        self.tester = app.test_client(self)
+        response = self.tester.post('/auth', data=json.dumps({'username': 'owner@example.com', 'password': 'secret'}),
+            content_type='application/json')
+        self.headers = {'Authorization': 'JWT ' + json.loads(response.data)['access_token']}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def make_fleet(self, locations=3, bulbs=10):
+        for l in range(locations):
+            location = Location(name='Location %d' % l, owner_id=self.user.id)
+            db.session.add(location)
+            db.session.flush()
+            group = Group(name='Group %d' % l, owner_id=self.user.id, location_id=location.id)
+            db.session.add(group)
+            db.session.flush()
+            for b in range(bulbs):
+                db.session.add(Bulb(name='Bulb %d-%d' % (l, b), bulb_type='life', owner_id=self.user.id,
+                    location_id=location.id, group_id=group.id))
+        db.session.commit()
+
+    #STATEMENTS THE REQUEST RAN, FROM ITS X-SQL-Count HEADER
+    def count_queries(self, url, method='get', content=None):
+        kwargs = {'headers': self.headers}
+        if content is not None:
+            kwargs.update(data=json.dumps(content), content_type='application/json')
+        response = getattr(self.tester, method)(url, **kwargs)
+        self.assertTrue(response.status_code < 300, response.data)
+        return int(response.headers['X-SQL-Count'])
+
+    def assertQueryBudget(self, url, budget, method='get', content=None):
+        count = self.count_queries(url, method, content)
+        self.assertTrue(count <= budget, '%s %s ran %d statements, budget is %d' % (method.upper(), url, count, budget))
+
+class SerializeQueryCountTestCase(ApiTestCase):
+
+    #query counts must not grow with the number of bulbs
+    def assertConstantQueries(self, url_for_fleet):
+        self.make_fleet(locations=2, bulbs=2)
+        small = self.count_queries(url_for_fleet())
+        self.make_fleet(locations=4, bulbs=25)
+        large = self.count_queries(url_for_fleet())
+        self.assertEqual(small, large)
+
+    def test_get_user(self):
+        self.assertConstantQueries(lambda: '/api/a/user/%d' % self.user.id)
+
+    def test_get_location(self):
+        self.assertConstantQueries(lambda: '/api/a/location/%d' % Location.query.order_by(Location.id.desc()).first().id)
+
+    def test_get_group(self):
+        self.assertConstantQueries(lambda: '/api/a/group/%d' % Group.query.order_by(Group.id.desc()).first().id)
+
+    def test_get_bulb(self):
+        self.assertConstantQueries(lambda: '/api/a/bulb/%d' % Bulb.query.first().id)
+
+
+class BulkStateTestCase(ApiTestCase):
+
+    def post_state(self, content):
+        return self.tester.post('/api/a/bulbs/state', data=json.dumps(content),
+            content_type='application/json', headers=self.headers)
+
+    def test_switch_by_ids(self):
+        self.make_fleet(locations=1, bulbs=5)
+        ids = [b.id for b in Bulb.query.all()]
+        response = self.post_state({'bulb_ids': ids, 'state': 1, 'brightness': 40})
+        self.assertEqual(response.status_code, 200)
+        states = json.loads(response.data)['bulbs']
+        self.assertEqual([s['id'] for s in states], ids)
+        self.assertTrue(all(s['state']['state_bool'] for s in states))
+        self.assertEqual(set(b.brightness for b in Bulb.query.all()), set([40]))
+
+    def test_switch_by_location(self):
+        self.make_fleet(locations=2, bulbs=3)
+        location = Location.query.first()
+        response = self.post_state({'location_id': location.id, 'state': 1})
+        self.assertEqual(len(json.loads(response.data)['bulbs']), 3)
+        self.assertEqual(Bulb.query.filter_by(power=True).count(), 3)
+
+    def test_rejects_foreign_bulbs(self):
+        self.make_fleet(locations=1, bulbs=2)
+        ids = [b.id for b in Bulb.query.all()] + [9999]
+        response = self.post_state({'bulb_ids': ids, 'state': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Bulb.query.filter_by(power=True).count(), 0)
+
+    def test_ids_must_be_integers(self):
+        self.make_fleet(locations=1, bulbs=2)
+        location = Location.query.first()
+        for content in ({'bulb_ids': [[1]]}, {'bulb_ids': ['x']}, {'location_id': {'id': location.id}}):
+            response = self.post_state(dict(content, state=1))
+            self.assertEqual(response.status_code, 400)
+        for brightness in (-5, 1000, True):
+            self.assertEqual(self.post_state({'location_id': location.id, 'brightness': brightness}).status_code, 400)
+        #numeric strings are taken as ids
+        response = self.post_state({'location_id': str(location.id), 'state': 1})
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.post('/api/a/bulb', data=json.dumps({'name': 'New', 'location_id': [location.id],
+            'bulb_type': 'life'}), content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+
+
+class GroupStateTestCase(ApiTestCase):
+
+    def test_group_switch_is_constant_statements(self):
+        self.make_fleet(locations=1, bulbs=2)
+        small = Group.query.first().id
+        self.make_fleet(locations=1, bulbs=200)
+        large = Group.query.order_by(Group.id.desc()).first().id
+        counts = []
+        for group_id in (small, large):
+            statements = []
+            def record(conn, cursor, statement, parameters, context, executemany):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            set_group_state(group_id, power=True, brightness=55)
+            event.remove(db.engine, 'before_cursor_execute', record)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Bulb.query.filter_by(group_id=large, power=True, brightness=55).count(), 200)
+
+    def test_group_follows_last_bulb(self):
+        self.make_fleet(locations=1, bulbs=3)
+        group = Group.query.first()
+        bulbs = group.bulbs.order_by(Bulb.id).all()
+        set_bulbs_state(Bulb.id == bulbs[0].id, power=True)
+        set_bulbs_state(Bulb.id == bulbs[1].id, power=True)
+        self.assertFalse(Group.query.get(group.id).power)
+        set_bulbs_state(Bulb.id == bulbs[2].id, power=True)
+        self.assertTrue(Group.query.get(group.id).power)
+
+
+class ConcurrentToggleTestCase(ApiTestCase):
+
+    threads = 8
+    toggles = 25
+
+    def setUp(self):
+        #threads need their own connections to one database, so use a file
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.database_uri = 'sqlite:///' + self.path
+        super(ConcurrentToggleTestCase, self).setUp()
+        self.make_fleet(locations=1, bulbs=1)
+
+    def tearDown(self):
+        super(ConcurrentToggleTestCase, self).tearDown()
+        os.remove(self.path)
+
+    def hammer(self, toggle, target_id):
+        errors = []
+        def worker():
+            with app.app_context():
+                try:
+                    for i in range(self.toggles):
+                        toggle(target_id)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+        workers = [threading.Thread(target=worker) for i in range(self.threads)]
+        started = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - started
+        self.assertEqual(errors, [])
+        db.session.expire_all()
+        return self.threads * self.toggles / max(elapsed, 1e-6)
+
+    def test_bulb_toggles_are_not_lost(self):
+        bulb = Bulb.query.first()
+        rate = self.hammer(toggle_bulb, bulb.id)
+        bulb = Bulb.query.get(bulb.id)
+        total = self.threads * self.toggles
+        self.assertEqual(bulb.version, 1 + total)
+        self.assertEqual(bulb.power, total % 2 == 1)
+        self.assertEqual(Group.query.get(bulb.group_id).power, bulb.power)
+        self.assertTrue(rate > 0)
+
+    def test_group_toggles_are_not_lost(self):
+        group = Group.query.first()
+        rate = self.hammer(toggle_group, group.id)
+        group = Group.query.get(group.id)
+        total = self.threads * self.toggles
+        self.assertEqual(group.power, total % 2 == 1)
+        self.assertEqual(group.version, 1 + total)
+        self.assertEqual(set(b.power for b in group.bulbs), set([group.power]))
+        self.assertTrue(rate > 0)
+
+
+class HotStateStoreTestCase(ApiTestCase):
+
+    def setUp(self):
+        super(HotStateStoreTestCase, self).setUp()
+        self.journal = tempfile.mktemp(suffix='.journal')
+        self.make_fleet(locations=1, bulbs=3)
+        self.bulb = Bulb.query.first()
+
+    def tearDown(self):
+        for path in (self.journal, self.journal + '.flushing'):
+            if os.path.exists(path):
+                os.remove(path)
+        super(HotStateStoreTestCase, self).tearDown()
+
+    def stored_brightness(self):
+        db.session.expire_all()
+        return Bulb.query.get(self.bulb.id).brightness
+
+    def test_writes_are_coalesced_until_flush(self):
+        store = DeviceStateStore(load_bulb_state, apply_bulb_rows, journal_path=self.journal)
+        for value in range(20, 40):
+            store.set(self.bulb.id, brightness=value)
+        self.assertEqual(store.get(self.bulb.id)['brightness'], 39)
+        self.assertEqual(self.stored_brightness(), 10)
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(self.stored_brightness(), 39)
+        self.assertEqual(Bulb.query.get(self.bulb.id).version, 21)
+
+    def test_compare_and_swap(self):
+        store = DeviceStateStore(load_bulb_state, apply_bulb_rows)
+        self.assertTrue(store.set(self.bulb.id, power=1, version=1))
+        self.assertEqual(store.set(self.bulb.id, power=0, version=1), None)
+
+    #THE APP'S STORE; ITS FLUSH THREAD SLEEPS THROUGH THE TEST
+    def enable_store(self):
+        app.config.update(STATE_STORE_ENABLED=True, STATE_JOURNAL=self.journal, STATE_FLUSH_INTERVAL=3600)
+        app_state._store = None
+        def disable():
+            app.config['STATE_STORE_ENABLED'] = False
+            app_state._store = None
+        self.addCleanup(disable)
+        return app_state.hot_store()
+
+    def test_orm_writes_release_the_store(self):
+        store = self.enable_store()
+        friend = User(email='friend@example.com', nickname='friend', password='secret', confirmed=True)
+        db.session.add(friend)
+        db.session.commit()
+        store.set(self.bulb.id, brightness=50)
+        response = self.tester.patch('/api/a/bulb', data=json.dumps({'id': self.bulb.id, 'owner_id': friend.id}),
+            content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 200, response.data)
+        #the pending write landed first, and the store reloads the new owner
+        self.assertEqual(self.stored_brightness(), 50)
+        self.assertEqual(store.get(self.bulb.id)['owner_id'], friend.id)
+        with self.tester.session_transaction() as sess:
+            sess['user_id'] = sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+        response = self.tester.post('/bulb/%d/dim' % self.bulb.id, data={'brightness': '5'},
+            headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(store.get(self.bulb.id)['brightness'], 50)
+
+    def test_deleted_bulbs_leave_the_store(self):
+        store = self.enable_store()
+        self.assertTrue(store.get(self.bulb.id))
+        response = self.tester.delete('/api/a/bulb', data=json.dumps({'id': self.bulb.id}),
+            content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 204, response.data)
+        self.assertEqual(store.get(self.bulb.id), None)
+
+    def test_refused_writes_leave_the_store_alone(self):
+        store = self.enable_store()
+        stranger = User(email='stranger@example.com', nickname='stranger', password='secret', confirmed=True)
+        db.session.add(stranger)
+        db.session.commit()
+        response = self.tester.post('/auth', data=json.dumps({'username': 'stranger@example.com', 'password': 'secret'}),
+            content_type='application/json')
+        headers = {'Authorization': 'JWT ' + json.loads(response.data)['access_token']}
+        store.set(self.bulb.id, brightness=50)
+        for url, content in (('/api/a/bulb', {'id': self.bulb.id}), ('/api/a/location', {'id': self.bulb.location_id})):
+            response = self.tester.delete(url, data=json.dumps(content), content_type='application/json', headers=headers)
+            self.assertEqual(response.status_code, 400)
+        #nothing was flushed or evicted on their behalf
+        self.assertEqual(self.stored_brightness(), 10)
+        self.assertEqual(store.get(self.bulb.id)['brightness'], 50)
+
+    def test_pending_bulbs_gone_from_the_store_are_skipped(self):
+        self.enable_store()
+        with app.test_request_context('/bulb/9999/dim', method='POST', headers={'X-Requested-With': 'XMLHttpRequest'}):
+            response = control_done(pending={('bulb', 9999): {'brightness': 5}})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.get_data())['changes'], [])
+
+    def test_fragments_are_bumped_once_flushed(self):
+        store = self.enable_store()
+        cache = fragment_cache()
+        location_id = self.bulb.location_id
+        version = cache.version(location_id)
+        store.set(self.bulb.id, brightness=70)
+        #a render now would still read the old brightness from the database
+        self.assertEqual(cache.version(location_id), version)
+        store.flush()
+        self.assertEqual(cache.version(location_id), version + 1)
+
+    def test_store_writes_reach_the_change_feed(self):
+        store = self.enable_store()
+        def changes(since):
+            response = self.tester.get('/api/a/changes?since=%d' % since, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.data)
+        cursor = changes(0)['cursor']
+        response = self.tester.post('/api/a/bulb/%d/power' % self.bulb.id, data=json.dumps({'state': 1}),
+            content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        store.set(self.bulb.id, brightness=60)
+        store.flush()
+        feed = changes(cursor)
+        bulbs = [c for c in feed['changes'] if c['entity'] == 'bulb']
+        self.assertEqual([c['id'] for c in bulbs], [self.bulb.id])
+        self.assertEqual(bulbs[0]['data']['brightness'], 60)
+
+    def test_journal_is_replayed_after_crash(self):
+        store = DeviceStateStore(load_bulb_state, apply_bulb_rows, journal_path=self.journal)
+        store.set(self.bulb.id, power=1, brightness=77)
+        #no flush: a new process finds the journal and applies it
+        DeviceStateStore(load_bulb_state, apply_bulb_rows, journal_path=self.journal)
+        self.assertEqual(self.stored_brightness(), 77)
+        self.assertTrue(Bulb.query.get(self.bulb.id).power)
+
+
+class BrightnessDebounceTestCase(ApiTestCase):
+
+    def test_latest_value_wins(self):
+        self.make_fleet(locations=1, bulbs=2)
+        bulb = Bulb.query.first()
+        debouncer = BrightnessDebouncer(60, write_brightness)
+        for value in range(30):
+            debouncer.submit('bulb', bulb.id, value)
+        self.assertEqual(debouncer.flush(), 1)
+        self.assertEqual(debouncer.stats()['absorbed'], 29)
+        db.session.expire_all()
+        self.assertEqual(Bulb.query.get(bulb.id).brightness, 29)
+
+    def test_group_after_bulb_overrides_it(self):
+        self.make_fleet(locations=1, bulbs=2)
+        group = Group.query.first()
+        bulb = group.bulbs.first()
+        debouncer = BrightnessDebouncer(60, write_brightness)
+        debouncer.submit('bulb', bulb.id, 90)
+        debouncer.submit('group', group.id, 20)
+        debouncer.flush()
+        db.session.expire_all()
+        self.assertEqual(set(b.brightness for b in group.bulbs), set([20]))
+
+
+    def test_failed_writes_stay_pending(self):
+        written = []
+        def writer(items):
+            if not written:
+                written.append(None)
+                raise Exception('database is locked')
+            written.append(items)
+        debouncer = BrightnessDebouncer(60, writer)
+        debouncer.submit('bulb', 1, 10)
+        debouncer.submit('bulb', 2, 20)
+        self.assertRaises(Exception, debouncer.flush)
+        self.addCleanup(lambda: debouncer.timer and debouncer.timer.cancel())
+        #submitted while the write was failing: newer than what it held
+        debouncer.submit('bulb', 1, 15)
+        self.assertEqual(debouncer.stats()['pending'], 2)
+        self.assertEqual(debouncer.flush(), 2)
+        self.assertEqual(written[1], [('bulb', 2, 20), ('bulb', 1, 15)])
+        self.assertEqual(debouncer.stats()['failed'], 1)
+
+class EventStreamTestCase(ApiTestCase):
+
+    def test_commits_publish_state_events(self):
+        self.make_fleet(locations=1, bulbs=2)
+        bulb = Bulb.query.first()
+        after = broker.sequence
+        toggle_bulb(bulb.id)
+        sequence, events = broker.wait(after, 0)
+        bulbs = [e for e in events if e['type'] == 'bulb']
+        self.assertEqual([e['id'] for e in bulbs], [bulb.id])
+        self.assertTrue(bulbs[0]['state']['state_bool'])
+
+    def test_rollback_publishes_nothing(self):
+        self.make_fleet(locations=1, bulbs=1)
+        after = broker.sequence
+        set_bulbs_state(Bulb.id == Bulb.query.first().id, power=True, commit=False)
+        db.session.rollback()
+        self.assertEqual(broker.wait(after, 0), (after, []))
+
+    def test_slow_subscriber_is_told_to_resync(self):
+        log = EventBroker(size=2)
+        log.publish([{'n': n} for n in range(10)])
+        self.assertEqual(log.wait(0, 0), (10, None))
+        self.assertEqual(log.wait(8, 0), (10, [{'n': 8}, {'n': 9}]))
+
+
+class ChangeFeedTestCase(ApiTestCase):
+
+    def get_changes(self, since, limit=500):
+        response = self.tester.get('/api/a/changes?since=%d&limit=%d' % (since, limit), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_only_deltas_after_cursor(self):
+        self.make_fleet(locations=2, bulbs=5)
+        cursor = self.get_changes(0)['cursor']
+        bulb = Bulb.query.first()
+        set_bulbs_state(Bulb.id == bulb.id, brightness=80)
+        feed = self.get_changes(cursor)
+        bulbs = [c for c in feed['changes'] if c['entity'] == 'bulb']
+        self.assertEqual([c['id'] for c in bulbs], [bulb.id])
+        self.assertEqual(bulbs[0]['data']['brightness'], 80)
+        self.assertEqual(self.get_changes(feed['cursor'])['changes'], [])
+
+    def test_deletes_are_reported(self):
+        self.make_fleet(locations=1, bulbs=2)
+        cursor = self.get_changes(0)['cursor']
+        bulb = Bulb.query.first()
+        bulb_id = bulb.id
+        db.session.delete(bulb)
+        db.session.commit()
+        changes = self.get_changes(cursor)['changes']
+        self.assertEqual([(c['entity'], c['id'], c['op']) for c in changes], [('bulb', bulb_id, 'delete')])
+
+    def test_pages_are_bounded(self):
+        self.make_fleet(locations=1, bulbs=10)
+        first = self.get_changes(0, limit=4)
+        self.assertTrue(first['more'])
+        self.assertTrue(len(first['changes']) <= 4)
+        self.assertTrue(self.get_changes(first['cursor'], limit=500)['changes'])
+
+
+class DispatchTestCase(unittest.TestCase):
+
+    def test_fan_out_reaches_every_bulb_despite_loss(self):
+        fleet = SimulatedFleet(port=19899, ports=2, loss=0.1).start()
+        sender = CommandDispatcher(UdpTransport(lambda id: ('127.0.0.1', 19899 + id % 2), timeout=0.1),
+            workers=8, retries=10, backoff=0.001)
+        for version in (1, 2):
+            for id in range(200):
+                sender.submit({'id': id, 'power': True, 'brightness': 10, 'version': version})
+        sender.join()
+        self.assertEqual(sender.stats()['failed'], 0)
+        self.assertEqual(set(fleet.state(id)['version'] for id in range(200)), set([2]))
+
+    def test_latest_command_wins_while_queued(self):
+        release = threading.Event()
+        sent = []
+        class Blocking(object):
+            def send(self, command):
+                release.wait()
+                sent.append(command)
+        sender = CommandDispatcher(Blocking(), workers=1)
+        sender.submit({'id': 1, 'version': 1})
+        time.sleep(0.05)
+        for version in range(2, 10):
+            sender.submit({'id': 1, 'version': version})
+        release.set()
+        sender.join()
+        self.assertEqual([c['version'] for c in sent], [1, 9])
+        self.assertEqual(sender.stats()['coalesced'], 7)
+
+
+class SceneTestCase(ApiTestCase):
+
+    def post(self, url, content):
+        response = self.tester.post(url, data=json.dumps(content), content_type='application/json', headers=self.headers)
+        return response.status_code, json.loads(response.data)
+
+    def apply(self, scene_id):
+        response = self.tester.post('/api/a/scene/%d/apply' % scene_id, data='{}', content_type='application/json',
+            headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['changed'], int(response.headers['X-SQL-Count'])
+
+    def test_capture_and_apply_only_writes_differences(self):
+        counts = []
+        for bulbs, moved in ((5, 2), (500, 7)):
+            self.make_fleet(locations=1, bulbs=bulbs)
+            location = Location.query.order_by(Location.id.desc()).first()
+            set_bulbs_state(Bulb.location_id == location.id, power=True, brightness=60)
+            status, scene = self.post('/api/a/scene', {'name': 'Evening', 'location_id': location.id})
+            self.assertEqual(status, 201)
+            self.assertEqual(len(scene['entries']), bulbs)
+            ids = [b.id for b in Bulb.query.filter_by(location_id=location.id).order_by(Bulb.id).limit(moved)]
+            set_bulbs_state(Bulb.id.in_(ids), power=False, brightness=30)
+            versions = dict(db.session.query(Bulb.id, Bulb.version).filter_by(location_id=location.id))
+            changed, count = self.apply(scene['id'])
+            counts.append(count)
+            self.assertEqual(sorted(changed), ids)
+            db.session.expire_all()
+            for bulb in Bulb.query.filter_by(location_id=location.id):
+                self.assertEqual((bulb.power, bulb.brightness), (True, 60))
+                #bulbs already in the scene's state are not written
+                self.assertEqual(bulb.version, versions[bulb.id] + (1 if bulb.id in ids else 0))
+        #statements don't grow with the scene
+        self.assertEqual(counts[0], counts[1])
+
+    def test_presets_override_captured_state(self):
+        self.make_fleet(locations=1, bulbs=3)
+        location = Location.query.first()
+        bulb = Bulb.query.first()
+        status, scene = self.post('/api/a/scene', {'name': 'Reading', 'location_id': location.id,
+            'bulbs': [{'bulb_id': bulb.id, 'power': True, 'brightness': 95}]})
+        status, result = self.post('/api/a/scene/%d/apply' % scene['id'], {})
+        self.assertEqual(result['changed'], [bulb.id])
+        db.session.expire_all()
+        self.assertEqual(Bulb.query.get(bulb.id).brightness, 95)
+
+    def test_bulbs_that_left_are_not_applied(self):
+        self.make_fleet(locations=2, bulbs=3)
+        first, second = Location.query.order_by(Location.id).all()
+        status, scene = self.post('/api/a/scene', {'name': 'Night', 'location_id': first.id})
+        moved, given = Bulb.query.filter_by(location_id=first.id).order_by(Bulb.id).limit(2).all()
+        moved.location_id = second.id
+        other = User(email='other@example.com', nickname='other', password='secret', confirmed=True)
+        db.session.add(other)
+        db.session.flush()
+        given.owner_id = other.id
+        db.session.commit()
+        set_bulbs_state(Bulb.id.in_([moved.id, given.id]), power=True)
+        status, result = self.post('/api/a/scene/%d/apply' % scene['id'], {})
+        self.assertEqual(result['changed'], [])
+        self.assertEqual(Bulb.query.filter_by(power=True).count(), 2)
+
+    def test_malformed_presets_are_rejected(self):
+        self.make_fleet(locations=1, bulbs=1)
+        location = Location.query.first()
+        bulb = Bulb.query.first()
+        for presets in ([bulb.id], [{'power': True}], [{'bulb_id': bulb.id, 'brightness': 'dim'}], {'bulb_id': bulb.id}):
+            status, result = self.post('/api/a/scene', {'name': 'Bad', 'location_id': location.id, 'bulbs': presets})
+            self.assertEqual(status, 400)
+        self.assertEqual(Scene.query.count(), 0)
+
+
+class SchedulerTestCase(ApiTestCase):
+
+    def test_heap_pops_only_due_entries(self):
+        fired = []
+        timer = Scheduler(lambda after: [], lambda ids, now: fired.append((now, ids)) or [])
+        for fire_at, id in [(30, 3), (10, 1), (10, 2), (20, 4)]:
+            timer.add(fire_at, id)
+        self.assertEqual(timer.run_once(5), 0)
+        self.assertEqual(timer.run_once(10), 2)
+        self.assertEqual(timer.run_once(25), 1)
+        self.assertEqual(fired, [(10, [1, 2]), (25, [4])])
+        self.assertEqual(timer.stats()['next'], 30)
+
+    def test_failed_batches_are_retried_with_backoff(self):
+        outcomes = [Exception('database is locked'), Exception('database is locked'), None]
+        fired = []
+        def fire(ids, now):
+            fired.append((now, ids))
+            outcome = outcomes.pop(0)
+            if outcome is not None:
+                raise outcome
+            return []
+        timer = Scheduler(lambda after: [], fire, retry_delay=5)
+        timer.add(10, 1)
+        timer.add(10, 2)
+        self.assertEqual(timer.run_once(10), 0)
+        self.assertEqual(timer.stats()['next'], 15)
+        self.assertEqual(timer.run_once(15), 0)
+        self.assertEqual(timer.stats()['next'], 25)
+        self.assertEqual(timer.run_once(20), 0)
+        self.assertEqual(timer.run_once(25), 2)
+        self.assertEqual(fired, [(10, [1, 2]), (15, [1, 2]), (25, [1, 2])])
+        self.assertEqual(timer.stats()['failed'], 2)
+        self.assertEqual(timer.attempts, {})
+
+    def test_schedule_bodies_are_validated(self):
+        self.make_fleet(locations=1, bulbs=1)
+        bulb = Bulb.query.first()
+        def create(**content):
+            body = dict({'action': 'bulb', 'target_id': bulb.id, 'fire_at': 100, 'power': True}, **content)
+            return self.tester.post('/api/a/schedule', data=json.dumps(body), content_type='application/json',
+                headers=self.headers).status_code
+        for bad in ({'fire_at': 'soon'}, {'target_id': [bulb.id]}, {'power': 'on'}, {'brightness': 1000},
+                {'repeat_seconds': -60}, {'repeat_seconds': '60'}, {'action': ['bulb']}, {'target_id': 9999}):
+            self.assertEqual(create(**bad), 400, bad)
+        self.assertEqual(Schedule.query.count(), 0)
+        self.assertEqual(create(power=1, brightness=40, repeat_seconds=60), 201)
+        self.assertEqual(Schedule.query.one().power, True)
+
+    def test_same_second_actions_are_one_write(self):
+        self.make_fleet(locations=1, bulbs=50)
+        ids = [b.id for b in Bulb.query]
+        for id in ids:
+            db.session.add(Schedule(owner_id=self.user.id, action='bulb', target_id=id, power=True,
+                fire_at=100, enabled=True))
+        repeating = Schedule(owner_id=self.user.id, action='group', target_id=Group.query.first().id,
+            brightness=40, fire_at=100, repeat_seconds=60, enabled=True)
+        db.session.add(repeating)
+        db.session.commit()
+        updates = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE bulb'):
+                updates.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            again = fire_schedules([s.id for s in Schedule.query], 230)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(again, [(280, repeating.id)])
+        self.assertEqual(Bulb.query.filter_by(power=True, brightness=40).count(), 50)
+        self.assertEqual(Schedule.query.filter_by(enabled=True).count(), 1)
+
+
+class UserCacheTestCase(ApiTestCase):
+
+    def test_expiry_and_lru_bound(self):
+        now = [0]
+        cache = TTLCache(size=2, ttl=10, clock=lambda: now[0])
+        for key in (1, 2, 1, 3):
+            cache.get(key, lambda key: key * 10)
+        self.assertEqual(sorted(cache.entries.keys()), [1, 3])
+        now[0] = 11
+        self.assertEqual(cache.get(1, lambda key: 'reloaded'), 'reloaded')
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_identity_is_served_from_cache_until_changed(self):
+        user_cache().clear()
+        uncached = self.count_queries('/api/a/stats')
+        queries = self.count_queries('/api/a/stats')
+        self.assertEqual(queries, uncached - 1)
+        response = self.tester.patch('/api/a/user', data=json.dumps({'id': self.user.id, 'nickname': 'renamed'}),
+            content_type='application/json', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.count_queries('/api/a/stats'), queries + 1)
+        stats = json.loads(self.tester.get('/api/a/stats', headers=self.headers).data)['user_cache']
+        self.assertTrue(stats['hits'] >= 3)
+        self.assertTrue(stats['invalidated'] >= 1)
+
+    def test_cached_identity_owns_large_ids(self):
+        user = User(id=1000, email='late@example.com', nickname='late', password='secret', confirmed=True)
+        db.session.add(user)
+        db.session.commit()
+        response = self.tester.post('/auth', data=json.dumps({'username': 'late@example.com', 'password': 'secret'}),
+            content_type='application/json')
+        headers = {'Authorization': 'JWT ' + json.loads(response.data)['access_token']}
+        for content in ({'id': 1000, 'nickname': 'renamed'}, {'id': '1000', 'nickname': 'again'}):
+            response = self.tester.patch('/api/a/user', data=json.dumps(content), content_type='application/json',
+                headers=headers)
+            self.assertEqual(response.status_code, 200)
+        response = self.tester.delete('/api/a/user', data=json.dumps({'id': self.user.id}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.tester.delete('/api/a/user', data=json.dumps({'id': 1000}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 204)
+
+
+class PasswordTestCase(ApiTestCase):
+
+    def auth(self):
+        return self.tester.post('/auth', data=json.dumps({'username': 'owner@example.com', 'password': 'secret'}),
+            content_type='application/json')
+
+    def test_login_upgrades_hash_cost(self):
+        rounds = app.config.get('BCRYPT_LOG_ROUNDS')
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        try:
+            self.assertEqual(self.auth().status_code, 200)
+            db.session.expire_all()
+            self.assertEqual(passwords.hash_rounds(User.query.get(self.user.id).password), 5)
+            self.assertEqual(self.auth().status_code, 200)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+    def test_saturated_pool_rejects_fast(self):
+        slots = passwords._slots
+        passwords._slots = threading.BoundedSemaphore(1)
+        passwords._slots.acquire()
+        try:
+            started = time.time()
+            response = self.auth()
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertTrue(time.time() - started < 0.5)
+        finally:
+            passwords._slots = slots
+
+    def test_slow_pool_is_busy(self):
+        class Result(object):
+            def get(self, timeout):
+                raise multiprocessing.TimeoutError()
+        class Pool(object):
+            def apply_async(self, fn, args, callback=None):
+                self.callback = callback
+                return Result()
+        pool, slots = passwords._pool, passwords._slots
+        passwords._pool, passwords._slots = Pool(), threading.BoundedSemaphore(1)
+        try:
+            response = self.auth()
+            self.assertEqual(response.status_code, 503)
+            #the task still runs: its slot is held until it finishes
+            self.assertFalse(passwords._slots.acquire(False))
+            passwords._pool.callback((True, False))
+            self.assertTrue(passwords._slots.acquire(False))
+        finally:
+            passwords._pool, passwords._slots = pool, slots
+
+
+class AccessIndexTestCase(ApiTestCase):
+
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        access_index().clear()
+        self.make_fleet(locations=2, bulbs=3)
+        self.friend = User(email='friend@example.com', nickname='friend', password='secret', confirmed=True)
+        db.session.add(self.friend)
+        db.session.commit()
+        self.shared, self.private = [l.id for l in Location.query.order_by(Location.id)]
+
+    def test_grant_gives_control_but_not_ownership(self):
+        bulb = Bulb.query.filter_by(location_id=self.shared).first()
+        self.assertFalse(allowed(self.friend.id, 'bulb', bulb.id))
+        db.session.add(Shared_control(email='friend@example.com', location_id=self.shared))
+        db.session.commit()
+        self.assertTrue(allowed(self.friend.id, 'bulb', bulb.id))
+        self.assertTrue(allowed(self.friend.id, 'location', self.shared))
+        self.assertFalse(allowed(self.friend.id, 'bulb', bulb.id, own=True))
+        self.assertFalse(allowed(self.friend.id, 'location', self.private))
+        self.assertTrue(allowed(self.user.id, 'bulb', bulb.id, own=True))
+
+    def test_grants_are_made_through_the_api(self):
+        def share(location_id, headers):
+            return self.tester.put('/api/a/share/location', data=json.dumps({'location_id': location_id,
+                'email': 'friend@example.com'}), content_type='application/json', headers=headers).status_code
+        bulb = Bulb.query.filter_by(location_id=self.shared).first()
+        allowed(self.friend.id, 'bulb', bulb.id)
+        self.assertEqual(share('x', self.headers), 400)
+        self.assertEqual(share(self.shared, {}), 401)
+        self.assertEqual(share(str(self.shared), self.headers), 201)
+        self.assertTrue(allowed(self.friend.id, 'bulb', bulb.id))
+        self.assertFalse(allowed(self.friend.id, 'location', self.private))
+
+    def test_only_affected_users_are_invalidated(self):
+        allowed(self.user.id, 'bulb', 1)
+        allowed(self.friend.id, 'bulb', 1)
+        bulb = Bulb.query.filter_by(location_id=self.private).first()
+        bulb.location_id = self.shared
+        bulb.friend_id = self.friend.id
+        db.session.commit()
+        self.assertEqual(sorted(access_index().entries.keys()), [])
+        allowed(self.user.id, 'bulb', 1)
+        allowed(self.friend.id, 'bulb', 1)
+        set_bulbs_state(Bulb.location_id == self.shared, power=True)
+        self.assertEqual(access_index().stats()['invalidated'], 2)
+        self.assertTrue(allowed(self.friend.id, 'bulb', bulb.id))
+
+    def test_shared_user_can_control_but_not_delete(self):
+        db.session.add(Shared_control(email='friend@example.com', location_id=self.shared))
+        db.session.commit()
+        bulb = Bulb.query.filter_by(location_id=self.shared).first()
+        response = self.tester.post('/auth', data=json.dumps({'username': 'friend@example.com', 'password': 'secret'}),
+            content_type='application/json')
+        headers = {'Authorization': 'JWT ' + json.loads(response.data)['access_token']}
+        response = self.tester.post('/api/a/bulb/%d/power' % bulb.id, data=json.dumps({'state': 1}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.tester.delete('/api/a/bulb', data=json.dumps({'id': bulb.id}),
+            content_type='application/json', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class StorageProfileTestCase(ApiTestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.database_uri = 'sqlite:///' + self.path
+        super(StorageProfileTestCase, self).setUp()
+        self.make_fleet(locations=1, bulbs=2)
+
+    def tearDown(self):
+        super(StorageProfileTestCase, self).tearDown()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def reads_during(self, method, url, content=None):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(read_engine(), 'before_cursor_execute', record)
+        try:
+            response = getattr(self.tester, method)(url, data=json.dumps(content or {}),
+                content_type='application/json', headers=self.headers)
+        finally:
+            event.remove(read_engine(), 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, 200)
+        return statements
+
+    def test_pragmas(self):
+        self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(db.engine.execute('PRAGMA busy_timeout').scalar(), 1000 * app.config.get('SQLITE_BUSY_TIMEOUT', 30))
+
+    def test_gets_read_from_read_connections(self):
+        bulb = Bulb.query.first()
+        self.assertTrue(self.reads_during('get', '/api/a/bulb/%d' % bulb.id))
+        self.assertEqual(self.reads_during('post', '/api/a/bulb/%d/power' % bulb.id, {'state': 1}), [])
+        self.assertRaises(Exception, read_engine().execute, 'UPDATE bulb SET power = 0')
+
+
+class IndexUsageTestCase(ApiTestCase):
+
+    def test_known_queries_do_not_scan(self):
+        out = StringIO()
+        self.assertEqual(plan_report(out), 0, out.getvalue())
+
+    def test_migration_adds_missing_indexes(self):
+        db.engine.execute('DROP INDEX ix_bulb_owner_location')
+        add_missing_indexes(db.engine)
+        names = [row[1] for row in db.engine.execute("PRAGMA index_list('bulb')")]
+        self.assertIn('ix_bulb_owner_location', names)
+
+
+class QueryBudgetTestCase(ApiTestCase):
+
+    def test_api_routes_stay_within_budget(self):
+        self.make_fleet(locations=3, bulbs=20)
+        bulb = Bulb.query.first()
+        group = Group.query.first()
+        location = Location.query.first()
+        #identity and access index are cached after the first request
+        self.count_queries('/api/a/bulb/%d' % bulb.id)
+        #resource GETs include their ETag stamp queries
+        budgets = [
+            ('/api/a/bulb/%d' % bulb.id, 4, 'get', None),
+            ('/api/a/bulb/%d/power' % bulb.id, 1, 'get', None),
+            ('/api/a/group/%d' % group.id, 7, 'get', None),
+            ('/api/a/location/%d' % location.id, 5, 'get', None),
+            ('/api/a/user/%d' % self.user.id, 9, 'get', None),
+            ('/api/a/changes', 8, 'get', None),
+            ('/api/a/bulbs/state', 12, 'post', {'location_id': location.id, 'state': 1}),
+        ]
+        for url, budget, method, content in budgets:
+            self.assertQueryBudget(url, budget, method, content)
+
+    def test_slowest_statement_is_reported(self):
+        response = self.tester.get('/api/a/user/%d' % self.user.id, headers=self.headers)
+        self.assertTrue(response.headers['X-SQL-Slowest'].startswith('SELECT'))
+        self.assertTrue(float(response.headers['X-SQL-Time']) >= float(response.headers['X-SQL-Slowest-Time']))
+
+
+class BulkLoaderTestCase(ApiTestCase):
+
+    def test_synthetic_fleet_loads_in_batches(self):
+        inserts = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT'):
+                inserts.append(executemany)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            with BulkLoader(db.engine, batch_size=100, workers=0, rounds=4) as loader:
+                loader.load(synthetic_fleet(5, locations=2, groups=3, bulbs=20, first_id=100))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(Bulb.query.count(), 5 * 2 * 3 * 20)
+        self.assertEqual(Group.query.filter(Group.location_id == Location.query.get(100).id).count(), 3)
+        self.assertTrue(all(inserts))
+        self.assertTrue(len(inserts) < 15)
+        self.assertTrue(loader.stats()['rows_per_second'] > 0)
+        self.assertTrue(passwords.check_password(User.query.get(100).password, 'secret'))
+
+    def test_csv_records(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('type,id,name,owner_id,location_id,power\n')
+            f.write('location,7,Attic,%d,,\n' % self.user.id)
+            f.write('bulb,9,Lamp,%d,7,true\n' % self.user.id)
+        try:
+            with BulkLoader(db.engine, workers=0) as loader:
+                loader.load(read_records(path))
+        finally:
+            os.remove(path)
+        self.assertEqual(Bulb.query.get(9).location_id, 7)
+        self.assertTrue(Bulb.query.get(9).power)
+
+
+class ExportTestCase(ApiTestCase):
+
+    def test_export_streams_every_row(self):
+        self.make_fleet(locations=2, bulbs=30)
+        db.session.add(Shared_control(email='friend@example.com', location_id=Location.query.first().id))
+        db.session.commit()
+        app.config['EXPORT_BATCH'] = 7
+        try:
+            response = self.tester.get('/api/a/export', headers=self.headers)
+        finally:
+            app.config['EXPORT_BATCH'] = 1000
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        records = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        kinds = [r['type'] for r in records]
+        self.assertEqual(kinds.count('user'), 1)
+        self.assertEqual(kinds.count('location'), 2)
+        self.assertEqual(kinds.count('group'), 2)
+        self.assertEqual(kinds.count('bulb'), 60)
+        self.assertEqual(kinds.count('shared_control'), 1)
+        self.assertNotIn('password', records[0])
+
+
+class PaginationTestCase(ApiTestCase):
+
+    def get_json(self, url):
+        response = self.tester.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_bulbs_page_by_after_id(self):
+        self.make_fleet(locations=2, bulbs=12)
+        seen, after_id = [], None
+        while True:
+            url = '/api/a/bulbs?limit=5' + ('&after_id=%d' % after_id if after_id is not None else '')
+            data = self.get_json(url)
+            self.assertTrue(len(data['items']) <= 5)
+            seen.extend(b['id'] for b in data['items'])
+            after_id = data['next_after_id']
+            if after_id is None:
+                break
+        self.assertEqual(seen, sorted(b.id for b in Bulb.query.all()))
+
+    def test_fields_trim_the_shape(self):
+        self.make_fleet(locations=1, bulbs=3)
+        data = self.get_json('/api/a/bulbs?fields=id,name,power')
+        self.assertEqual([sorted(b.keys()) for b in data['items']], [['id', 'name', 'power']] * 3)
+        location = Location.query.first()
+        data = self.get_json('/api/a/location/%d?fields=name,bulbs.id&limit=2' % location.id)
+        self.assertEqual(sorted(data.keys()), ['bulbs', 'bulbs_next_after_id', 'name'])
+        self.assertEqual([list(b.keys()) for b in data['bulbs']], [['id'], ['id']])
+        rest = self.get_json('/api/a/location/%d?fields=bulbs.id&limit=2&after_id=%d' % (location.id, data['bulbs_next_after_id']))
+        self.assertEqual(len(rest['bulbs']), 1)
+        self.assertEqual(rest['bulbs_next_after_id'], None)
+
+    def test_fields_skip_unrequested_queries(self):
+        self.make_fleet(locations=1, bulbs=20)
+        full = self.count_queries('/api/a/bulbs')
+        trimmed = self.count_queries('/api/a/bulbs?fields=id,power')
+        self.assertTrue(trimmed < full, '%d statements trimmed, %d full' % (trimmed, full))
+
+
+class ChoicesTestCase(ApiTestCase):
+
+    def test_choices_are_cached_until_changed(self):
+        self.make_fleet(locations=2, bulbs=2)
+        choice_cache().clear()
+        before = choice_cache().stats()
+        self.assertEqual(location_choices(self.user.id), [(l.id, l.name) for l in Location.query.order_by(Location.id)])
+        self.assertEqual(len(bulb_choices(self.user.id)), 4)
+        location_choices(self.user.id)
+        self.assertEqual(choice_cache().stats()['hits'], before['hits'] + 1)
+        location = Location.query.first()
+        location.name = 'Renamed'
+        db.session.add(Bulb(name='New', bulb_type='life', owner_id=self.user.id, location_id=location.id))
+        db.session.commit()
+        self.assertIn((location.id, 'Renamed'), location_choices(self.user.id))
+        self.assertEqual(len(bulb_choices(self.user.id)), 5)
+        #state changes leave the lists alone
+        Bulb.query.first().power = True
+        db.session.commit()
+        location_choices(self.user.id)
+        self.assertEqual(choice_cache().stats()['invalidated'], before['invalidated'] + 2)
+
+    def test_location_bulbs_are_not_joined_by_default(self):
+        self.make_fleet(locations=2, bulbs=3)
+        db.session.expunge_all()
+        locations = Location.query.filter_by(owner_id=self.user.id).all()
+        self.assertTrue(all('bulbs' in inspect(l).unloaded for l in locations))
+        self.assertQueryBudget('/api/a/locations', 6)
+
+
+class FragmentCacheTestCase(ApiTestCase):
+
+    def test_disk_cache_is_an_lru(self):
+        path = tempfile.mkdtemp()
+        try:
+            now = [0]
+            cache = DiskCache(path, size=2, ttl=10, clock=lambda: now[0])
+            for key in ('a', 'b', 'a', 'c'):
+                cache.get(key, lambda key: u'<p>%s</p>' % key)
+            self.assertEqual(list(cache.entries.keys()), ['a', 'c'])
+            self.assertEqual(len(os.listdir(path)), 2)
+            self.assertEqual(cache.get('a', lambda key: None), u'<p>a</p>')
+            now[0] = 11
+            self.assertEqual(cache.get('a', lambda key: u'reloaded'), u'reloaded')
+            self.assertEqual(cache.stats()['evicted'], 1)
+        finally:
+            shutil.rmtree(path)
+
+    def test_writes_bump_the_location_version(self):
+        self.make_fleet(locations=2, bulbs=3)
+        cache = fragment_cache()
+        first, second = [l.id for l in Location.query.order_by(Location.id)]
+        renders = []
+        render = lambda: renders.append(1) or u'<div></div>'
+        key = lambda: ('bulbs', self.user.id, first, cache.version(first))
+        cache.get(key(), render)
+        cache.get(key(), render)
+        self.assertEqual(len(renders), 1)
+        #set-based write
+        set_bulbs_state(Bulb.location_id == first, power=True)
+        cache.get(key(), render)
+        self.assertEqual(len(renders), 2)
+        #ORM delete
+        db.session.delete(Bulb.query.filter_by(location_id=first).first())
+        db.session.commit()
+        cache.get(key(), render)
+        self.assertEqual(len(renders), 3)
+        #writes elsewhere leave it alone
+        version = cache.version(first)
+        set_bulbs_state(Bulb.location_id == second, power=True)
+        self.assertEqual(cache.version(first), version)
+
+
+class XhrControlTestCase(ApiTestCase):
+
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        self.make_fleet(locations=1, bulbs=2)
+        #web login (flask_login keeps the user id in the session)
+        with self.tester.session_transaction() as sess:
+            sess['user_id'] = sess['_user_id'] = str(self.user.id)
+            sess['_fresh'] = True
+        self.xhr = {'X-Requested-With': 'XMLHttpRequest'}
+
+    def test_plain_posts_still_redirect(self):
+        bulb = Bulb.query.first()
+        response = self.tester.post('/bulb/%d/switch' % bulb.id)
+        self.assertEqual(response.status_code, 302)
+
+    def test_xhr_switch_returns_changed_state(self):
+        bulb = Bulb.query.first()
+        response = self.tester.post('/bulb/%d/switch' % bulb.id, headers=dict(self.xhr, Accept='application/json'))
+        self.assertEqual(response.status_code, 200)
+        changes = json.loads(response.data.decode('utf-8'))['changes']
+        self.assertEqual([(c['kind'], c['id']) for c in changes], [('bulb', bulb.id), ('group', bulb.group_id)])
+        self.assertEqual(changes[0]['power'], True)
+
+    def test_xhr_html_returns_items(self):
+        group = Group.query.first()
+        response = self.tester.post('/group/%d/switch' % group.id, headers=dict(self.xhr, Accept='text/html'))
+        self.assertEqual(response.status_code, 200)
+        html = response.data.decode('utf-8')
+        self.assertIn('id="group-%d"' % group.id, html)
+        self.assertEqual(html.count('class="bulb"'), 2)
+        response = self.tester.get('/bulb/%d/delete' % Bulb.query.first().id, headers=dict(self.xhr, Accept='text/html'))
+        self.assertIn('data-deleted', response.data.decode('utf-8'))
+
+    def test_bad_brightness_is_rejected(self):
+        bulb = Bulb.query.first()
+        group = Group.query.first()
+        for url in ('/bulb/%d/dim' % bulb.id, '/group/%d/dim' % group.id):
+            for data in ({}, {'brightness': 'bright'}, {'brightness': '101'}, {'brightness': '-1'}):
+                response = self.tester.post(url, data=data, headers=self.xhr)
+                self.assertEqual(response.status_code, 400)
+        db.session.expire_all()
+        self.assertEqual(Bulb.query.get(bulb.id).brightness, 10)
+
+    def test_xhr_errors_are_json(self):
+        response = self.tester.post('/group/999/dim', data={'brightness': '5'}, headers=self.xhr)
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('error', json.loads(response.data.decode('utf-8')))
+
+
+class ETagTestCase(ApiTestCase):
+
+    def conditional_get(self, url, etag):
+        return self.tester.get(url, headers=dict(self.headers, **{'If-None-Match': etag}))
+
+    def assertRevalidates(self, url, change):
+        response = self.tester.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        unchanged = self.conditional_get(url, etag)
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertEqual(unchanged.data, b'')
+        change()
+        changed = self.conditional_get(url, etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+
+    def test_resources_revalidate(self):
+        self.make_fleet(locations=2, bulbs=3)
+        bulb = Bulb.query.first()
+        group = Group.query.first()
+        location = Location.query.first()
+        self.assertRevalidates('/api/a/bulb/%d' % bulb.id, lambda: set_bulbs_state(Bulb.id == bulb.id, power=True))
+        self.assertRevalidates('/api/a/group/%d' % group.id, lambda: toggle_bulb(bulb.id))
+        def rename():
+            Location.query.get(location.id).name = 'Renamed'
+            db.session.commit()
+        self.assertRevalidates('/api/a/location/%d' % location.id, rename)
+        #the location's name is embedded in its bulbs
+        self.assertRevalidates('/api/a/bulb/%d' % bulb.id, rename)
+        def nickname():
+            User.query.get(self.user.id).nickname = 'renamed'
+            db.session.commit()
+        self.assertRevalidates('/api/a/user/%d' % self.user.id, nickname)
+
+    def test_collections_revalidate(self):
+        self.make_fleet(locations=2, bulbs=3)
+        def add_bulb():
+            db.session.add(Bulb(name='New', bulb_type='life', owner_id=self.user.id,
+                location_id=Location.query.first().id))
+            db.session.commit()
+        self.assertRevalidates('/api/a/bulbs?limit=2', add_bulb)
+        self.assertRevalidates('/api/a/locations', add_bulb)
+        self.assertRevalidates('/api/a/groups', lambda: set_group_state(Group.query.first().id, power=True))
+
+    def test_not_modified_skips_loading(self):
+        self.make_fleet(locations=1, bulbs=20)
+        url = '/api/a/user/%d' % self.user.id
+        etag = self.tester.get(url, headers=self.headers).headers['ETag']
+        response = self.conditional_get(url, etag)
+        self.assertEqual(response.status_code, 304)
+        #the stamp's three aggregate queries
+        self.assertTrue(int(response.headers['X-SQL-Count']) <= 3, response.headers['X-SQL-Count'])
+
+
+    def test_other_users_are_not_served(self):
+        other = User(email='other@example.com', nickname='other', password='secret', confirmed=True)
+        db.session.add(other)
+        db.session.commit()
+        url = '/api/a/user/%d' % other.id
+        self.assertEqual(self.tester.get(url, headers=self.headers).status_code, 400)
+        #not even a 304 for a guessed ETag
+        self.assertEqual(self.conditional_get(url, '*').status_code, 400)
+
+class HistoryTestCase(ApiTestCase):
+
+    def setUp(self):
+        ApiTestCase.setUp(self)
+        app.config['HISTORY_ROLLUP_LAG'] = 0
+        #compaction is tested on its own
+        app.config['HISTORY_COMPACT_INTERVAL'] = 10 ** 12
+
+    def tearDown(self):
+        app.config['HISTORY_ROLLUP_LAG'] = 10
+        app.config['HISTORY_COMPACT_INTERVAL'] = 86400
+        ApiTestCase.tearDown(self)
+
+    def test_changes_are_written_in_batches(self):
+        batches = []
+        log = HistoryLog(batches.append, batch_size=3, interval=60, clock=lambda: 100)
+        log.record([{'kind': 'bulb', 'id': 1, 'power': True, 'brightness': 10}])
+        log.record([{'kind': 'bulb', 'id': 1, 'power': True, 'brightness': 10},
+            {'kind': 'bulb', 'id': 2, 'power': True, 'brightness': 10}])
+        self.assertEqual(batches, [])
+        log.record([{'kind': 'group', 'id': 1, 'power': False, 'brightness': 5}])
+        self.assertEqual([len(b) for b in batches], [3])
+        self.assertEqual(log.stats()['skipped'], 1)
+        log.record([{'kind': 'bulb', 'id': 1, 'power': False, 'brightness': 10}])
+        log.flush()
+        self.assertEqual([len(b) for b in batches], [3, 1])
+
+    def test_failed_writes_are_kept(self):
+        batches = []
+        def writer(rows):
+            if not batches:
+                batches.append(None)
+                raise Exception('database is locked')
+            batches.append(rows)
+        log = HistoryLog(writer, batch_size=100, interval=60, clock=lambda: 100)
+        self.addCleanup(lambda: log.timer and log.timer.cancel())
+        log.record([{'kind': 'bulb', 'id': 1, 'power': True, 'brightness': 10}])
+        self.assertRaises(Exception, log.flush)
+        self.assertEqual(log.stats()['pending'], 1)
+        #still waiting to be written, so a repeat is a duplicate
+        log.record([{'kind': 'bulb', 'id': 1, 'power': True, 'brightness': 10},
+            {'kind': 'bulb', 'id': 2, 'power': False, 'brightness': 10}])
+        self.assertEqual(log.flush(), 2)
+        self.assertEqual([(r['entity_id'], r['power']) for r in batches[1]], [(1, True), (2, False)])
+        self.assertEqual(log.stats()['failed'], 1)
+
+    def test_rollups_and_ranges(self):
+        #bulb 1 on at 0:30, off at 1:30 (minute 1), on again at 2:00:00 and left on
+        write_history([
+            {'at': 30, 'kind': 'bulb', 'entity_id': 1, 'power': True, 'brightness': 40},
+            {'at': 90, 'kind': 'bulb', 'entity_id': 1, 'power': False, 'brightness': 40},
+            {'at': 7200, 'kind': 'bulb', 'entity_id': 1, 'power': True, 'brightness': 80},
+        ])
+        maintain(now=3 * 3600)
+        minutes = State_rollup.query.filter_by(resolution=60).order_by(State_rollup.bucket).all()
+        self.assertEqual([(m.bucket, m.changes, m.on_seconds) for m in minutes], [(0, 1, 30), (60, 1, 30), (7200, 1, 60)])
+        hour = State_rollup.query.filter_by(resolution=3600, bucket=0).one()
+        self.assertEqual((hour.changes, hour.on_seconds, hour.brightness_max), (2, 60, 40))
+        #quiet minutes after 2:00 count as on; the range ends at the rollup mark
+        result = history_range('bulb', 1, 0, 3 * 3600, 60)
+        self.assertEqual(result['on_seconds'], 60 + 3600)
+        self.assertEqual(history_range('bulb', 1, 0, 3 * 3600, 3600)['on_seconds'], 60 + 3600)
+        #rolling up again adds nothing
+        self.assertEqual(maintain(now=3 * 3600)['rolled_up'], 0)
+
+    def test_retention_waits_for_the_day_rollup(self):
+        write_history([{'at': 30, 'kind': 'bulb', 'entity_id': 1, 'power': True, 'brightness': 40}])
+        self.assertEqual(maintain(now=3 * 86400)['history_deleted'], 1)
+        self.assertEqual(State_history.query.count(), 0)
+        self.assertEqual(State_rollup.query.filter_by(resolution=86400).count(), 1)
+
+    def test_history_api(self):
+        self.make_fleet(locations=1, bulbs=1)
+        bulb = Bulb.query.first()
+        write_history([{'at': 30, 'kind': 'bulb', 'entity_id': bulb.id, 'power': True, 'brightness': 40}])
+        maintain(now=600)
+        response = self.tester.get('/api/a/bulb/%d/history?start=0&end=600&resolution=minute' % bulb.id,
+            headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(data['on_seconds'], 570)
+        self.assertEqual(len(data['buckets']), 1)
+
+    def test_compaction_vacuums_free_pages(self):
+        db.session.commit()
+        self.assertTrue(compact(db.engine, free_ratio=0))
+        self.assertFalse(compact(db.engine, free_ratio=2))
+
+
+if __name__ == '__main__':
+    unittest.main()